@@ -0,0 +1,78 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Activation restricted to the agents that can still act.
+#
+# RandomActivation shuffles and steps every agent on every tick. Agents that
+# can no longer move, infect, be infected or change stage (e.g. the deceased)
+# only accumulate a constant value per step and record their trace, which the
+# model can do for all of them at once. This scheduler keeps such agents in a
+# passive set, steps the remaining active set in random order, and hands the
+# passive set to a bulk callback once per step.
+from collections import OrderedDict
+
+from mesa.time import RandomActivation
+
+
+class ActiveSetActivation(RandomActivation):
+    """ RandomActivation that only steps the active agents.
+
+    is_passive(agent) decides whether an agent belongs to the passive set and
+    step_passive(agents) is called once per step with all passive agents.
+    Agents must call update(agent) whenever is_passive may have changed.
+    The agents property still lists every scheduled agent.
+    """
+
+    def __init__(self, model, is_passive, step_passive):
+        super().__init__(model)
+        self.is_passive = is_passive
+        self.step_passive = step_passive
+        # unique_id -> agent, in the order they were added
+        self.active = OrderedDict()
+        self.passive = OrderedDict()
+
+    def add(self, agent):
+        super().add(agent)
+        if self.is_passive(agent):
+            self.passive[agent.unique_id] = agent
+        else:
+            self.active[agent.unique_id] = agent
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.active.pop(agent.unique_id, None)
+        self.passive.pop(agent.unique_id, None)
+
+    def update(self, agent):
+        # Move an agent between the active and passive sets after a state change
+        if agent.unique_id not in self._agents:
+            return
+        if self.is_passive(agent):
+            if self.active.pop(agent.unique_id, None) is not None:
+                self.passive[agent.unique_id] = agent
+        elif self.passive.pop(agent.unique_id, None) is not None:
+            self.active[agent.unique_id] = agent
+
+    def agent_buffer(self, shuffled=False):
+        """ Yield the active agents, letting agents be added, removed or
+        become passive during stepping. Agents turning passive in the middle
+        of a step are still stepped in that step.
+        """
+        agent_keys = list(self.active.keys())
+        if shuffled:
+            self.model.random.shuffle(agent_keys)
+        for key in agent_keys:
+            if key in self._agents:
+                yield self._agents[key]
+
+    def step(self):
+        # Agents that become passive during this step were stepped already
+        passive = list(self.passive.values())
+        for agent in self.agent_buffer(shuffled=True):
+            agent.step()
+        if passive:
+            self.step_passive(passive)
+        self.steps += 1
+        self.time += 1
@@ -1,5 +1,3 @@
-from scipy.stats import poisson, bernoulli
-
 # The agent class contains all the parameters for an agent
 class AgentDataClass:
     def __init__(self, model, is_checkpoint, params):
@@ -7,11 +5,15 @@ class AgentDataClass:
         if not is_checkpoint:
             self.age_group = params[1]
             self.sex_group = params[2]
-            self.vaccine_willingness = bernoulli.rvs(model.model_data.vaccinated_percent)
-            # These are fixed values associated with properties of individuals
-            self.incubation_time = poisson.rvs(model.model_data.avg_incubation)
-            self.dwelling_time = poisson.rvs(model.model_data.avg_dwell)
-            self.recovery_time = poisson.rvs(model.model_data.avg_recovery)
+            # Willingness and fixed times may come pre-drawn in bulk (see PopulationFactory)
+            if len(params) > 4:
+                self.vaccine_willingness, self.incubation_time, self.dwelling_time, self.recovery_time = params[4]
+            else:
+                self.vaccine_willingness = model.streams.population.bernoulli(model.model_data.vaccinated_percent)
+                # These are fixed values associated with properties of individuals
+                self.incubation_time = model.streams.population.poisson(model.model_data.avg_incubation)
+                self.dwelling_time = model.streams.population.poisson(model.model_data.avg_dwell)
+                self.recovery_time = model.streams.population.poisson(model.model_data.avg_recovery)
             self.prob_contagion = model.model_data.prob_contagion_base
             # Mortality in vulnerable population appears to be around day 2-3
             self.mortality_value = params[3]
@@ -40,8 +42,9 @@ class AgentDataClass:
             self.employed = True
             # Contact tracing: this is only available for symptomatic patients
             self.tested_traced = False
-            # All agents 
-            self.contacts = set()
+            # All agents; a dict keyed by agent, so that the contacts are traced in the
+            # order they were made and not in an order that depends on memory addresses
+            self.contacts = {}
             # We assume it takes two full days
             self.tracing_delay = 2*model.model_data.dwell_15_day
             self.tracing_counter = 0
@@ -16,6 +16,8 @@ import multiprocessing
 
 import random
 
+from random_streams import derive_seed
+
 class ParameterError(TypeError):
     MESSAGE = (
         "parameters must map a name to a value. "
@@ -126,12 +128,16 @@ class FixedBatchRunner:
 
         count = len(self.parameters_list)
         if count:
-            for params in self.parameters_list:
+            for index, params in enumerate(self.parameters_list):
                 kwargs = params.copy()
                 kwargs.update(self.fixed_parameters)
                 #run each iterations specific number of times
                 for iter in range(self.iterations):
                     kwargs_repeated = kwargs.copy()
+                    # Each run gets its own seed derived from the base seed, so an
+                    # ensemble is reproducible regardless of which worker runs what
+                    if kwargs_repeated.get("seed") is not None:
+                        kwargs_repeated["seed"] = derive_seed(kwargs_repeated["seed"], index, iter)
                     all_kwargs.append([self.model_cls, kwargs_repeated, self.max_steps, iter])
 
         elif len(self.fixed_parameters):
@@ -157,29 +163,46 @@ class FixedBatchRunner:
                     pbar.update()
 
     @staticmethod
-    def run_wrapper(iter_args, return_dict):
+    def run_wrapper(iter_args):
         model_i = iter_args[0]
         kwargs = iter_args[1]
         max_steps = iter_args[2]
-        # iter_args[1].update({'iteration': iter_args[3]})
+        # The iteration keys the rows the run writes to the database
+        iter_args[1].update({'iteration': iter_args[3]})
         iteration = iter_args[3]
 
         def run_iteration(model_i, kwargs, max_steps, iteration):
             #instantiate version of model with correct parameters
             model = model_i(**kwargs)
-            while model.running and model.schedule.steps < max_steps:
-                model.step()
-
-            dfs = []
-            for data in model.data_lists:
-                dfs.append(model.data_coll)
-            return_dict[iteration] = [model.retrieve_model_Data(), model.retrieve_agent_Data()]
-            # if model.datacollector:
-            #     return model.datacollector.get_model_vars_dataframe()
-            # else:
-            #     return kwargs, "no datacollector in model"
-
-        run_iteration(model_i, kwargs, max_steps, iteration)
+            try:
+                # Room for every step of the run in the collected columns
+                if getattr(model, "datacollector", None) is not None:
+                    model.datacollector.reserve(max_steps)
+                while model.running and model.schedule.steps < max_steps:
+                    model.step()
+                # Record (and stream, for models with a summary table) the statistics of a period the run stopped in
+                if hasattr(model, "flush_collection"):
+                    model.flush_collection()
+                elif getattr(model, "datacollector", None) is not None:
+                    model.datacollector.flush()
+                # Write out the traces still buffered in this process
+                if getattr(model, "db", None) is not None:
+                    model.db.flush()
+
+                dfs = []
+                for data in model.data_lists:
+                    dfs.append(model.data_coll)
+                return iteration, [model.retrieve_model_Data(), model.retrieve_agent_Data()]
+                # if model.datacollector:
+                #     return model.datacollector.get_model_vars_dataframe()
+                # else:
+                #     return kwargs, "no datacollector in model"
+            finally:
+                # Hand the connection back to the pool of the worker for the next run
+                if getattr(model, "db", None) is not None:
+                    model.db.close()
+
+        return run_iteration(model_i, kwargs, max_steps, iteration)
 
 
     def run_model(self, model):
@@ -429,30 +452,23 @@ class BatchRunnerMP(BatchRunner):
                     # make a new process and add it to the queue
             #with self.pool as p:
         if self.processes > 1:
-            #Boots to the ground multiprocessing, if you believe the pool is more efficient then omit all of these changes.
-            #I just had an issue on Windows 10 where if I tried using a nested multiprocess (i.e running different types of scenarios in parallel)
-            manager = multiprocessing.Manager()
-            return_dict = manager.dict()
-            processes = []
-            for parameter in run_iter_args:
-                process = multiprocessing.Process(target=self.run_wrapper, args=(parameter,return_dict))
-                process.start()
-                processes.append(process)
-
-            for process in processes:
-                process.join()
-
-            results = return_dict
-            # for params, model_data in self.pool.imap_unordered(self.run_wrapper, run_iter_args):
-            #     results[str(params)] = model_data
+            # The runs share a bounded pool of workers, so that every worker reuses its
+            # database connection across runs. Scenarios run in parallel start their
+            # batch runs in plain (non-daemonic) processes, which may own a pool.
+            with self.pool as p:
+                for iteration, model_data in p.imap_unordered(self.run_wrapper, run_iter_args):
+                    results[iteration] = model_data
+                # Let the workers exit on their own, closing their connections
+                p.close()
+                p.join()
+            # In the order of the runs, whichever worker finished first
+            results = dict(sorted(results.items()))
 
         #For debugging model due to difficulty of getting errors during multiprocessing
         else:
             for run in run_iter_args:
-                model_data, agent_data = self.run_wrapper(run)
-                #params, model_data = self.run_wrapper(run)
-                #no need for a dictionary since one set of results
-                results[str(params)] = model_data
+                iteration, model_data = self.run_wrapper(run)
+                results[iteration] = model_data
 
         return results
 
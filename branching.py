@@ -0,0 +1,157 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Branching an ensemble from a warmed-up model.
+#
+# Late-policy studies run the same scenario up to some day and only then
+# apply different policies. Instead of simulating the common warm-up once
+# per variant, a model is run up to that step once (warm_up) and branch
+# then runs every variant from its state. Each child is a fork of the
+# parent process, so it starts from a copy-on-write copy of the frozen
+# model; it gets its own random seed, iteration number and experiment uuid,
+# applies its policy overrides and runs to the end. A model holds database
+# connections (and a writer thread), which cannot be copied within a
+# process, so branching needs the fork start method.
+import multiprocessing
+import random
+import uuid
+
+import numpy as np
+
+from checkpoint import CheckpointWriter
+from random_streams import RandomStreams, derive_seed
+from snapshot_store import SnapshotStore, snapshot_path
+
+
+# Iterations set aside for the children of every iteration, see Branch
+BRANCH_ITERATIONS = 1000
+
+
+class Branch:
+    """ A child run of a branched model.
+
+    overrides maps ModelDataClass fields (e.g. distancing, isolation_rate,
+    testing_rate or vaccination_start) to the values the child uses from
+    the branching step on. seed and iteration default to values derived
+    from the position of the branch: the iteration is
+    (parent iteration + 1) * BRANCH_ITERATIONS + position, so that the rows
+    and files of a child never replace those of the parent, of another
+    child or of the other iterations of an ensemble (up to BRANCH_ITERATIONS
+    of them). The iteration must be an integer, as it is stored in integer
+    columns.
+    """
+
+    def __init__(self, overrides=None, seed=None, iteration=None):
+        self.overrides = dict(overrides or {})
+        self.seed = seed
+        self.iteration = iteration
+
+
+def warm_up(model, step):
+    """ run the model up to (not including) the given step """
+    while model.running and model.schedule.steps < step:
+        model.step()
+    return model
+
+
+def model_data_frame(model):
+    # Default result of a branch: what its data collector recorded
+    return model.datacollector.get_model_vars_dataframe()
+
+
+def _reseed(model, seed):
+    # The model draws from its own generators, from its streams and, through
+    # scipy and the random module, from the global generators of the process
+    model.reset_randomizer(seed)
+    model.streams = RandomStreams(seed)
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+
+def _run_branch(model, branch, until, collect):
+    for name, value in branch.overrides.items():
+        if not hasattr(model.model_data, name):
+            raise ValueError(f"Unknown model data field {name}")
+        setattr(model.model_data, name, value)
+    _reseed(model, branch.seed)
+    model.iteration = branch.iteration
+    db = getattr(model, "db", None)
+    if hasattr(model, "run_id"):
+        # The child is a run of its own, also for the change-only traces
+        model.run_id = str(uuid.uuid4())
+        if db is not None and hasattr(model, "experiment_row"):
+            db.insert_model(model.experiment_row())
+    writer = getattr(model, "checkpoint_writer", None)
+    if writer is not None:
+        # Checkpoints of the child go to its own files
+        model.checkpoint_writer = CheckpointWriter(writer.base, branch.iteration, writer.keep)
+    if getattr(model, "snapshot_store", None) is not None:
+        # and so do its snapshots
+        model.snapshot_store = SnapshotStore(snapshot_path(model.agent_snapshot_file, branch.iteration), "w")
+
+    while model.running and model.schedule.steps < until:
+        model.step()
+    if hasattr(model, "flush_collection"):
+        model.flush_collection()
+    else:
+        datacollector = getattr(model, "datacollector", None)
+        if datacollector is not None and hasattr(datacollector, "flush"):
+            datacollector.flush()
+    if db is None:
+        return collect(model)
+    # Everything the child wrote is stored before collect runs (and may read it back)
+    db.flush()
+    try:
+        return collect(model)
+    finally:
+        db.close()
+
+
+# What the forked children share with the parent: (model, until, collect)
+_parent = None
+
+
+def _forked_branch(branch):
+    model, until, collect = _parent
+    return _run_branch(model, branch, until, collect)
+
+
+def branch(model, branches, until=None, collect=model_data_frame, processes=None, seed=None):
+    """ Run every branch from the current state of the model.
+
+    Each child runs until its schedule reaches until (by default the
+    model's max_steps) and returns collect(child_model). The results are
+    returned in the order of the branches. The seeds of the branches are
+    derived from seed (by default the seed of the model) and their
+    position; the parent model itself is left untouched.
+    """
+    global _parent
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("Branching a model needs the fork start method, which this platform does not have")
+    if until is None:
+        until = model.max_steps
+    if seed is None:
+        seed = model.streams.seed
+    branches = list(branches)
+    for index, child in enumerate(branches):
+        if child.seed is None:
+            child.seed = derive_seed(seed, index)
+        if child.iteration is None:
+            child.iteration = (model.iteration + 1) * BRANCH_ITERATIONS + index
+        if not isinstance(child.iteration, int):
+            raise ValueError(f"The iteration of a branch must be an integer, not {child.iteration!r}")
+
+    db = getattr(model, "db", None)
+    if db is not None:
+        # Rows still buffered by the parent would otherwise be written again by every child
+        db.flush()
+
+    # Every task gets a freshly forked worker, that is, a fresh copy of the frozen model
+    _parent = (model, until, collect)
+    try:
+        with multiprocessing.get_context("fork").Pool(processes, maxtasksperchild=1) as pool:
+            return pool.map(_forked_branch, branches, chunksize=1)
+    finally:
+        _parent = None
@@ -0,0 +1,344 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Binary checkpoints for the backtracking model (covidmodelcheckpoint.py).
+#
+# The state of a model at one step is stored as one row per agent: every
+# agent field is a typed column (enums as their values, the variant as a
+# code into a list of names, the variant immunities as a flag matrix, the
+# contacts as a ragged list of agent ids and the position as an (x, y)
+# pair). Alongside the columns, a small JSON header holds the model data
+# (ModelDataClass), the state of the random number generators and of the
+# scheduler. Everything goes into a single .npz file, written and read in
+# time linear in the number of agents and without evaluating any strings.
+#
+# Save files of the older CSV format (one "Agent {i} {param}" column per
+# agent and field, one row per step and iteration) can still be restored
+# with read_csv_state, which locates the row once and parses only that row.
+import ast
+import collections
+import csv
+import dataclasses
+import itertools
+import json
+import os
+import random
+from enum import Enum
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+from model_data_class import ModelDataClass
+
+
+FORMAT = "covid-checkpoint"
+VERSION = 1
+
+# Agent fields and how they are stored, in the order of agent_parameter_names
+COLUMNS = (("unique_id", "int"), ("stage", "enum"), ("age_group", "enum"), ("sex_group", "enum"),
+           ("vaccine_willingness", "int"), ("incubation_time", "int"), ("dwelling_time", "int"),
+           ("recovery_time", "int"), ("prob_contagion", "float"), ("mortality_value", "float"),
+           ("severity_value", "float"), ("curr_dwelling", "int"), ("curr_incubation", "int"),
+           ("curr_recovery", "int"), ("curr_asymptomatic", "int"), ("isolated", "bool"),
+           ("isolated_but_inefficient", "bool"), ("test_chance", "float"), ("in_isolation", "bool"),
+           ("in_distancing", "bool"), ("in_testing", "bool"), ("astep", "int"), ("tested", "bool"),
+           ("occupying_bed", "bool"), ("cumul_private_value", "float"), ("cumul_public_value", "float"),
+           ("employed", "bool"), ("tested_traced", "bool"), ("contacts", "ids"), ("tracing_delay", "int"),
+           ("tracing_counter", "int"), ("vaccinated", "bool"), ("safetymultiplier", "float"),
+           ("current_effectiveness", "float"), ("vaccination_day", "int"), ("vaccine_count", "int"),
+           ("dosage_eligible", "bool"), ("fully_vaccinated", "bool"), ("variant", "category"),
+           ("variant_immune", "flags"), ("pos", "pos"))
+
+DTYPES = {"int": np.int64, "float": np.float64, "bool": np.bool_, "enum": np.int64}
+
+# Fields kept on the agent itself; the others live in agent.agent_data
+AGENT_FIELDS = frozenset(["unique_id", "stage", "astep", "pos"])
+
+
+def _encode(value):
+    # JSON form of the model data: enums by class and member name, dicts as
+    # lists of items (their keys are often enums)
+    if isinstance(value, Enum):
+        return {"enum": type(value).__name__, "name": value.name}
+    if isinstance(value, dict):
+        return {"items": [[_encode(key), _encode(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode(value, enums):
+    if isinstance(value, dict):
+        if "enum" in value:
+            return enums[value["enum"]][value["name"]]
+        return {_decode(key, enums): _decode(item, enums) for key, item in value["items"]}
+    if isinstance(value, list):
+        return [_decode(item, enums) for item in value]
+    return value
+
+
+def _python_state(state):
+    # random.Random.getstate() as nested lists, and back
+    version, internal, gauss = state
+    return [version, list(internal), gauss]
+
+
+def _random_state(state):
+    version, internal, gauss = state
+    return (version, tuple(internal), gauss)
+
+
+def capture(model):
+    """ The state of the model as a dict of arrays, ready to be written.
+
+    The agents are stored in schedule order.
+    """
+    agents = model.schedule.agents
+    arrays = {}
+    data_fields = [name for name, _ in COLUMNS if name not in AGENT_FIELDS]
+    getter = attrgetter(*data_fields)
+    values = dict(zip(data_fields, zip(*[getter(agent.agent_data) for agent in agents]))) if agents else {}
+    variants = list(model.model_data.variant_data_list)
+
+    for name, kind in COLUMNS:
+        if name in AGENT_FIELDS:
+            column = [getattr(agent, name) for agent in agents]
+        else:
+            column = values.get(name, ())
+        if kind == "enum":
+            arrays[name] = np.array([value.value for value in column], dtype=np.int64)
+        elif kind == "category":
+            codes = {variant: code for code, variant in enumerate(variants)}
+            arrays[name] = np.array([codes.setdefault(value, len(codes)) for value in column], dtype=np.int32)
+            variants = list(codes)
+        elif kind == "flags":
+            arrays[name] = np.array([[immune.get(variant, False) for variant in variants] for immune in column],
+                                    dtype=np.bool_).reshape(len(agents), len(variants))
+        elif kind == "ids":
+            arrays[name + ".offsets"] = np.cumsum([0] + [len(contacts) for contacts in column], dtype=np.int64)
+            arrays[name] = np.array([contact.unique_id for contacts in column for contact in contacts], dtype=np.int64)
+        elif kind == "pos":
+            arrays[name] = np.array([(-1, -1) if value is None else value for value in column],
+                                    dtype=np.int64).reshape(len(agents), 2)
+        else:
+            arrays[name] = np.array(column, dtype=DTYPES[kind])
+
+    streams = {}
+    for name, stream in vars(model.streams).items():
+        if hasattr(stream, "generator"):
+            streams[name] = stream.generator.bit_generator.state
+            # Variates drawn in the current block but not used yet
+            arrays["stream." + name] = np.array(stream._uniforms[stream._next_uniform:], dtype=np.float64)
+
+    numpy_state = np.random.get_state()
+    arrays["numpy_random"] = numpy_state[1]
+    header = {
+        "format": FORMAT,
+        "version": VERSION,
+        "fields": [name for name, _ in COLUMNS],
+        "variants": variants,
+        "model": {"stepno": model.stepno, "iteration": model.iteration, "i": model.i,
+                  "num_agents": model.num_agents},
+        "schedule": {"steps": model.schedule.steps, "time": model.schedule.time},
+        "model_data": {field.name: _encode(getattr(model.model_data, field.name))
+                       for field in dataclasses.fields(model.model_data)},
+        "random": {"model": _python_state(model.random.getstate()),
+                   "python": _python_state(random.getstate()),
+                   "numpy": [numpy_state[0]] + [_encode(value) for value in numpy_state[2:]],
+                   "streams": streams},
+    }
+    arrays["header"] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    return arrays
+
+
+def header(arrays):
+    """ The decoded JSON header of a checkpoint """
+    return json.loads(arrays["header"].tobytes().decode())
+
+
+def checkpoint_path(base, iteration, step):
+    """ file of the checkpoint of an iteration at a step, for the save file base """
+    root, _ = os.path.splitext(base)
+    return f"{root}_{iteration}_{step}.npz"
+
+
+def locate(path, iteration, step):
+    # A path naming a checkpoint file is used as is; otherwise it is the save file
+    # base of a run, and the checkpoint of the iteration at the step is looked up
+    if path.endswith(".npz") and os.path.isfile(path):
+        return path
+    return checkpoint_path(path, iteration, step)
+
+
+def write(path, arrays):
+    """ write a checkpoint captured by capture to path (uncompressed, for speed)
+
+    The checkpoint is written to a temporary file next to path and renamed
+    into place, so a file under the final name is always complete.
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read(path):
+    """ read a checkpoint back into a dict of arrays """
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def save(path, model):
+    write(path, capture(model))
+
+
+class CheckpointWriter:
+    """ Writes the checkpoints of a run to disk as they are taken.
+
+    Every checkpoint goes to checkpoint_path(base, iteration, step) as soon
+    as it is captured, so a run holds at most one in memory. With keep
+    set, only the keep most recent checkpoints of the run are kept: older
+    files are removed once a newer one is in place.
+    """
+
+    def __init__(self, base, iteration, keep=None):
+        self.base = base
+        self.iteration = iteration
+        self.keep = keep
+        self.written = collections.deque()
+
+    def save(self, model, arrays=None):
+        # arrays is the checkpoint of the model, when it has been captured already
+        path = checkpoint_path(self.base, self.iteration, model.stepno)
+        write(path, capture(model) if arrays is None else arrays)
+        if path not in self.written:
+            self.written.append(path)
+        while self.keep is not None and len(self.written) > self.keep:
+            os.remove(self.written.popleft())
+        return path
+
+
+def restore(model, arrays, agent_class, enums):
+    """ Rebuild the agents and the state of a freshly constructed model.
+
+    The agents are created with agent_class(model, parameters), with the
+    parameters in the order of the checkpoint fields (position excluded),
+    added to the schedule in the stored order and placed on the grid.
+    enums maps the names of the enum classes used by the model to the
+    classes. The model data, generators and step counters are restored.
+    """
+    info = header(arrays)
+    if info.get("format") != FORMAT or info.get("version") != VERSION:
+        raise ValueError("Not a checkpoint of a supported version")
+    kinds = dict(COLUMNS)
+    variants = info["variants"]
+    enum_classes = {"stage": enums["Stage"], "age_group": enums["AgeGroup"], "sex_group": enums["SexGroup"]}
+
+    columns = []
+    for name in info["fields"]:
+        kind = kinds[name]
+        if name == "pos" or kind == "ids":
+            continue
+        values = arrays[name].tolist()
+        if kind == "enum":
+            members = {member.value: member for member in enum_classes[name]}
+            values = [members[value] for value in values]
+        elif kind == "category":
+            values = [variants[code] for code in values]
+        elif kind == "flags":
+            values = [dict(zip(variants, flags)) for flags in values]
+        columns.append(values)
+
+    # Contacts refer to other agents, so they are filled in once all exist
+    contacts_at = info["fields"].index("contacts")
+    created = []
+    for params in zip(*columns):
+        params = list(params)
+        params.insert(contacts_at, {})
+        agent = agent_class(model, params)
+        model.schedule.add(agent)
+        created.append(agent)
+    by_id = {agent.unique_id: agent for agent in created}
+    offsets = arrays["contacts.offsets"].tolist()
+    ids = arrays["contacts"].tolist()
+    for agent, start, end in zip(created, offsets, offsets[1:]):
+        agent.agent_data.contacts.update((by_id[contact], None) for contact in ids[start:end])
+    for agent, (x, y) in zip(created, arrays["pos"].tolist()):
+        if x >= 0:
+            model.grid.place_agent(agent, (x, y))
+
+    state = info["model"]
+    model.stepno = state["stepno"]
+    model.i = state["i"]
+    model.num_agents = state["num_agents"]
+    model.schedule.steps = info["schedule"]["steps"]
+    model.schedule.time = info["schedule"]["time"]
+    model.model_data = ModelDataClass(**{name: _decode(value, enums) for name, value in info["model_data"].items()})
+
+    generators = info["random"]
+    model.random.setstate(_random_state(generators["model"]))
+    random.setstate(_random_state(generators["python"]))
+    numpy_state = generators["numpy"]
+    np.random.set_state((numpy_state[0], arrays["numpy_random"]) + tuple(numpy_state[1:]))
+    for name, bit_state in generators["streams"].items():
+        stream = getattr(model.streams, name)
+        stream.generator.bit_generator.state = bit_state
+        stream._uniforms = arrays["stream." + name].tolist()
+        stream._next_uniform = 0
+    return info
+
+
+def _csv_parsers(enums):
+    # Conversion of the text of a CSV field to its value, by kind of column
+    def members(enum):
+        # Enums are saved as their string form, e.g. Stage.EXPOSED
+        return lambda text: enum[text.rsplit(".", 1)[-1]]
+    return {"int": lambda text: int(float(text)),
+            "float": float,
+            "bool": lambda text: text == "True",
+            "stage": members(enums["Stage"]),
+            "age_group": members(enums["AgeGroup"]),
+            "sex_group": members(enums["SexGroup"]),
+            "category": str,
+            "flags": ast.literal_eval,
+            "pos": ast.literal_eval,
+            # Contacts were saved as the text of agent objects, which cannot be restored
+            "ids": lambda text: {}}
+
+
+def read_csv_state(path, step, iteration, names, num_agents, enums):
+    """ Agents stored at a step of an iteration in a CSV save file.
+
+    names are the agent fields in the order of the columns of every agent,
+    pos last. Returns a list with, for every agent, its parameters (all
+    fields but pos, in order) and its position. Only the Step and Iteration
+    columns are read to find the row; that single line is then split and
+    its fields converted one column at a time over all agents.
+    """
+    index = pd.read_csv(path, usecols=["Step", "Iteration"])
+    rows = np.flatnonzero((index["Step"].to_numpy() == step) & (index["Iteration"].to_numpy() == iteration))
+    if len(rows) != 1:
+        raise ValueError(f"{path} has {len(rows)} rows for step {step} of iteration {iteration}")
+    with open(path, newline="") as f:
+        lines = csv.reader(f)
+        fields = next(lines)
+        line = next(itertools.islice(lines, rows[0], None))
+    position = {field: i for i, field in enumerate(fields)}
+
+    kinds = dict(COLUMNS)
+    parsers = _csv_parsers(enums)
+    columns = []
+    for name in names:
+        kind = kinds[name]
+        parse = parsers[name if kind == "enum" else kind]
+        columns.append([parse(line[position[f"Agent {agent} {name}"]]) for agent in range(num_agents)])
+
+    positions = columns.pop(names.index("pos"))
+    return [(list(params), position) for params, position in zip(zip(*columns), positions)]
@@ -0,0 +1,135 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Per-cell index of contagious occupants.
+#
+# The infection check of a susceptible (or recovered) agent used to scan every
+# cellmate and ask whether it was contagious, which is quadratic in the cell
+# occupancy. The index keeps, for every grid cell, the contagious occupants
+# bucketed by kind (symptomatic or asymptomatic) and variant. It is kept up to
+# date by ContagionGrid when agents are placed, moved or removed, and by
+# CovidAgent when its stage changes, so an infection check is a lookup over a
+# handful of buckets followed by a single weighted draw.
+from mesa.space import MultiGrid
+
+
+# Contact kinds, numbered as the infected_contact codes in CovidAgent.step
+SYMPTOMATIC = 1
+ASYMPTOMATIC = 2
+
+
+class ContagionIndex:
+
+    def __init__(self):
+        # pos -> {(kind, variant): {agent: None}}; buckets are dicts so that they are
+        # iterated in insertion order and not in an order that depends on memory addresses
+        self.cells = {}
+        # agent -> position, for every agent on the grid
+        self.positions = {}
+        # agent -> (pos, (kind, variant)), for every indexed agent
+        self.entries = {}
+
+    def place(self, agent, pos):
+        self.positions[agent] = pos
+        self._insert(agent, pos)
+
+    def remove(self, agent):
+        self._discard(agent)
+        self.positions.pop(agent, None)
+
+    def update(self, agent):
+        # Re-bucket an agent after a change of stage or variant
+        pos = self.positions.get(agent)
+        if pos is None:
+            return
+        self._discard(agent)
+        self._insert(agent, pos)
+
+    def _insert(self, agent, pos):
+        kind = agent.contagion_kind()
+        if kind is None:
+            return
+        key = (kind, agent.agent_data.variant)
+        self.cells.setdefault(pos, {}).setdefault(key, {})[agent] = None
+        self.entries[agent] = (pos, key)
+
+    def _discard(self, agent):
+        entry = self.entries.pop(agent, None)
+        if entry is None:
+            return
+        pos, key = entry
+        cell = self.cells[pos]
+        bucket = cell[key]
+        bucket.pop(agent, None)
+        if not bucket:
+            del cell[key]
+            if not cell:
+                del self.cells[pos]
+
+    def count(self, pos, kind, eligible):
+        # Number of contagious occupants of the given kind whose variant passes eligible
+        cell = self.cells.get(pos)
+        if not cell:
+            return 0
+        return sum(len(bucket) for (k, variant), bucket in cell.items() if k == kind and eligible(variant))
+
+    def draw(self, pos, kind, eligible, uniform):
+        # Draw the variant of a contact, weighted by the number of contagious occupants
+        # carrying it. Returns None when there is no eligible contagious occupant.
+        cell = self.cells.get(pos)
+        if not cell:
+            return None
+
+        weights = [(variant, len(bucket)) for (k, variant), bucket in cell.items() if k == kind and eligible(variant)]
+        total = sum(weight for _, weight in weights)
+        if total == 0:
+            return None
+
+        target = uniform() * total
+        for variant, weight in weights:
+            target = target - weight
+            if target < 0:
+                return variant
+        return weights[-1][0]
+
+    def occupants(self, pos, kind, eligible):
+        # Iterate over the contagious occupants of the given kind whose variant passes eligible
+        cell = self.cells.get(pos)
+        if not cell:
+            return
+        for (k, variant), bucket in list(cell.items()):
+            if k == kind and eligible(variant):
+                yield from list(bucket)
+
+
+class ContagionGrid(MultiGrid):
+    """ MultiGrid that maintains a ContagionIndex of its occupants.
+
+    Every placement and removal goes through _place_agent/_remove_agent,
+    so place_agent, move_agent and remove_agent all keep the index current.
+    """
+
+    def __init__(self, width, height, torus):
+        super().__init__(width, height, torus)
+        self.contagion = ContagionIndex()
+
+    def _place_agent(self, pos, agent):
+        super()._place_agent(pos, agent)
+        self.contagion.place(agent, pos)
+
+    def _remove_agent(self, pos, agent):
+        super()._remove_agent(pos, agent)
+        self.contagion.remove(agent)
+
+    def place_agents(self, agents, positions):
+        # Bulk place_agent: the list of empty cells is filtered once for the
+        # whole batch instead of being searched for every agent
+        for agent, pos in zip(agents, positions):
+            x, y = pos
+            self.grid[x][y].add(agent)
+            agent.pos = pos
+            self.contagion.place(agent, pos)
+        occupied = set(positions)
+        self.empties = [pos for pos in self.empties if pos not in occupied]
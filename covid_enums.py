@@ -0,0 +1,52 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Stages and groups of the agents of the COVID-19 model, shared by the
+# model and its population engine
+from enum import Enum
+
+
+class Stage(Enum):
+    SUSCEPTIBLE = 1
+    EXPOSED = 2
+    ASYMPTOMATIC = 3
+    SYMPDETECTED = 4
+    ASYMPDETECTED = 5
+    SEVERE = 6
+    RECOVERED = 7
+    DECEASED = 8
+
+
+class AgeGroup(Enum):
+    C00to09 = 0
+    C10to19 = 1
+    C20to29 = 2
+    C30to39 = 3
+    C40to49 = 4
+    C50to59 = 5
+    C60to69 = 6
+    C70to79 = 7
+    C80toXX = 8
+
+
+class SexGroup(Enum):
+    MALE = 1
+    FEMALE = 2
+
+
+class ValueGroup(Enum):
+    PRIVATE = 1
+    PUBLIC = 2
+
+class VaccinationStage(Enum):
+    C00to09 = 0
+    C10to19 = 1
+    C20to29 = 2
+    C30to39 = 3
+    C40to49 = 4
+    C50to59 = 5
+    C60to69 = 6
+    C70to79 = 7
+    C80toXX = 8
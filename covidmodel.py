@@ -5,19 +5,19 @@
 
 # A simple tunable model for COVID-19 response
 import math
+from collections import Counter
+from functools import partial
 from operator import mod
 from sqlite3 import DatabaseError
 import timeit
 
 import mesa.batchrunner
 from mesa import Agent, Model
-from mesa.time import RandomActivation
-from mesa.space import MultiGrid
+from active_schedule import ActiveSetActivation
 from datacollection import DataCollector
-from scipy.stats import poisson, bernoulli
-from enum import Enum
+from fused_reporters import Aggregate, FusedReporter
+from covid_enums import Stage, AgeGroup, SexGroup, ValueGroup, VaccinationStage
 import numpy as np
-import random
 import sys
 import psutil as psu
 import timeit as time
@@ -28,91 +28,195 @@ from model_data_class import ModelDataClass
 import uuid
 from database import Database
 from policyhandler import PolicyHandler
-
-
-def bernoulli_rvs(p):
-    # Return a sample from a Bernoulli-distributed random source
-    # We convert from a Uniform(0, 1)
-    r = random.random()
-    if r >= p:
-        return 1
-    return 0
-
-
-def poisson_rvs(mu):
-    p0 = math.exp(-mu)
-    F = p0
-    i = 0
-    sample = random.random()
-    while sample >= F:
-        i += 1
-        F += p0 * (mu ** i) / math.factorial(i)
-    return i
-
-
-class Stage(Enum):
-    SUSCEPTIBLE = 1
-    EXPOSED = 2
-    ASYMPTOMATIC = 3
-    SYMPDETECTED = 4
-    ASYMPDETECTED = 5
-    SEVERE = 6
-    RECOVERED = 7
-    DECEASED = 8
-
-
-class AgeGroup(Enum):
-    C00to09 = 0
-    C10to19 = 1
-    C20to29 = 2
-    C30to39 = 3
-    C40to49 = 4
-    C50to59 = 5
-    C60to69 = 6
-    C70to79 = 7
-    C80toXX = 8
-
-
-class SexGroup(Enum):
-    MALE = 1
-    FEMALE = 2
-
-
-class ValueGroup(Enum):
-    PRIVATE = 1
-    PUBLIC = 2
-
-class VaccinationStage(Enum):
-    C00to09 = 0
-    C10to19 = 1
-    C20to29 = 2
-    C30to39 = 3
-    C40to49 = 4
-    C50to59 = 5
-    C60to69 = 6
-    C70to79 = 7
-    C80toXX = 8
-
+from contagion_index import ContagionGrid, SYMPTOMATIC, ASYMPTOMATIC
+from random_streams import RandomStreams
+from population_counters import PopulationCounters
+from vaccination_scheduler import VaccinationScheduler
+from timer_wheel import TimerWheel
+from resource_sampler import resource_sampler
+from population import PopulationEngine, PopulationSchedule, PopulationFactory
 
 
 class CovidAgent(Agent):
     """ An agent representing a potential covid case"""
     
-    def __init__(self, unique_id, ageg, sexg, mort, model):
+    def __init__(self, unique_id, ageg, sexg, mort, model, draws=None):
         super().__init__(unique_id, model)
-        self.stage = Stage.SUSCEPTIBLE
+        self._stage = Stage.SUSCEPTIBLE
         self.astep = 0
         is_checkpoint = False
         params = [0, ageg, sexg, mort]
+        if draws is not None:
+            params.append(draws)
         self.agent_data = AgentDataClass(model, is_checkpoint, params)
+        # Running countdowns, see schedule_countdowns
+        self.stage_timer = None
+        self.countdown = None
+        self.tracing_timer = None
+        self.tracing_countdown = None
+        self.move_due = model.stepno + self.agent_data.curr_dwelling
+        model.counters.add(self)
 
        
     def alive(self):
         print(f'{self.unique_id} {self.agent_data.age_group} {self.agent_data.sex_group} is alive')
 
+    @property
+    def stage(self):
+        return self._stage
+
+    @stage.setter
+    def stage(self, stage):
+        # Keep the per-cell contagion index, the counters and the countdowns in sync
+        # with stage transitions
+        self.sync_countdowns()
+        self._stage = stage
+        self.model.grid.contagion.update(self)
+        self.model.counters.update(self)
+        self.schedule_countdowns()
+        self.model.schedule.update(self)
+
+    def set_data(self, **fields):
+        # Set fields of agent_data the population counters depend on (see counter_keys),
+        # recounting the agent when one of them actually changes
+        data = self.agent_data
+        changed = False
+        for name, value in fields.items():
+            if getattr(data, name) != value:
+                setattr(data, name, value)
+                changed = True
+        if changed:
+            self.model.counters.update(self)
+
+    # Incubation, recovery and contact tracing countdowns are not ticked on every
+    # step. When an agent enters a stage, the step at which the countdown runs out
+    # is registered in the model's timer wheel, which fires the transition at the
+    # start of that step. The curr_* fields are only materialised on demand.
+
+    def sync_countdowns(self):
+        # Bring curr_incubation/curr_recovery, tracing_counter and curr_dwelling up to date
+        now = self.model.stepno
+        if self.countdown is not None:
+            field, start, since, span = self.countdown
+            setattr(self.agent_data, field, start + min(now - since, span))
+        if self.tracing_countdown is not None:
+            start, since, span = self.tracing_countdown
+            self.agent_data.tracing_counter = start + min(now - since, span)
+        self.agent_data.curr_dwelling = max(self.move_due - now - 1, 0)
+
+    def schedule_countdowns(self):
+        # Register the step at which the countdown of the current stage runs out
+        if self.stage_timer is not None:
+            self.model.timers.cancel(self.stage_timer)
+            self.stage_timer = None
+        self.countdown = None
+
+        data = self.agent_data
+        if self._stage == Stage.EXPOSED:
+            self.start_countdown("curr_incubation", data.curr_incubation,
+                                 data.incubation_time - data.curr_incubation, self.end_incubation)
+        elif self._stage == Stage.ASYMPTOMATIC or self._stage == Stage.SEVERE:
+            self.start_countdown("curr_recovery", data.curr_recovery,
+                                 data.recovery_time - data.curr_recovery, self.recover)
+        elif self._stage == Stage.SYMPDETECTED or self._stage == Stage.ASYMPDETECTED:
+            self.start_countdown("curr_recovery", data.curr_recovery,
+                                 data.incubation_time + data.recovery_time - data.curr_incubation - data.curr_recovery,
+                                 self.recover)
+
+        self.schedule_tracing()
+
+    def start_countdown(self, field, start, span, callback):
+        # The countdown ticks once per step and runs out on the step after its last tick
+        span = max(span, 0)
+        now = self.model.stepno
+        self.countdown = (field, start, now, span)
+        self.stage_timer = self.model.timers.schedule(now + span + 1, callback)
+
+    def schedule_tracing(self):
+        # Detected agents test their contacts once tracing_delay steps of active tracing have passed
+        if self.tracing_timer is not None:
+            self.model.timers.cancel(self.tracing_timer)
+            self.tracing_timer = None
+        self.tracing_countdown = None
+
+        data = self.agent_data
+        if (self._stage == Stage.SYMPDETECTED or self._stage == Stage.ASYMPDETECTED) and \
+                self.model.model_data.tracing_now and data.tracing_counter >= 0:
+            span = max(data.tracing_delay - data.tracing_counter, 0)
+            now = self.model.stepno
+            self.tracing_countdown = (data.tracing_counter, now, span)
+            self.tracing_timer = self.model.timers.schedule(now + span + 1, self.trace_contacts)
+
+    def end_incubation(self):
+        self.stage_timer = None
+        current_prob_asymptomatic = self.model.model_data.prob_asymptomatic * self.model.model_data.variant_data_list[self.agent_data.variant]["Asymtpomatic_Multiplier"]
+        if self.agent_data.vaccinated:
+            current_prob_asymptomatic = 1-(1-self.model.model_data.prob_asymptomatic) * self.agent_data.safetymultiplier
+
+        if self.model.streams.infection.bernoulli(current_prob_asymptomatic):
+            self.stage = Stage.ASYMPTOMATIC
+        else:
+            self.stage = Stage.SYMPDETECTED
+
+    def recover(self):
+        self.stage_timer = None
+        if self.stage == Stage.SEVERE and self.agent_data.occupying_bed:
+            self.agent_data.occupying_bed = False
+            self.model.model_data.bed_count += 1
+        self.stage = Stage.RECOVERED
+        self.agent_data.variant_immune[self.agent_data.variant] = True
+
+    def trace_contacts(self):
+        self.sync_countdowns()
+        self.tracing_timer = None
+        self.tracing_countdown = None
+        for t in self.agent_data.contacts:
+            t.test_contact_trace()
+        self.agent_data.tracing_counter = -1
+
+    def is_passive(self):
+        # Deceased agents only accrue the value of their stage, see step_passive
+        return self.stage == Stage.DECEASED
+
     def is_contagious(self):
         return (self.stage == Stage.EXPOSED) or (self.stage == Stage.ASYMPTOMATIC) or (self.stage == Stage.SYMPDETECTED)
 
+    def counter_keys(self):
+        # Keys of the population counters this agent currently contributes to
+        data = self.agent_data
+        stage = self.stage
+        age = data.age_group
+        keys = [("stage", stage), ("variant", data.variant), ("stage_variant", stage, data.variant), ("age", age),
+                ("vaccine_count", data.vaccine_count), ("age_vaccine_count", age, data.vaccine_count)]
+        if data.vaccinated:
+            keys.extend([("vaccinated",), ("vaccinated_age", age), ("vaccinated_stage", stage)])
+        if data.fully_vaccinated:
+            keys.append(("fully_vaccinated_age", age))
+        if data.isolated:
+            keys.append(("isolated",))
+        if data.employed:
+            keys.append(("employed",))
+        if data.tested:
+            keys.append(("tested",))
+        if data.tested_traced:
+            keys.append(("traced",))
+        if data.vaccine_willingness:
+            keys.append(("willing",))
+            if data.dosage_eligible and stage != Stage.DECEASED:
+                keys.append(("dosage_eligible_willing",))
+            if data.dosage_eligible and (stage == Stage.SUSCEPTIBLE or stage == Stage.EXPOSED or stage == Stage.ASYMPTOMATIC):
+                keys.append(("eligible_age", age))
+        return tuple(keys)
+
+    def contagion_kind(self):
+        # Kind of contact this agent represents for its cellmates, if any. Only
+        # contagious agents in a symptomatic or asymptomatic stage can infect others.
+        if self.stage == Stage.SYMPDETECTED:
+            return SYMPTOMATIC
+        elif self.stage == Stage.ASYMPTOMATIC:
+            return ASYMPTOMATIC
+        return None
+
     def dmult(self):
         # In this function, we simulate aerosol effects exhibited by droplets due to
         # both the contributions of a) a minimum distance with certainty of infection
@@ -145,23 +249,36 @@ class CovidAgent(Agent):
     def test_contact_trace(self):
         # We may have an already tested but it had a posterior contact and became infected
         if self.stage == Stage.SUSCEPTIBLE:
-            self.agent_data.tested_traced = True
+            self.set_data(tested_traced=True)
         elif self.stage == Stage.EXPOSED:
-            self.agent_data.tested_traced = True
+            self.set_data(tested_traced=True)
 
-            if bernoulli_rvs(self.model.model_data.prob_asymptomatic):
+            if self.model.streams.infection.bernoulli(self.model.model_data.prob_asymptomatic):
                     self.stage = Stage.ASYMPDETECTED
             else:
                 self.stage = Stage.SYMPDETECTED
         elif self.stage == Stage.ASYMPTOMATIC:
             self.stage = Stage.ASYMPDETECTED
-            self.agent_data.tested_traced = True
+            self.set_data(tested_traced=True)
         else:
             return
 
+    def draw_contact(self, symptomatic_eligible, asymptomatic_eligible):
+        # Look up the contagious cellmates in the contagion index. Returns the contact
+        # kind (1 symptomatic, 2 asymptomatic only, 0 none) and the variant drawn in
+        # proportion to the number of contagious cellmates carrying it.
+        index = self.model.grid.contagion
+        variant = index.draw(self.pos, SYMPTOMATIC, symptomatic_eligible, self.model.streams.infection.uniform)
+        if variant is not None:
+            return 1, variant
+        variant = index.draw(self.pos, ASYMPTOMATIC, asymptomatic_eligible, self.model.streams.infection.uniform)
+        if variant is not None:
+            return 2, variant
+        return 0, "Standard"
+
     def add_contact_trace(self, other):
         if self.model.model_data.tracing_now:
-            self.agent_data.contacts.add(other)
+            self.agent_data.contacts[other] = None
 
     #helper function that reveals if an agent is vaccinated
     def is_vaccinated(self):
@@ -176,7 +293,7 @@ class CovidAgent(Agent):
         eligible_count = compute_age_group_count(self.model, self.agent_data.age_group)
         vaccination_chance = 1/eligible_count
         if self.stage == Stage.ASYMPTOMATIC or self.stage == Stage.SUSCEPTIBLE or self.stage == Stage.EXPOSED:
-            if bernoulli_rvs(vaccination_chance):
+            if self.model.streams.vaccination.bernoulli(vaccination_chance):
                 return True
             return False
         return False
@@ -220,17 +337,17 @@ class CovidAgent(Agent):
         # In 60 days, this is equivalent to a probability of 1% unemployment filings.
         if self.agent_data.employed:
             if self.agent_data.isolated:
-                if bernoulli_rvs(32*0.00018/self.model.model_data.dwell_15_day):
-                    self.agent_data.employed = False
+                if self.model.streams.population.bernoulli(32*0.00018/self.model.model_data.dwell_15_day):
+                    self.set_data(employed=False)
             else:
-                if bernoulli_rvs(8*0.00018/self.model.model_data.dwell_15_day):
-                    self.agent_data.employed = False
+                if self.model.streams.population.bernoulli(8*0.00018/self.model.model_data.dwell_15_day):
+                    self.set_data(employed=False)
 
         # We also compute the probability of re-employment, which is at least ten times
         # as smaller in a crisis.
         if not(self.agent_data.employed):
-            if bernoulli_rvs(0.000018/self.model.model_data.dwell_15_day):
-                self.agent_data.employed = True
+            if self.model.streams.population.bernoulli(0.000018/self.model.model_data.dwell_15_day):
+                self.set_data(employed=True)
 
 
        # Social distancing
@@ -256,22 +373,19 @@ class CovidAgent(Agent):
         #Will process based on whether all older agents in an older group are vaccinated
         if (not(self.agent_data.vaccinated) or self.agent_data.dosage_eligible) and self.model.model_data.vaccination_now and (not(self.agent_data.fully_vaccinated) and (self.agent_data.vaccine_count < self.model.model_data.vaccine_dosage)):
             if self.should_be_vaccinated() and self.model.model_data.vaccine_count > 0 and self.agent_data.vaccine_willingness:
-                if not (bernoulli_rvs(0.1)):  # Chance that someone doesnt show up for the vaccine/ vaccine expires.
-                    self.agent_data.vaccinated = True
+                if not (self.model.streams.vaccination.bernoulli(0.1)):  # Chance that someone doesnt show up for the vaccine/ vaccine expires.
                     self.agent_data.vaccination_day = self.model.stepno
-                    self.agent_data.vaccine_count = self.agent_data.vaccine_count + 1
-                    self.agent_data.dosage_eligible = False
+                    self.set_data(vaccinated=True, vaccine_count=self.agent_data.vaccine_count + 1, dosage_eligible=False)
                     self.model.model_data.vaccine_count = self.model.model_data.vaccine_count - 1
-                    self.model.model_data.vaccinated_count = self.model.model.data.vaccinated_count + 1
+                    self.model.model_data.vaccinated_count = self.model.model_data.vaccinated_count + 1
 
-                else:
-                    other_agent = self.random.choice(self.model.schedule.agents)
-                    while not(other_agent.dosage_eligible and other_agent.vaccine_willingness):
-                        other_agent = self.random.choice(self.model.schedule.agents)
-                    other_agent.vaccinated = True
-                    other_agent.vaccination_day = self.model.stepno
-                    other_agent.vaccine_count = other_agent.vaccine_count +1
-                    other_agent.dosage_eligible = False
+                elif self.model.counters.count("dosage_eligible_willing") > 0:
+                    other_agent = self.model.streams.vaccination.choice(self.model.schedule.agents)
+                    while not(other_agent.agent_data.dosage_eligible and other_agent.agent_data.vaccine_willingness) or other_agent.is_passive():
+                        other_agent = self.model.streams.vaccination.choice(self.model.schedule.agents)
+                    other_agent.agent_data.vaccination_day = self.model.stepno
+                    other_agent.set_data(vaccinated=True, vaccine_count=other_agent.agent_data.vaccine_count + 1,
+                                         dosage_eligible=False)
                     self.model.model_data.vaccinated_count = self.model.model_data.vaccinated_count + 1
                     self.model.model_data.vaccine_count = self.model.model_data.vaccine_count - 1
 
@@ -281,18 +395,18 @@ class CovidAgent(Agent):
             if (self.astep >= self.model.model_data.isolation_start):
                 if (self.stage == Stage.SUSCEPTIBLE) or (self.stage == Stage.EXPOSED) or \
                     (self.stage == Stage.ASYMPTOMATIC):
-                    if bool(bernoulli_rvs(self.model.model_data.isolation_rate)):
-                        self.agent_data.isolated = True
+                    if self.model.streams.population.bernoulli(self.model.model_data.isolation_rate):
+                        self.set_data(isolated=True)
                     else:
-                        self.agent_data.isolated = False
+                        self.set_data(isolated=False)
                     self.agent_data.in_isolation = True
             elif (self.astep >= self.model.model_data.isolation_end):
                 if (self.stage == Stage.SUSCEPTIBLE) or (self.stage == Stage.EXPOSED) or \
                     (self.stage == Stage.ASYMPTOMATIC):
-                    if bool(bernoulli_rvs(self.model.model_data.after_isolation)):
-                        self.agent_data.isolated = True
+                    if self.model.streams.population.bernoulli(self.model.model_data.after_isolation):
+                        self.set_data(isolated=True)
                     else:
-                        self.agent_data.isolated = False
+                        self.set_data(isolated=False)
                     self.agent_data.in_isolation = True
 
                     
@@ -300,7 +414,7 @@ class CovidAgent(Agent):
         if self.agent_data.in_isolation and (self.astep >= self.model.model_data.isolation_end):
             if (self.stage == Stage.SUSCEPTIBLE) or (self.stage == Stage.EXPOSED) or \
                 (self.stage == Stage.ASYMPTOMATIC):
-                self.agent_data.isolated = False
+                self.set_data(isolated=False)
                 self.agent_data.in_isolation = False
 
 
@@ -310,22 +424,21 @@ class CovidAgent(Agent):
         #In this model I will assume that the vaccine is only half as effective once 2 weeks have passed given one dose.
         effective_date = self.model.model_data.dwell_15_day * 14
         if (vaccination_time < effective_date) and self.agent_data.vaccinated == True:
-            self.agent_data.safetymultiplier = 1 - (self.model.agent_data.effectiveness_per_dosage * (vaccination_time/effective_date)) - self.agent_data.current_effectiveness #Error the vaccination will go to 0 once it is done.
+            self.agent_data.safetymultiplier = 1 - (self.model.model_data.effectiveness_per_dosage * (vaccination_time/effective_date)) - self.agent_data.current_effectiveness #Error the vaccination will go to 0 once it is done.
         else:
             self.agent_data.current_effectiveness = self.model.model_data.effectiveness_per_dosage * self.agent_data.vaccine_count
             self.agent_data.safetymultiplier = 1 - self.agent_data.current_effectiveness * self.model.model_data.variant_data_list[self.agent_data.variant]["Vaccine_Multiplier"]
             if (self.agent_data.vaccine_count < self.model.model_data.vaccine_dosage):
-                self.agent_data.dosage_eligible = True  # Once this number is false, the person is eligible and is not fully vaccinated.
+                self.set_data(dosage_eligible=True)  # Once this number is false, the person is eligible and is not fully vaccinated.
             elif self.agent_data.fully_vaccinated == False:
-                self.agent_data.dosage_eligible = False
-                self.agent_data.fully_vaccinated = True
+                self.set_data(dosage_eligible=False, fully_vaccinated=True)
                 self.model.model_data.fully_vaccinated_count = self.model.model_data.fully_vaccinated_count + 1
 
 
         # Using the model, determine if a susceptible individual becomes infected due to
         # being elsewhere and returning to the community
         if self.stage == Stage.SUSCEPTIBLE:
-            #             if bernoulli_rvs(self.model.rate_inbound):
+            #             if self.model.streams.infection.bernoulli(self.model.rate_inbound):
             #                 self.stage = Stage.EXPOSED
             #                 self.model.generally_infected = self.model.generally_infected + 1
             #
@@ -338,8 +451,8 @@ class CovidAgent(Agent):
             # still susceptible.
             # We take care of testing probability at the top level step
             # routine to avoid this repeated computation
-            if not(self.agent_data.tested or self.agent_data.tested_traced) and bernoulli_rvs(self.agent_data.test_chance):
-                self.agent_data.tested = True
+            if not(self.agent_data.tested or self.agent_data.tested_traced) and self.model.streams.testing.bernoulli(self.agent_data.test_chance):
+                self.set_data(tested=True)
                 self.model.model_data.cumul_test_cost = self.model.model_data.cumul_test_cost + self.model.model_data.test_cost
             # First opportunity to get infected: contact with others
             # in near proximity
@@ -351,28 +464,16 @@ class CovidAgent(Agent):
 
             #Future implementaions would allow for multiple strains of the virus to stack on top of the same agent if exposed more than once but there is not much research showing what would really happen or what
             #values we would have to account for
-            variant = "Standard"
-            for c in cellmates:
-                    if c.is_contagious() and (c.stage == Stage.SYMPDETECTED or c.stage == Stage.SEVERE) and self.agent_data.variant_immune[c.agent_data.variant] == False:
-                        c.add_contact_trace(self)
-                        if self.agent_data.isolated and bernoulli_rvs(1 - self.model.model_data.prob_isolation_effective):
-                            self.agent_data.isolated_but_inefficient = True
-                            infected_contact = 1
-                            variant = c.agent_data.variant
-                            break
-                        else:
-                            infected_contact = 1
-                            variant = c.agent_data.variant
-                            break
-                    elif c.is_contagious() and (c.stage == Stage.ASYMPTOMATIC or c.stage == Stage.ASYMPDETECTED) and self.agent_data.variant_immune[c.agent_data.variant] == False:
-                        c.add_contact_trace(self)
-                        if self.agent_data.isolated and bernoulli_rvs(1 - self.model.model_data.prob_isolation_effective):
-                            self.agent_data.isolated_but_inefficient = True
-                            infected_contact = 2
-                            variant = c.agent_data.variant
-                        else:
-                            infected_contact = 2
-                            variant = c.agent_data.variant
+            not_immune = lambda v: self.agent_data.variant_immune[v] == False
+            infected_contact, variant = self.draw_contact(not_immune, not_immune)
+
+            if infected_contact > 0:
+                if self.model.model_data.tracing_now:
+                    for kind in (SYMPTOMATIC, ASYMPTOMATIC):
+                        for c in self.model.grid.contagion.occupants(self.pos, kind, not_immune):
+                            c.add_contact_trace(self)
+                if self.agent_data.isolated and self.model.streams.infection.bernoulli(1 - self.model.model_data.prob_isolation_effective):
+                    self.agent_data.isolated_but_inefficient = True
 
             # Value is computed before infected stage happens
             isolation_private_divider = 1
@@ -403,15 +504,15 @@ class CovidAgent(Agent):
 
             if infected_contact > 0:
                 if self.agent_data.isolated:
-                    if bernoulli_rvs(current_prob) and not(bernoulli_rvs(self.model.model_data.prob_isolation_effective)):
+                    if self.model.streams.infection.bernoulli(current_prob) and not(self.model.streams.infection.bernoulli(self.model.model_data.prob_isolation_effective)):
                         self.stage = Stage.EXPOSED
-                        self.agent_data.variant = variant
+                        self.set_data(variant=variant)
                         self.model.model_data.generally_infected = self.model.model_data.generally_infected + 1
                 else:
-                    if bernoulli_rvs(current_prob):
+                    if self.model.streams.infection.bernoulli(current_prob):
                         #Added vaccination account after being exposed to determine exposure.
                         self.stage = Stage.EXPOSED
-                        self.agent_data.variant = variant
+                        self.set_data(variant=variant)
                         self.model.model_data.generally_infected = self.model.model_data.generally_infected + 1
 
 
@@ -453,24 +554,15 @@ class CovidAgent(Agent):
 
 
             # If testing is available and the date is reached, test
-            if not(self.agent_data.tested or self.agent_data.tested_traced) and bernoulli_rvs(self.agent_data.test_chance):
-                if bernoulli_rvs(current_prob_asymptomatic):
+            if not(self.agent_data.tested or self.agent_data.tested_traced) and self.model.streams.testing.bernoulli(self.agent_data.test_chance):
+                if self.model.streams.infection.bernoulli(current_prob_asymptomatic):
                     self.stage = Stage.ASYMPDETECTED
                 else:
                     self.stage = Stage.SYMPDETECTED
                     do_move = False
                 
-                self.agent_data.tested = True
+                self.set_data(tested=True)
                 self.model.model_data.cumul_test_cost = self.model.model_data.cumul_test_cost + self.model.model_data.test_cost
-            else:
-                if self.agent_data.curr_incubation < self.agent_data.incubation_time:
-                    self.agent_data.curr_incubation = self.agent_data.curr_incubation + 1
-                else:
-                    if bernoulli_rvs(current_prob_asymptomatic):
-                        self.stage = Stage.ASYMPTOMATIC
-                    else:
-                        self.stage = Stage.SYMPDETECTED
-                        do_move = False
 
             # Now, attempt to move
             if do_move and not(self.agent_data.isolated):
@@ -498,17 +590,11 @@ class CovidAgent(Agent):
                     self.agent_data.cumul_private_value = self.agent_data.cumul_private_value + 0
                     self.agent_data.cumul_public_value = self.agent_data.cumul_public_value - 2*self.model.model_data.stage_value_dist[ValueGroup.PUBLIC][Stage.ASYMPTOMATIC]
 
-            if not(self.agent_data.tested or self.agent_data.tested_traced) and bernoulli_rvs(self.agent_data.test_chance):
+            if not(self.agent_data.tested or self.agent_data.tested_traced) and self.model.streams.testing.bernoulli(self.agent_data.test_chance):
                 self.stage = Stage.ASYMPDETECTED
-                self.agent_data.tested = True
+                self.set_data(tested=True)
                 self.model.model_data.cumul_test_cost = self.model.model_data.cumul_test_cost + self.model.model_data.test_cost
 
-            if self.agent_data.curr_recovery >= self.agent_data.recovery_time:
-                self.stage = Stage.RECOVERED
-                self.agent_data.variant_immune[self.agent_data.variant] = True
-            else:
-                self.agent_data.curr_recovery  += 1
-
             if not (self.agent_data.isolated):
                 self.move()
 
@@ -517,63 +603,33 @@ class CovidAgent(Agent):
             # Once a symptomatic patient has been detected, it does not move and starts
             # the road to severity, recovery or death. We assume that, by reaching a health
             # unit, they are tested as positive.
-            self.agent_data.isolated = True
-            self.agent_data.tested = True
+            self.set_data(isolated=True, tested=True)
 
             current_severe_chance = self.agent_data.mortality_value * self.model.model_data.variant_data_list[self.agent_data.variant]["Mortality_Multiplier"] * (1/(self.model.model_data.dwell_15_day))
             if (self.agent_data.vaccinated):
                 current_severe_chance = current_severe_chance * self.agent_data.safetymultiplier
 
 
-            # Contact tracing logic: use a negative number to indicate trace exhaustion
-            if self.model.model_data.tracing_now and self.agent_data.tracing_counter >= 0:
-                # Test only when the count down has been reached
-                if self.agent_data.tracing_counter == self.agent_data.tracing_delay:
-                    for t in self.agent_data.contacts:
-                        t.test_contact_trace()
+            # Contact tracing runs on the timer wheel (see schedule_tracing)
 
-                    self.agent_data.tracing_counter = -1
-                else:
-                    self.agent_data.tracing_counter = self.agent_data.tracing_counter + 1
-            
             self.agent_data.cumul_private_value = self.agent_data.cumul_private_value + \
                 self.model.model_data.stage_value_dist[ValueGroup.PRIVATE][Stage.SYMPDETECTED]
             self.agent_data.cumul_public_value = self.agent_data.cumul_public_value + \
                 self.model.model_data.stage_value_dist[ValueGroup.PUBLIC][Stage.SYMPDETECTED]
 
-            if self.agent_data.curr_incubation + self.agent_data.curr_recovery < self.agent_data.incubation_time + self.agent_data.recovery_time:
-                self.agent_data.curr_recovery = self.agent_data.curr_recovery + 1
-
-                if bernoulli_rvs(current_severe_chance):
-                    self.stage = Stage.SEVERE
-            else:
-                self.stage = Stage.RECOVERED
-                self.agent_data.variant_immune[self.agent_data.variant] = True
+            # Recovery is fired by the timer wheel once the countdown runs out
+            if self.model.streams.infection.bernoulli(current_severe_chance):
+                self.stage = Stage.SEVERE
         elif self.stage == Stage.ASYMPDETECTED:
-            self.agent_data.isolated = True
-
-            # Contact tracing logic: use a negative number to indicate trace exhaustion
-            if self.model.model_data.tracing_now and self.agent_data.tracing_counter >= 0:
-                # Test only when the count down has been reached
-                if self.agent_data.tracing_counter == self.agent_data.tracing_delay:
-                    for t in self.agent_data.contacts:
-                        t.test_contact_trace()
-
-                    self.agent_data.tracing_counter = -1
-                else:
-                    self.agent_data.tracing_counter = self.agent_data.tracing_counter + 1
+            self.set_data(isolated=True)
 
             self.agent_data.cumul_private_value = self.agent_data.cumul_private_value + \
                 self.model.model_data.stage_value_dist[ValueGroup.PRIVATE][Stage.ASYMPDETECTED]
             self.agent_data.cumul_public_value = self.agent_data.cumul_public_value + \
                 self.model.model_data.stage_value_dist[ValueGroup.PUBLIC][Stage.ASYMPDETECTED]
 
-            # The road of an asymptomatic patients is similar without the prospect of death
-            if self.agent_data.curr_incubation + self.agent_data.curr_recovery < self.agent_data.incubation_time + self.agent_data.recovery_time:
-               self.agent_data.curr_recovery = self.agent_data.curr_recovery + 1
-            else:
-                self.stage = Stage.RECOVERED
-                self.agent_data.variant_immune[self.agent_data.variant] = True
+            # The road of an asymptomatic patients is similar without the prospect of death;
+            # recovery is fired by the timer wheel
 
         elif self.stage == Stage.SEVERE:            
             self.agent_data.cumul_private_value = self.agent_data.cumul_private_value + \
@@ -581,27 +637,19 @@ class CovidAgent(Agent):
             self.agent_data.cumul_public_value = self.agent_data.cumul_public_value + \
                 self.model.model_data.stage_value_dist[ValueGroup.PUBLIC][Stage.SEVERE]
 
-            # Severe patients are in ICU facilities
-            if self.agent_data.curr_recovery < self.agent_data.recovery_time:
-                # Not recovered yet, may pass away depending on prob.
-                if self.model.model_data.bed_count > 0 and self.agent_data.occupying_bed == False:
-                    self.agent_data.occupying_bed = True
-                    self.model.model_data.bed_count -= 1
-                if self.agent_data.occupying_bed == False:
-                    if bernoulli(1/(self.agent_data.recovery_time)): #Chance that someone dies at this stage is current_time/time that they should recover. This ensures that they may die at a point during recovery.
-                        self.stage = Stage.DECEASED
-                # else:
-                #     if bernoulli(0 * 1/self.recovery_time): #Chance that someone dies on the bed is 42% less likely so I will also add that they have a 1/recovery_time chance of dying
-                #         self.stage = Stage.DECEASED
-                #         self.occupying_bed == False
-                #         self.model.bed_count += 1
-                self.agent_data.curr_recovery = self.agent_data.curr_recovery + 1
-            else:
-                self.stage = Stage.RECOVERED
-                self.agent_data.variant_immune[self.variant] = True
-                if (self.agent_data.occupying_bed == True):
-                    self.agent_data.occupying_bed == False
-                    self.model.model_data.bed_count += 1
+            # Severe patients are in ICU facilities. Not recovered yet (recovery is fired by
+            # the timer wheel), may pass away depending on prob.
+            if self.model.model_data.bed_count > 0 and self.agent_data.occupying_bed == False:
+                self.agent_data.occupying_bed = True
+                self.model.model_data.bed_count -= 1
+            if self.agent_data.occupying_bed == False:
+                if self.model.streams.infection.bernoulli(1/(self.agent_data.recovery_time)): #Chance that someone dies at this stage is current_time/time that they should recover. This ensures that they may die at a point during recovery.
+                    self.stage = Stage.DECEASED
+            # else:
+            #     if bernoulli(0 * 1/self.recovery_time): #Chance that someone dies on the bed is 42% less likely so I will also add that they have a 1/recovery_time chance of dying
+            #         self.stage = Stage.DECEASED
+            #         self.occupying_bed == False
+            #         self.model.bed_count += 1
 
 
 
@@ -627,31 +675,17 @@ class CovidAgent(Agent):
 
             # A recovered agent can now move freely within the grid again
             self.agent_data.curr_recovery = 0
-            self.agent_data.isolated = False
+            self.set_data(isolated=False)
             self.agent_data.isolated_but_inefficient = False
 
-            infected_contact = 0
-            variant = "Standard"
-            for c in cellmates:
-                if c.is_contagious() and self.model.model_data.variant_data_list[c.variant]["Reinfection"] == True and (c.stage == Stage.SYMPDETECTED or c.stage == Stage.SEVERE) and self.agent_data.variant_immune[c.variant] != True:
-                    if self.agent_data.isolated and bernoulli_rvs(1 - self.model.model_data.prob_isolation_effective):
-                        self.agent_data.isolated_but_inefficient = True
-                        infected_contact = 1
-                        variant = c.variant
-                        break
-                    else:
-                        infected_contact = 1
-                        variant = c.variant
-                        break
-                elif c.is_contagious() and (c.stage == Stage.ASYMPTOMATIC or c.stage == Stage.ASYMPDETECTED) and self.agent_data.variant_immune[c.variant] == False:
+            # Symptomatic contacts only reinfect with variants that allow reinfection
+            reinfects = lambda v: self.model.model_data.variant_data_list[v]["Reinfection"] == True and self.agent_data.variant_immune[v] != True
+            not_immune = lambda v: self.agent_data.variant_immune[v] == False
+            infected_contact, variant = self.draw_contact(reinfects, not_immune)
+
+            if infected_contact == 2 and self.model.model_data.tracing_now:
+                for c in self.model.grid.contagion.occupants(self.pos, ASYMPTOMATIC, not_immune):
                     c.add_contact_trace(self)
-                    if self.agent_data.isolated and bernoulli_rvs(1 - self.model.model_data.prob_isolation_effective):
-                        self.agent_data.isolated_but_inefficient = True
-                        infected_contact = 2
-                        variant = c.variant
-                    else:
-                        infected_contact = 2
-                        variant = c.variant
 
             current_prob = self.agent_data.prob_contagion * self.model.model_data.variant_data_list[variant]["Contagtion_Multiplier"]
             if self.agent_data.vaccinated:
@@ -662,14 +696,14 @@ class CovidAgent(Agent):
 
             if infected_contact > 0:
                 if self.agent_data.isolated:
-                    if bernoulli_rvs(current_prob) and not (bernoulli_rvs(self.model.model_data.prob_isolation_effective)):
+                    if self.model.streams.infection.bernoulli(current_prob) and not (self.model.streams.infection.bernoulli(self.model.model_data.prob_isolation_effective)):
                         self.stage = Stage.EXPOSED
-                        self.agent_data.variant = variant
+                        self.set_data(variant=variant)
                 else:
-                    if bernoulli_rvs(current_prob):
+                    if self.model.streams.infection.bernoulli(current_prob):
                         # Added vaccination account after being exposed to determine exposure.
                         self.stage = Stage.EXPOSED
-                        self.agent_data.variant = variant
+                        self.set_data(variant=variant)
 
 
             self.move()
@@ -683,9 +717,21 @@ class CovidAgent(Agent):
             sys.exit("Unknown stage: aborting.")
 
 
-        #Insert a new trace into the database (AgentDataClass)
+        #Insert a new trace into the database (AgentDataClass); the database buffers the
+        #traces and writes them out in bulk
+        self.model.db.insert_agent([self.trace_row()], [self.trace_key()])
+
+        self.astep = self.astep + 1
+
+    def trace_key(self):
+        # Experiment, iteration, step and agent of the current trace row
+        return (self.model.run_id, self.model.iteration, self.model.stepno, self.unique_id)
+
+    def trace_row(self):
+        # Current state of the agent as a row of the agent trace table
+        self.sync_countdowns()
         id = str(uuid.uuid4())
-        agent_params = [(
+        return (
             id, 
             self.agent_data.age_group.value,
             self.agent_data.sex_group.value, 
@@ -723,17 +769,13 @@ class CovidAgent(Agent):
             self.agent_data.dosage_eligible,
             self.agent_data.fully_vaccinated,
             self.agent_data.variant
-        )]
-
-        self.model.db.insert_agent(agent_params)
-        self.model.db.commit()
-
-        self.astep = self.astep + 1
+        )
 
     def move(self):
-        # If dwelling has not been exhausted, do not move
-        if self.agent_data.curr_dwelling > 0:
-            self.agent_data.curr_dwelling = self.agent_data.curr_dwelling - 1
+        # If dwelling has not been exhausted, do not move. The dwell is kept as the
+        # step at which it runs out (curr_dwelling is derived in sync_countdowns).
+        if self.model.stepno < self.move_due:
+            return
 
         # If dwelling has been exhausted, move and replenish the dwell
         else:
@@ -742,94 +784,98 @@ class CovidAgent(Agent):
                 moore=True,
                 include_center=False
             )
-            new_position = self.random.choice(possible_steps)
+            new_position = self.model.streams.movement.choice(possible_steps)
 
             self.model.grid.move_agent(self, new_position)
-            self.agent_data.curr_dwelling = poisson_rvs(self.model.model_data.avg_dwell)
+            self.move_due = self.model.stepno + self.model.streams.movement.poisson(self.model.model_data.avg_dwell) + 1
+
+
+def step_passive(agents):
+    # Bulk step of the passive (deceased) agents: they accrue the constant value of
+    # their stage and record their trace, with a single insert for all.
+    model = agents[0].model
+    rows = []
+    keys = []
+    for agent in agents:
+        stage = agent.stage
+        agent.agent_data.cumul_private_value = agent.agent_data.cumul_private_value + \
+            model.model_data.stage_value_dist[ValueGroup.PRIVATE][stage]
+        agent.agent_data.cumul_public_value = agent.agent_data.cumul_public_value + \
+            model.model_data.stage_value_dist[ValueGroup.PUBLIC][stage]
+        rows.append(agent.trace_row())
+        keys.append(agent.trace_key())
+        agent.astep = agent.astep + 1
+
+    model.db.insert_agent(rows, keys)
 
 
 ########################################
 
+# Counting reporters read the population counters maintained by the agents
+# (see CovidAgent.counter_keys) instead of scanning the schedule.
+
 def compute_variant_stage(model, variant, stage):
-    count = 0
-    for agent in model.schedule.agents:
-        if stage == Stage.SUSCEPTIBLE:
-            if agent.agent_data.variant == variant:
-                count += 1
-        else:
-            if agent.stage == stage and agent.agent_data.variant == variant:
-                count += 1
-    return count
+    if stage == Stage.SUSCEPTIBLE:
+        return model.counters.count("variant", variant)
+    return model.counters.count("stage_variant", stage, variant)
 
 def compute_vaccinated_stage(model, stage):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.stage == stage and agent.agent_data.vaccinated == True:
-            count += count
-    vaccinated_count = compute_vaccinated_count(model)
-    if vaccinated_count == 0:
-        return 0
-    else:
-        return count
+    return model.counters.count("vaccinated_stage", stage)
 
 def compute_stage(model,stage):
     return count_type(model,stage)
 
 def count_type(model, stage):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.stage == stage:
-            count = count + 1
-
-    return count
+    return model.counters.count("stage", stage)
 
 def compute_isolated(model):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.isolated:
-            count = count + 1
-    return count
+    return model.counters.count("isolated")
 
 def compute_employed(model):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.employed:
-            count = count + 1
-
-    return count
+    return model.counters.count("employed")
 
 def compute_unemployed(model):
-    count = 0
+    return model.schedule.get_agent_count() - model.counters.count("employed")
 
-    for agent in model.schedule.agents:
-        if not(agent.agent_data.employed):
-            count = count + 1
+# Reporters aggregating agent fields declare their aggregates, so that the
+# DataCollector computes all of them in one pass (see fused_reporters.py).
+# They are still called like the other reporters, e.g. compute_contacts(model).
 
-    return count
+# Stages in which an agent meets the other occupants of its cell
+MEETING_STAGES = [stage for stage in Stage if stage not in (Stage.DECEASED, Stage.RECOVERED)]
 
-def compute_contacts(model):
-    count = 0
-    for agent in model.schedule.agents:
-        count = count + agent.interactants()
-    return count
+CONTACT_AGGREGATES = {
+    "occupants": Aggregate("count", by="pos"),
+    "free": Aggregate("count", where={"isolated": [False]}, by="pos"),
+    "inefficient": Aggregate("count", where={"stage": MEETING_STAGES, "isolated_but_inefficient": [True]}, by="pos"),
+    "efficient": Aggregate("count", where={"stage": MEETING_STAGES, "isolated_but_inefficient": [False]}, by="pos"),
+    "efficient_free": Aggregate("count", where={"stage": MEETING_STAGES, "isolated_but_inefficient": [False],
+                                                "isolated": [False]}, by="pos"),
+}
+
+def contacts(model, values):
+    # CovidAgent.interactants summed over all agents, cell by cell: an agent isolating inefficiently
+    # meets all the other occupants, any other agent those that do not isolate
+    return int(np.sum(values["inefficient"] * (values["occupants"] - 1)
+                      + values["efficient"] * values["free"] - values["efficient_free"]))
+
+compute_contacts = FusedReporter(CONTACT_AGGREGATES, contacts)
 
 def compute_stepno(model):
     return model.stepno
 
-def compute_cumul_private_value(model):
-    value = 0
-    for agent in model.schedule.agents:
-        value = value + agent.agent_data.cumul_private_value
+def cumul_private_value(model, values):
+    value = values["value"]
     return np.sign(value)*np.power(np.abs(value), model.model_data.alpha_private)/model.num_agents
 
-def compute_cumul_public_value(model):
-    value = 0
-
-    for agent in model.schedule.agents:
-        value = value + agent.agent_data.cumul_public_value
+compute_cumul_private_value = FusedReporter({"value": Aggregate("sum", "cumul_private_value")}, cumul_private_value)
 
+def cumul_public_value(model, values):
+    value = values["value"]
     return np.sign(value)*np.power(np.abs(value), model.model_data.alpha_public)/model.num_agents
 
+compute_cumul_public_value = FusedReporter({"value": Aggregate("sum", "cumul_public_value")}, cumul_public_value)
+
 
 #  Changed the method for calculating the test cost. This will occur in more linear time,
 #  can also differentiate being tested from being percieved as infected. This will be a rising value,
@@ -845,85 +891,42 @@ def compute_total_cost(model):
     return model.model_data.cumul_test_cost + model.model_data.cumul_vaccine_cost
 
 def compute_tested(model):
-    tested = 0
-
-    for agent in model.schedule.agents:
-        if agent.agent_data.tested:
-            tested = tested + 1
-
-    return tested
+    return model.counters.count("tested")
 
 # Added to track the number of vaccinated agents.
 def compute_vaccinated(model):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.vaccinated:
-            vaccinated_count = vaccinated_count + 1
-
-    return vaccinated_count
+    return model.counters.count("vaccinated")
 
 
 def compute_vaccinated_count(model):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.vaccinated:
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("vaccinated")
 
 def compute_vaccinated_1(model):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.vaccine_count == 1:
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("vaccine_count", 1)
 
 def compute_vaccinated_2(model):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.vaccine_count == 2:
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("vaccine_count", 2)
 
 def compute_willing_agents(model):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.vaccine_willingness:
-            count = count + 1
-    return count
+    return model.counters.count("willing")
 
 
 # Another helper function to determine the vaccination of agents based on agegroup.
 def compute_vaccinated_in_group_count(model,agegroup):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if (agent.agent_data.vaccinated) and (agent.agent_data.age_group == agegroup):
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("vaccinated_age", agegroup)
 
 
 
 def compute_vaccinated_in_group(model,agegroup):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if (agent.agent_data.vaccinated) and (agent.agent_data.age_group == agegroup):
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("vaccinated_age", agegroup)
 
 
 def compute_fully_vaccinated_in_group(model,agegroup):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if (agent.agent_data.fully_vaccinated) and (agent.agent_data.age_group == agegroup):
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("fully_vaccinated_age", agegroup)
 
 
 def compute_vaccinated_in_group_percent_vaccine_count(model, agegroup, count):
-    vaccinated_count = 0
-    for agent in model.schedule.agents:
-        if (agent.agent_data.vaccine_count == count) and (agent.agent_data.age_group == agegroup):
-            vaccinated_count = vaccinated_count + 1
-    return vaccinated_count
+    return model.counters.count("age_vaccine_count", agegroup, count)
 
 
 def cumul_effectiveness_per_group_vaccinated(model,agegroup):
@@ -950,126 +953,89 @@ def cumul_effectiveness_per_group(model,agegroup):
     else:
         return 0
 
+# The effectiveness reporters of all age groups share these aggregates, so
+# all of them are computed in one pass
+EFFECTIVENESS_AGGREGATES = {
+    "agents": Aggregate("count", by="age_group", groups=len(AgeGroup)),
+    "safety": Aggregate("sum", "safetymultiplier", by="age_group", groups=len(AgeGroup)),
+}
+
+VACCINATED_EFFECTIVENESS_AGGREGATES = {
+    "agents": Aggregate("count", where={"vaccinated": [True]}, by="age_group", groups=len(AgeGroup)),
+    "safety": Aggregate("sum", "safetymultiplier", where={"vaccinated": [True]}, by="age_group", groups=len(AgeGroup)),
+}
+
+def cumul_effectiveness(model, values, agegroup):
+    # 1 - the mean safety multiplier of the agents of the age group
+    agent_count = int(values["agents"][agegroup.value])
+    if (agent_count > 0):
+        return 1-(float(values["safety"][agegroup.value]) / agent_count)
+    else:
+        return 0
+
+def fused_cumul_effectiveness_per_group_vaccinated(agegroup):
+    return FusedReporter(VACCINATED_EFFECTIVENESS_AGGREGATES, partial(cumul_effectiveness, agegroup=agegroup))
+
+def fused_cumul_effectiveness_per_group(agegroup):
+    return FusedReporter(EFFECTIVENESS_AGGREGATES, partial(cumul_effectiveness, agegroup=agegroup))
+
 def compute_age_group_count(model,agegroup):
-    count = 0
-    for agent in model.schedule.agents:
-        if agent.agent_data.age_group == agegroup:
-            count = count + 1
-    return count
+    return model.counters.count("age", agegroup)
 
 def compute_eligible_age_group_count(model,agegroup):
-    count = 0
-    for agent in model.schedule.agents:
-        if (agent.agent_data.age_group == agegroup) and (agent.agent_data.stage == Stage.SUSCEPTIBLE or agent.agent_data.stage == Stage.EXPOSED or agent.agent_data.stage == Stage.ASYMPTOMATIC) and agent.agent_data.dosage_eligible and agent.agent_data.vaccine_willingness:
-            count = count + 1
-    return count
+    return model.counters.count("eligible_age", agegroup)
 
 
 def update_vaccination_stage(model):
-    initial_stage = model.model_data.vaccination_stage
-    # if compute_eligible_age_group_count(model, AgeGroup.C80toXX) < 1:
-    #     model.model_data.vaccination_stage = VaccinationStage.C70to79
-    #     if compute_eligible_age_group_count(model, AgeGroup.C70to79) < 1:
-    #         model.model_data.vaccination_stage = VaccinationStage.C60to69
-    #         if compute_eligible_age_group_count(model, AgeGroup.C60to69) < 1:
-    #             model.model_data.vaccination_stage = VaccinationStage.C50to59
-    #             if compute_eligible_age_group_count(model, AgeGroup.C50to59) < 1:
-    #                 model.model_data.vaccination_stage = VaccinationStage.C40to49
-    #                 if compute_eligible_age_group_count(model, AgeGroup.C40to49) < 1:
-    #                     model.model_data.vaccination_stage = VaccinationStage.C30to39
-    #                     if compute_eligible_age_group_count(model, AgeGroup.C30to39) < 1:
-    #                         model.model_data.vaccination_stage = VaccinationStage.C20to29
-    #                         if compute_eligible_age_group_count(model, AgeGroup.C20to29) < 1:
-    #                             model.model_data.vaccination_stage = VaccinationStage.C10to19
-    #                             if compute_eligible_age_group_count(model, AgeGroup.C10to19) < 1:
-    #                                 model.model_data.vaccination_stage = VaccinationStage.C00to09
-    # else:
-    #     model.model_data.vaccination_stage = VaccinationStage.C80toXX
-
-    eligible_age_group_dict = {}
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C80toXX)] = VaccinationStage.C70to79
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C70to79)] = VaccinationStage.C60to69
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C60to69)] = VaccinationStage.C50to59
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C50to59)] = VaccinationStage.C40to49
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C40to49)] = VaccinationStage.C30to39
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C30to39)] = VaccinationStage.C20to29
-    eligible_age_group_dict[compute_eligible_age_group_count(model, AgeGroup.C10to19)] = VaccinationStage.C00to09
-
-    model.model_data.vaccination_stage = VaccinationStage.C80toXX
-    for key,value in sorted(eligible_age_group_dict.items(), reverse=True):
-        if (key < 1):
-            model.model_data.vaccination_stage = value
-
-    if initial_stage != model.model_data.vaccination_stage:
-        print(f"Vaccination stage is now {model.model_data.vaccination_stage}")
+    # The scheduler only re-evaluates the stage when an eligible count has changed
+    model.vaccination.update()
 
 
 def compute_willing_group_count(model, agegroup):
-    count = 0
-    for agent in model.schedule.agents:
-        if(agent.agent_data.vaccine_willingness):
-            count += 1
-    return count
+    return model.counters.count("willing")
 
 def compute_traced(model):
-    tested = 0
+    return model.counters.count("traced")
 
-    for agent in model.schedule.agents:
-        if agent.agent_data.tested_traced:
-            tested = tested + 1
-
-    return tested
 
+# Resource use reporters read the latest sample of the background sampler
+# (see resource_sampler.py), and report 0 until the first one is taken
 
 def compute_total_processor_usage(model):
-    if model.stepno % model.model_data.dwell_15_day == 0:
-        processes = psu.cpu_percent(1, True)
-        process_count = 0
-        for idx, process in enumerate(processes):
-            if (process > 0.0):
-                process_count = process_count + 1
-        return process_count
-    else:
+    sample = resource_sampler().latest()
+    if sample is None:
         return 0
+    process_count = 0
+    for process in sample.cpu:
+        if (process > 0.0):
+            process_count = process_count + 1
+    return process_count
 
 def compute_processor_usage(model, processoridx):
-    if model.stepno % model.model_data.dwell_15_day == 0:
-        processes = psu.cpu_percent(1, True)
-        for idx, process in enumerate(processes):
-            if (idx == processoridx):
-                return process
-        return "Out of range"
-    else:
+    sample = resource_sampler().latest()
+    if sample is None:
         return 0
+    if processoridx < len(sample.cpu):
+        return sample.cpu[processoridx]
+    return "Out of range"
 
-def compute_eff_reprod_number(model):
-    prob_contagion = 0.0
-    
-    # Adding logic to better compute R(t)
-    exposed = 0.0
-    asymptomatics = 0.0
-    symptomatics = 0.0
-    
-    exp_time = 0.0
-    asympt_time = 0.0
-    sympt_time = 0.0
+def compute_memory_usage(model):
+    sample = resource_sampler().latest()
+    return 0 if sample is None else sample.rss
 
-    for agent in model.schedule.agents:
-        if agent.stage == Stage.EXPOSED:
-            exposed = exposed + 1
-            exp_time = exp_time + agent.agent_data.incubation_time
-            prob_contagion = agent.agent_data.prob_contagion
-        elif agent.stage == Stage.SYMPDETECTED:
-            # NOTE: this part needs to be adapted to model hospital transmission in further detail
-            symptomatics = symptomatics + 1
-            sympt_time = sympt_time + agent.agent_data.incubation_time
-            prob_contagion = agent.agent_data.prob_contagion
-        elif agent.stage == Stage.ASYMPTOMATIC:
-            asymptomatics = asymptomatics + 1
-            asympt_time = asympt_time + agent.agent_data.incubation_time + agent.agent_data.recovery_time
-            prob_contagion = agent.agent_data.prob_contagion
-        else:
-            continue
+def compute_read_bytes(model):
+    sample = resource_sampler().latest()
+    return 0 if sample is None else sample.read_bytes
+
+def compute_write_bytes(model):
+    sample = resource_sampler().latest()
+    return 0 if sample is None else sample.write_bytes
+
+def eff_reprod_number(model, values):
+    # Adding logic to better compute R(t)
+    exposed = values["exposed"]
+    symptomatics = values["symptomatics"]
+    asymptomatics = values["asymptomatics"]
 
     total = exposed + symptomatics + asymptomatics
 
@@ -1077,21 +1043,38 @@ def compute_eff_reprod_number(model):
     times = []
 
     if exposed != 0:
-        times.append(exp_time/exposed)
+        times.append(values["exp_time"]/exposed)
 
     if symptomatics != 0:
-        times.append(sympt_time/symptomatics)
+        times.append(values["sympt_time"]/symptomatics)
 
     if asymptomatics != 0 and symptomatics != 0:
-        times.append(asympt_time/symptomatics)
+        times.append((values["asympt_incubation"] + values["asympt_recovery"])/symptomatics)
 
     if total != 0:
         infectious_period = np.mean(times)
     else:
         infectious_period = 0
 
-    avg_contacts = compute_contacts(model)
-    return model.model_data.kmob * model.model_data.repscaling * prob_contagion * avg_contacts * infectious_period
+    avg_contacts = contacts(model, values)
+    return model.model_data.kmob * model.model_data.repscaling * values["prob_contagion"] * avg_contacts * infectious_period
+
+# NOTE: the symptomatic part needs to be adapted to model hospital transmission in further detail
+RT_AGGREGATES = {
+    "exposed": Aggregate("count", where={"stage": [Stage.EXPOSED]}),
+    "exp_time": Aggregate("sum", "incubation_time", where={"stage": [Stage.EXPOSED]}),
+    "symptomatics": Aggregate("count", where={"stage": [Stage.SYMPDETECTED]}),
+    "sympt_time": Aggregate("sum", "incubation_time", where={"stage": [Stage.SYMPDETECTED]}),
+    "asymptomatics": Aggregate("count", where={"stage": [Stage.ASYMPTOMATIC]}),
+    "asympt_incubation": Aggregate("sum", "incubation_time", where={"stage": [Stage.ASYMPTOMATIC]}),
+    "asympt_recovery": Aggregate("sum", "recovery_time", where={"stage": [Stage.ASYMPTOMATIC]}),
+    # of the last infected agent in the schedule
+    "prob_contagion": Aggregate("last", "prob_contagion", default=0.0,
+                                where={"stage": [Stage.EXPOSED, Stage.SYMPDETECTED, Stage.ASYMPTOMATIC]}),
+}
+RT_AGGREGATES.update(CONTACT_AGGREGATES)
+
+compute_eff_reprod_number = FusedReporter(RT_AGGREGATES, eff_reprod_number)
 
 def compute_num_agents(model):
     return model.num_agents
@@ -1112,6 +1095,12 @@ def compute_fully_vaccinated_count(model):
     return model.model_data.fully_vaccinated_count
 
 
+# Model reporters making up a row of the summary table, in the order of its columns
+SUMMARY_REPORTERS = ["CumulPrivValue", "CumulPublValue", "CumulTestCost", "Rt", "Employed", "Unemployed",
+                     "Tested", "Traced", "Cumul_Vaccine_Cost", "Cumul_Cost", "Step", "N", "Isolated",
+                     "Vaccinated", "Vaccines", "V", "Data_Time", "Step_Time", "Generally_Infected",
+                     "Fully_Vaccinated", "Vaccine_1", "Vaccine_2", "Vaccine_Willing"]
+
 
 
 class CovidModel(Model):
@@ -1125,13 +1114,22 @@ class CovidModel(Model):
                  day_tracing_start, days_tracing_lasts, stage_value_matrix, test_cost, alpha_private, alpha_public, proportion_beds_pop, day_vaccination_begin,
                  day_vaccination_end, effective_period, effectiveness, distribution_rate, cost_per_vaccine, vaccination_percent, variant_data, 
                  # policy_data,
-                 db, dummy=0):
+                 db, population_engine=False, seed=None, iteration=0, collection=None, dummy=0):
 
         print("Made it to the model")
         self.running = True
+        # Position of the run in its ensemble
+        self.iteration = iteration
+        # All draws come from per-concern streams derived from a single seed; Mesa's
+        # own generator (activation order) is reseeded from it so the run is reproducible
+        self.streams = RandomStreams(seed)
+        self.reset_randomizer(self.streams.seed)
+        self.counters = PopulationCounters()
+        # Stage countdowns of the agents fire from here
+        self.timers = TimerWheel()
         self.num_agents = num_agents
-        self.grid = MultiGrid(width, height, True)
-        self.schedule = RandomActivation(self)
+        self.grid = ContagionGrid(width, height, True)
+        self.schedule = ActiveSetActivation(self, CovidAgent.is_passive, step_passive)
         self.stepno = 0
         self.datacollection_time = 0
         self.step_time = 0
@@ -1216,6 +1214,10 @@ class CovidModel(Model):
             bed_count=max_bed_available
         )
 
+        # Age groups are vaccinated from the oldest to the youngest
+        vaccination_order = [(AgeGroup(stage.value), stage) for stage in sorted(VaccinationStage, key=lambda s: s.value, reverse=True)]
+        self.vaccination = VaccinationScheduler(self.model_data, self.counters, vaccination_order)
+
         self.pol_handler = PolicyHandler(dwell_15_day)
 
         #Read
@@ -1229,68 +1231,9 @@ class CovidModel(Model):
 
         # insert a model into the database
         myid = str(uuid.uuid4())
-        model_params = [(
-            myid,
-            self.model_data.test_cost,
-            self.model_data.alpha_private,
-            self.model_data.alpha_public,
-            self.model_data.fully_vaccinated_count,
-            self.model_data.prop_initial_infected,
-            self.model_data.generally_infected,
-            self.model_data.cumul_vaccine_cost,
-            self.model_data.cumul_test_cost,
-            self.model_data.total_costs,
-            self.model_data.vaccination_chance, #
-            self.model_data.vaccination_stage.value,
-            self.model_data.vaccine_cost, #
-            self.model_data.day_vaccination_begin, 
-            self.model_data.day_vaccination_end,
-            self.model_data.effective_period,
-            self.model_data.effectiveness,
-            self.model_data.distribution_rate,
-            self.model_data.vaccine_count, #
-            self.model_data.vaccinated_count, #
-            self.model_data.vaccinated_percent, #
-            self.model_data.vaccine_dosage,
-            self.model_data.effectiveness_per_dosage,
-            self.model_data.dwell_15_day,
-            self.model_data.avg_dwell,
-            self.model_data.avg_incubation,
-            self.model_data.repscaling,
-            self.model_data.prob_contagion_base,
-            self.model_data.kmob,
-            self.model_data.rate_inbound,
-            self.model_data.prob_contagion_places,
-            self.model_data.prob_asymptomatic,
-            self.model_data.avg_recovery,
-            self.model_data.testing_rate, #
-            self.model_data.testing_start,
-            self.model_data.testing_end,
-            self.model_data.tracing_start,
-            self.model_data.tracing_end,
-            self.model_data.tracing_now,
-            self.model_data.isolation_rate, #
-            self.model_data.isolation_start,
-            self.model_data.isolation_end,
-            self.model_data.after_isolation,
-            self.model_data.prob_isolation_effective, #
-            self.model_data.distancing, #
-            self.model_data.distancing_start,
-            self.model_data.distancing_end,
-            self.model_data.new_agent_num,
-            self.model_data.new_agent_start,
-            self.model_data.new_agent_end,
-            self.model_data.new_agent_age_mean,
-            self.model_data.new_agent_prop_infected,
-            self.model_data.vaccination_start,
-            self.model_data.vaccination_end,
-            self.model_data.vaccination_now,
-            self.model_data.prob_severe,
-            self.model_data.max_bed_available,
-            self.model_data.bed_count
-        )]
-
-        self.db.insert_model(model_params)
+        # The experiment uuid identifies the run in the agent traces
+        self.run_id = myid
+        self.db.insert_model(self.experiment_row())
         self.db.commit()
 
         for variant in variant_data:
@@ -1323,16 +1266,18 @@ class CovidModel(Model):
         # for all cells.
         # Alternatively, shutting restaurants corresponds to 15% of interactions in an active day, and bars to a 7%
         # of those interactions
-        self.variant_start_times = {}
-        self.variant_start = {}
+        # Shared with model_data, where CovidModel.step looks the variant introductions up
+        self.variant_start_times = self.model_data.variant_start_times
+        self.variant_start = self.model_data.variant_start
 
         # A dictionary to count the dwell time of an agent at a location; 
         # key is (agent, x, y) and value is count of dwell time
         self.dwell_time_at_locations = {}
-        positions = [(x, y) for x, y in zip(range(self.grid.width), range(self.grid.height))]
-        
-        for i,j in positions:
-            self.dwell_time_at_locations[(x, y)] = poisson_rvs(self.model.model_data.avg_dwell)
+        positions = [(x, y) for x in range(self.grid.width) for y in range(self.grid.height)]
+        dwells = self.streams.movement.poissons(self.model_data.avg_dwell, len(positions)).tolist()
+
+        for (i,j), dwell in zip(positions, dwells):
+            self.dwell_time_at_locations[(i, j)] = dwell
 
         for key in self.model_data.variant_data_list:
             self.variant_start_times[key] = self.model_data.variant_data_list[key]["Appearance"] * self.model_data.dwell_15_day
@@ -1344,34 +1289,34 @@ class CovidModel(Model):
 
         # Now, a neat python trick: generate the spacing of entries and then build a map
         times_list = list(np.linspace(self.model_data.new_agent_start, self.model_data.new_agent_end, self.model_data.new_agent_num, dtype=int))
-        self.new_agent_time_map = {x:times_list.count(x) for x in times_list}
+        self.new_agent_time_map = dict(Counter(times_list))
 
         # We store a simulation specification in the database
         # Commit
         #print(self.model_data.vaccination_stage.value)
 
-        # Create agents
+        # Optionally keep the population in NumPy columns and step it in bulk
+        # instead of one CovidAgent per person (see population.py)
+        self.population = None
+        if population_engine:
+            self.population = PopulationEngine(self)
+            self.schedule = PopulationSchedule(self, self.population)
+            self.counters.source = self.population
+
+        # Create agents, drawing their attributes in bulk
         self.i = 0
+        self.factory = PopulationFactory(self)
+        ages, sexes = self.factory.initial_groups(self.num_agents)
+        self.create_agents(ages, sexes, np.full(len(ages), Stage.SUSCEPTIBLE.value))
 
-        for ag in self.model_data.age_distribution:
-            for sg in self.model_data.sex_distribution:
-                r = self.model_data.age_distribution[ag]*self.model_data.sex_distribution[sg]
-                num_agents = int(round(self.num_agents*r))
-                mort = self.model_data.age_mortality[ag]*self.model_data.sex_mortality[sg]
-                for k in range(num_agents):
-                    a = CovidAgent(self.i, ag, sg, mort, self)
-                    self.schedule.add(a)
-                    x = self.random.randrange(self.grid.width)
-                    y = self.random.randrange(self.grid.height)
-                    self.grid.place_agent(a, (x,y))
-                    self.i = self.i + 1
-
-        processes = psu.cpu_percent(1, True)
         processes_dict = {}
-        for idx, process in enumerate(processes):
+        for idx in range(psu.cpu_count()):
             processor_name = "Processor " + str(idx)
             processes_dict[processor_name] = [compute_processor_usage, [self, idx]]
         processes_dict["Total_Processore_Use"] = compute_total_processor_usage
+        processes_dict["Memory_RSS"] = compute_memory_usage
+        processes_dict["IO_Read_Bytes"] = compute_read_bytes
+        processes_dict["IO_Write_Bytes"] = compute_write_bytes
 
 
         age_vaccination_dict = {}
@@ -1380,7 +1325,7 @@ class CovidModel(Model):
             age_group_name = "Vaccinated " + str(age.name)
             age_vaccination_dict[age_group_name] = [compute_vaccinated_in_group, [self, age]]
             age_group_name = "Cumulative_Effectiveness " + str(age.name)
-            age_vaccination_dict[age_group_name] = [cumul_effectiveness_per_group, [self, age]]
+            age_vaccination_dict[age_group_name] = fused_cumul_effectiveness_per_group(age)
 
         for age in AgeGroup:
             age_group_name = "Fully_Vaccinated " + str(age.name)
@@ -1451,7 +1396,16 @@ class CovidModel(Model):
         model_reporters_dict.update(prices_dict)
 
 
-        self.datacollector = DataCollector(model_reporters = model_reporters_dict)
+        # Collection cadence from the output block of the scenario, e.g. {"every": "day", "aggregate": "mean"},
+        # with "resources": true adding the resource use reporters
+        collection = collection or {}
+        if collection.get("resources"):
+            model_reporters_dict.update(processes_dict)
+        every = collection.get("every", 1)
+        if every == "day":
+            every = self.model_data.dwell_15_day
+        self.datacollector = DataCollector(model_reporters = model_reporters_dict, every=every,
+                                           aggregate=collection.get("aggregate"), last=["Step"])
 
         # Final step: infect an initial proportion of random agents
         num_init = int(self.num_agents * prop_initial_infected)
@@ -1514,7 +1468,7 @@ class CovidModel(Model):
             vaccine_willing
         )]
 
-        self.db.insert_summary(summary_params)
+        self.db.insert_summary(summary_params, [self.summary_key()])
         self.db.commit()
 
 
@@ -1526,10 +1480,113 @@ class CovidModel(Model):
                 self.model_data.generally_infected = self.model_data.generally_infected + 1
                 num_init = num_init - 1
 
+    def create_agents(self, ages, sexes, stages, variant=None):
+        """ Create and place agents with the given age, sex and stage codes in bulk.
+        Returns the attributes drawn for them by the population factory. """
+        draws = self.factory.draw(ages, sexes)
+        if self.population is not None:
+            self.population.add(draws, stages, variant or "Standard")
+            return draws
+
+        agents = []
+        for ag, sg, mort, willing, incubation, dwelling, recovery, stage in zip(
+                draws["age_group"].tolist(), draws["sex_group"].tolist(), draws["mortality_value"].tolist(),
+                draws["vaccine_willingness"].tolist(), draws["incubation_time"].tolist(),
+                draws["dwelling_time"].tolist(), draws["recovery_time"].tolist(), np.asarray(stages).tolist()):
+            a = CovidAgent(self.i, AgeGroup(ag), SexGroup(sg), mort, self, (willing, incubation, dwelling, recovery))
+            self.schedule.add(a)
+            if variant is not None:
+                a.set_data(variant=variant)
+            if stage != Stage.SUSCEPTIBLE.value:
+                a.stage = Stage(stage)
+            agents.append(a)
+            self.i = self.i + 1
+
+        self.grid.place_agents(agents, list(zip(draws["pos_x"].tolist(), draws["pos_y"].tolist())))
+        return draws
+
+    def experiment_row(self):
+        # Parameters of the run, keyed by its experiment uuid
+        return [(
+            self.run_id,
+            self.model_data.test_cost,
+            self.model_data.alpha_private,
+            self.model_data.alpha_public,
+            self.model_data.fully_vaccinated_count,
+            self.model_data.prop_initial_infected,
+            self.model_data.generally_infected,
+            self.model_data.cumul_vaccine_cost,
+            self.model_data.cumul_test_cost,
+            self.model_data.total_costs,
+            self.model_data.vaccination_chance, #
+            self.model_data.vaccination_stage.value,
+            self.model_data.vaccine_cost, #
+            self.model_data.day_vaccination_begin, 
+            self.model_data.day_vaccination_end,
+            self.model_data.effective_period,
+            self.model_data.effectiveness,
+            self.model_data.distribution_rate,
+            self.model_data.vaccine_count, #
+            self.model_data.vaccinated_count, #
+            self.model_data.vaccinated_percent, #
+            self.model_data.vaccine_dosage,
+            self.model_data.effectiveness_per_dosage,
+            self.model_data.dwell_15_day,
+            self.model_data.avg_dwell,
+            self.model_data.avg_incubation,
+            self.model_data.repscaling,
+            self.model_data.prob_contagion_base,
+            self.model_data.kmob,
+            self.model_data.rate_inbound,
+            self.model_data.prob_contagion_places,
+            self.model_data.prob_asymptomatic,
+            self.model_data.avg_recovery,
+            self.model_data.testing_rate, #
+            self.model_data.testing_start,
+            self.model_data.testing_end,
+            self.model_data.tracing_start,
+            self.model_data.tracing_end,
+            self.model_data.tracing_now,
+            self.model_data.isolation_rate, #
+            self.model_data.isolation_start,
+            self.model_data.isolation_end,
+            self.model_data.after_isolation,
+            self.model_data.prob_isolation_effective, #
+            self.model_data.distancing, #
+            self.model_data.distancing_start,
+            self.model_data.distancing_end,
+            self.model_data.new_agent_num,
+            self.model_data.new_agent_start,
+            self.model_data.new_agent_end,
+            self.model_data.new_agent_age_mean,
+            self.model_data.new_agent_prop_infected,
+            self.model_data.vaccination_start,
+            self.model_data.vaccination_end,
+            self.model_data.vaccination_now,
+            self.model_data.prob_severe,
+            self.model_data.max_bed_available,
+            self.model_data.bed_count,
+            self.iteration
+        )]
+
+    def summary_key(self):
+        # Experiment and iteration of the summary rows
+        return (self.run_id, self.iteration)
+
+    def summary_row(self):
+        # Summary of the step from the values just collected by the model reporters
+        return (str(uuid.uuid4()),) + tuple(self.datacollector.latest(name) for name in SUMMARY_REPORTERS)
+
+    def flush_collection(self):
+        # Statistics of a period the run stopped in, streamed like the others
+        if self.datacollector.flush():
+            self.db.insert_summary([self.summary_row()], [self.summary_key()])
+
     def step(self):
         datacollectiontimeA = timeit.default_timer()
-        self.datacollector.collect(self)
-        # summary
+        # summary, whenever the collector records a row
+        if self.datacollector.collect(self):
+            self.db.insert_summary([self.summary_row()], [self.summary_key()])
         datacollectiontimeB = timeit.default_timer()
         self.datacollection_time = datacollectiontimeB-datacollectiontimeA
 
@@ -1540,6 +1597,8 @@ class CovidModel(Model):
             if self.model_data.vaccination_now:
                 self.model_data.vaccine_count = self.model_data.vaccine_count + self.model_data.distribution_rate
 
+        tracing_was = self.model_data.tracing_now
+
         # Deactivate unnecessary policies once they run their course
         self.policy_handler.reverse_dispatch(self, self.model_data)
 
@@ -1553,8 +1612,14 @@ class CovidModel(Model):
         if self.model_data.tracing_now and (self.stepno > self.model_data.tracing_end):
             self.model_data.tracing_now = False
 
+        # Tracing countdowns only run while tracing is active
+        if self.population is None and self.model_data.tracing_now != tracing_was:
+            for agent in self.schedule.agents:
+                agent.sync_countdowns()
+                agent.schedule_tracing()
+
         if not (self.model_data.vaccination_now) and (self.stepno >= self.model_data.vaccination_start):
-            self.model_data.vaccinating_now = True
+            self.model_data.vaccination_now = True
 
         if self.model_data.vaccination_now and (self.stepno > self.model_data.vaccination_end):
             self.model_data.vaccination_now = False
@@ -1566,22 +1631,11 @@ class CovidModel(Model):
                 new_infection_count = int(self.num_agents*self.model_data.prop_initial_infected)
                 self.model_data.variant_start[variant] = True
                 print(f"Variant {variant} is set to True with cound {new_infection_count}")
-                for _ in range(0,new_infection_count):
-                    print(f"Creating new variant {variant}")
-                    #Creates new agents that are infected with the variant
-                    ag = random.choice(list(AgeGroup))
-                    sg = random.choice(list(SexGroup))
-                    mort = self.model_data.age_mortality[ag]*self.model_data.sex_mortality[sg]
-                    a = CovidAgent(self.i, ag, sg, mort, self)
-                    self.schedule.add(a)
-                    a.variant = variant
-                    a.stage = Stage.EXPOSED
-                    x = self.random.randrange(self.grid.width)
-                    y = self.random.randrange(self.grid.height)
-                    self.grid.place_agent(a, (x, y))
-                    self.i = self.i + 1
-                    self.num_agents = self.num_agents + 1
-                    self.model_data.generally_infected += 1
+                #Creates new agents that are infected with the variant
+                ages, sexes = self.factory.random_groups(new_infection_count)
+                self.create_agents(ages, sexes, np.full(new_infection_count, Stage.EXPOSED.value), variant)
+                self.num_agents = self.num_agents + new_infection_count
+                self.model_data.generally_infected += new_infection_count
                    
 
 
@@ -1590,43 +1644,28 @@ class CovidModel(Model):
         if (self.stepno >= self.model_data.new_agent_start) and (self.stepno < self.model_data.new_agent_end):
             # Check if the current step is in the new-agent time map
             if self.stepno in self.new_agent_time_map.keys():
-                # We repeat the following procedure as many times as the value stored in the map
-
-                for _ in range(0, self.new_agent_time_map[self.stepno]):
-                    # Generate an age group at random using a Poisson distribution centered at the mean
-                    # age for the incoming population
-                    in_range = False
-                    arange = 0
-
-                    while not(in_range):
-                        arange = poisson_rvs(self.model_data.new_agent_age_mean)
-                        if arange in range(0, 9):
-                            in_range = True
-                    
-                    ag = AgeGroup(arange)
-                    sg = random.choice(list(SexGroup))
-                    mort = self.model_data.age_mortality[ag]*self.model_data.sex_mortality[sg]
-                    a = CovidAgent(self.i, ag, sg, mort, self)
-                    
-                    # Some will be infected
-                    if bernoulli_rvs(self.model_data.new_agent_prop_infected):
-                        a.stage = Stage.EXPOSED
-                        self.model_data.generally_infected = self.model_data.generally_infected + 1
-
-                    self.schedule.add(a)
-                    x = self.random.randrange(self.grid.width)
-                    y = self.random.randrange(self.grid.height)
-                    self.grid.place_agent(a, (x,y))
-                    self.i = self.i + 1
-                    self.num_agents = self.num_agents + 1
-                    self.dwell_time_at_locations[(x,y)] += a.agent_data.dwelling_time
-
-        
+                count = self.new_agent_time_map[self.stepno]
+
+                # Generate age groups at random using a Poisson distribution centered at the mean
+                # age for the incoming population. Some will be infected.
+                ages, sexes = self.factory.ingress_groups(count)
+                infected = self.streams.population.bernoullis(self.model_data.new_agent_prop_infected, count)
+                stages = np.where(infected, Stage.EXPOSED.value, Stage.SUSCEPTIBLE.value)
+                self.model_data.generally_infected = self.model_data.generally_infected + int(infected.sum())
+                draws = self.create_agents(ages, sexes, stages)
+                self.num_agents = self.num_agents + count
+                for x, y, dwelling in zip(draws["pos_x"].tolist(), draws["pos_y"].tolist(), draws["dwelling_time"].tolist()):
+                    self.dwell_time_at_locations[(x,y)] += dwelling
+
+
+        # Fire the countdowns that run out on this step before the agents act
+        self.timers.advance(self.stepno)
         self.schedule.step()
         steptimeB = timeit.default_timer()
         self.step_time = steptimeB - steptimeA
 
         # Commit (save first all the agent data in memory)
+        self.db.end_step()
         # Save the summaries
 
         # We now do a reverse dispatch: deactivate all policies that need to be deactivated
@@ -24,6 +24,10 @@ from functools import partial
 import types
 from agent_data_class import AgentDataClass
 from model_data_class import ModelDataClass
+from random_streams import RandomStreams
+from resource_sampler import resource_sampler
+import checkpoint
+from snapshot_store import SnapshotStore, snapshot_path
 
 class Stage(Enum):
     SUSCEPTIBLE = 1
@@ -65,6 +69,9 @@ class VaccinationStage(Enum):
     C70to79 = 7
     C80toXX = 8
 
+# Enum classes by name, for restoring checkpoints
+CHECKPOINT_ENUMS = {enum.__name__: enum for enum in (Stage, AgeGroup, SexGroup, ValueGroup, VaccinationStage)}
+
 
 class CovidAgent(Agent):
     """ An agent representing a potential covid case"""
@@ -83,6 +90,9 @@ class CovidAgent(Agent):
         self.astep = 0
         # initialize the agent from AgentDataClass
         self.agent_data = AgentDataClass(model, is_checkpoint, parameters)
+        # or from the time of the agent in the saved model
+        if is_checkpoint:
+            self.astep = self.agent_data.astep
 
 
     def alive(self):
@@ -139,7 +149,7 @@ class CovidAgent(Agent):
 
     def add_contact_trace(self, other):
         if self.model.model_data.tracing_now:
-            self.agent_data.contacts.add(other)
+            self.agent_data.contacts[other] = None
 
     #helper function that reveals if an agent is vaccinated
     def is_vaccinated(self):
@@ -949,26 +959,26 @@ def compute_traced(model):
     return tested
 
 
+# Resource use reporters read the latest sample of the background sampler
+# (see resource_sampler.py), and report 0 until the first one is taken
+
 def compute_total_processor_usage(model):
-    if model.stepno % model.model_data.dwell_15_day == 0:
-        processes = psu.cpu_percent(1, True)
-        process_count = 0
-        for idx, process in enumerate(processes):
-            if (process > 0.0):
-                process_count = process_count + 1
-        return process_count
-    else:
+    sample = resource_sampler().latest()
+    if sample is None:
         return 0
+    process_count = 0
+    for process in sample.cpu:
+        if (process > 0.0):
+            process_count = process_count + 1
+    return process_count
 
 def compute_processor_usage(model, processoridx):
-    if model.stepno % model.model_data.dwell_15_day == 0:
-        processes = psu.cpu_percent(1, True)
-        for idx, process in enumerate(processes):
-            if (idx == processoridx):
-                return process
-        return "Out of range"
-    else:
+    sample = resource_sampler().latest()
+    if sample is None:
         return 0
+    if processoridx < len(sample.cpu):
+        return sample.cpu[processoridx]
+    return "Out of range"
 
 def compute_eff_reprod_number(model):
     prob_contagion = 0.0
@@ -1041,7 +1051,9 @@ def compute_fully_vaccinated_count(model):
 
 
 def get_agent_data(agent, param_name):
-    return agent.__dict__[param_name]
+    if param_name in agent.__dict__:
+        return agent.__dict__[param_name]
+    return agent.agent_data.__dict__[param_name]
 
 
 class CovidModel(Model):
@@ -1055,13 +1067,17 @@ class CovidModel(Model):
                  new_agent_proportion, new_agent_start, new_agent_lasts, new_agent_age_mean, new_agent_prop_infected,
                  day_tracing_start, days_tracing_lasts, stage_value_matrix, test_cost, alpha_private, alpha_public, proportion_beds_pop, day_vaccination_begin,
                  day_vaccination_end, effective_period, effectiveness, distribution_rate, cost_per_vaccine, vaccination_percent, variant_data, 
-                 step_count, load_from_file, loading_file_path, starting_step, agent_storage, model_storage, agent_increment, model_increment, iteration, dummy=0
+                 step_count, load_from_file, loading_file_path, starting_step, agent_storage, model_storage, agent_increment, model_increment, iteration, seed=None,
+                 agent_save_file=None, agent_keep=None, agent_snapshot_file=None, dummy=0
                  ):
         print("Made it to the model")
         self.iteration = iteration
         print(iteration)
         self.max_steps  = step_count
         self.running = True
+        # AgentDataClass draws the fixed agent properties from the population stream
+        self.streams = RandomStreams(seed)
+        self.reset_randomizer(self.streams.seed)
         self.starting_step = starting_step
         self.num_agents = num_agents
         self.grid = MultiGrid(width, height, True)
@@ -1169,6 +1185,8 @@ class CovidModel(Model):
         self.agent_storage = agent_storage #Details the method for storing the agent data. 0 -> We dont store agent data, 1->We store every step of the agent data, 2->We store incremental agent data, 3->We store final step agent data
         self.model_storage = model_storage #Details the method for storing the model data. 0 -> We dont store model data, 1->We store every step of the model data, 2->We store incremental model data, 3->We store final step model data
         self.iteration = iteration #Current iteration in the ensemble of iterations being run with the same scenario. Useful for running parallel backtracking jobs.
+        self.agent_increment = agent_increment #Number of steps between stored agent data when storing incrementally.
+        self.model_increment = model_increment #Number of steps between stored model data when storing incrementally.
 
         # All parameter names of concern for agents. Must be kept in this form as a standard for loading into agent data. Add a new variable name before pos.
         #TODO (optional) make the production of the agent more rigourous instead of the brute force solution you have up there.
@@ -1216,59 +1234,32 @@ class CovidModel(Model):
                         self.grid.place_agent(a, (x,y))
                         self.i = self.i + 1
 
+        elif not (loading_file_path.endswith(".csv") and os.path.isfile(loading_file_path)): #If were restoring a model from a binary checkpoint (see checkpoint.py)
+            path = checkpoint.locate(loading_file_path, self.iteration, self.starting_step)
+            checkpoint.restore(self, checkpoint.read(path), CovidAgent, CHECKPOINT_ENUMS)
+
         else: #If where creating a model from a previously generated model
-            data_df = pd.read_csv(loading_file_path)
             #We could extract data from the loading file path name to find out what type of data we are looking at.
             #TODO provide a nomenclature to the saved agent files.
                 #1->Complete, 2->Incremental, 3->Final
                 #Use some regex magic to find these keywords within the file name
-            for agent in range(self.num_agents):
-                agent_data = []
-                position = None
-
-                #For each agent we look through the different parameter names we initialized earlier as the standard and begin appending values from the Dataframe into the agent initialization.
-                for param_name in self.agent_parameter_names:
-
-                    key = "Agent " + str(agent) + " " + param_name #Standard key nomenclature within the agent data file.
-
-                    #Searching for the data at the defined step and iteration value we saved earlier through the batchrunner library folder.
-                    #This allows for multiple models to be backtracked according to their associated iteration number.
-                    #TODO Specify a situation where every iteration runs on a single iteration within the file.
-                    #TODO Contemplate reality and how this backtracking thing will work
-                    #Are we just backtracking from a specific scenario?
-                    #Are we backtracking to extend the length of a model?
-                    #If we are extending the length of a model we might as well just say that the iterations actually matter.
-                    #If we are working from a specific model then we will have to specify this fact and we will have to input the desired iteration.
-                    #TODO add two new parameters: load_file_iteration, load_specific_iteration -> True/False
-                    #TODO if we are loading to extend the file then wouldnt we just be using the only step that exists?
-
-                    value = data_df[key][data_df["Step"] == self.starting_step][data_df["Iteration"] == self.iteration]
-                    value = value.item()
-
-                    #Enums arent saved as enums in the dataframe so we will have to convert them here.
-                    if (param_name == "stage"):
-                        value = value.replace("Stage.", "")
-                        value = Stage[value]
-                    if (param_name == "age_group"):
-                        value = value.replace("AgeGroup.", "")
-                        value = AgeGroup[value]
-                    if (param_name == "sex_group"):
-                        value = value.replace("SexGroup.", "")
-                        value = SexGroup[value]
-
-                    #position is not an agent parameter but a model parameter.
-                    if (param_name == 'pos'):
-                        position = value
-                    elif(param_name == "variant_immune"):
-                        value = eval(value)#Dictionaries are saved as strings in the dataframe.
-                        agent_data.append(value.copy())
-                    else:
-                        agent_data.append(value)
-
+            #The row at the defined step and iteration value we saved earlier through the batchrunner library folder is located once,
+            #and all agents are built from it. This allows for multiple models to be backtracked according to their associated iteration number.
+            #TODO Specify a situation where every iteration runs on a single iteration within the file.
+            #TODO Contemplate reality and how this backtracking thing will work
+            #Are we just backtracking from a specific scenario?
+            #Are we backtracking to extend the length of a model?
+            #If we are extending the length of a model we might as well just say that the iterations actually matter.
+            #If we are working from a specific model then we will have to specify this fact and we will have to input the desired iteration.
+            #TODO add two new parameters: load_file_iteration, load_specific_iteration -> True/False
+            #TODO if we are loading to extend the file then wouldnt we just be using the only step that exists?
+            agents = checkpoint.read_csv_state(loading_file_path, self.starting_step, self.iteration,
+                                               self.agent_parameter_names, self.num_agents, CHECKPOINT_ENUMS)
+            for agent_data, position in agents:
                 #Create the agent based on the parameter list.
-                a = CovidAgent(self ,agent_data)
+                a = CovidAgent(self, agent_data)
                 self.schedule.add(a)
-                self.grid.place_agent(a, eval(position))
+                self.grid.place_agent(a, position)
 
 
             print("Confirmation that the code works by finding the values and datatypes of the agent's variables: (Comment this block out if you are sure everythings working.)")
@@ -1282,11 +1273,9 @@ class CovidModel(Model):
 
         #DECLARING ALL MODEL REPORTERS.
 
-        #Wonky attempt at modelling CPU usage within the model.
-        #TODO Delete everything related to this method. It literally freezes the model every time.
-        processes = psu.cpu_percent(1, True)
+        #Modelling CPU usage within the model, from the background resource sampler.
         processes_dict = {}
-        for idx, process in enumerate(processes):
+        for idx in range(psu.cpu_count()):
             processor_name = "Processor " + str(idx)
             processes_dict[processor_name] = [compute_processor_usage, [self, idx]]
         processes_dict["Total_Processore_Use"] = compute_total_processor_usage
@@ -1385,15 +1374,20 @@ class CovidModel(Model):
             for name, reporter in self.model_reporters.items():
                 self.model_vars[name] = []
 
-        #For storing agent data we dont use ModelReporters at all, so we will have to do it ourselves when we reach the step(model). So we just initialize the reporters here
-        self.agent_reporters = {}
-        self.agent_vars = {}
-        if(self.agent_storage > 0):
-            for index, agent in enumerate(self.schedule.agents):  # Creates a column for each agent and parameter
-                for param_name in self.agent_parameter_names:  # Retrieves the name of the parameters for that particular agent and adds it to the list of column headings. parameter_names will be a list of strings
-                    key = "Agent " + str(index) + " " + param_name #Nomenclature for storing agent data.
-                    self.agent_reporters[key] = [get_agent_data,[agent, param_name]]
-                    self.agent_vars[key] = []
+        #Agent data is stored as binary checkpoints of the whole model state (see checkpoint.py), one per stored step.
+        #With a save file they are written to disk as they are taken, otherwise they are kept in memory until the end of the run.
+        #Either way, only the agent_keep most recent ones are kept if it is set.
+        self.agent_checkpoints = []
+        self.agent_keep = agent_keep
+        self.checkpoint_writer = None
+        if agent_save_file is not None:
+            self.checkpoint_writer = checkpoint.CheckpointWriter(agent_save_file, self.iteration, agent_keep)
+        #The population at every stored step can also be appended to a memory-mapped snapshot store (see snapshot_store.py),
+        #from which any of those steps can be read back directly.
+        self.agent_snapshot_file = agent_snapshot_file
+        self.snapshot_store = None
+        if agent_snapshot_file is not None:
+            self.snapshot_store = SnapshotStore(snapshot_path(agent_snapshot_file, self.iteration), "w")
 
 
 
@@ -1414,7 +1408,27 @@ class CovidModel(Model):
     def retrieve_model_Data(self):
         return pd.DataFrame(self.model_vars)
     def retrieve_agent_Data(self):
-        return pd.DataFrame(self.agent_vars)
+        return self.agent_checkpoints
+
+    def store_model_Data(self):
+        for var, reporter in self.model_reporters.items():
+            # If the reporter was a function with no parameters
+            if isinstance(reporter, types.LambdaType):
+                self.model_vars[var].append(reporter(self))
+            # Check if function with arguments
+            elif isinstance(reporter, list):
+                self.model_vars[var].append(reporter[0](*reporter[1]))
+
+    def store_agent_Data(self):
+        arrays = checkpoint.capture(self)
+        if self.snapshot_store is not None:
+            self.snapshot_store.append(arrays)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(self, arrays)
+        elif self.snapshot_store is None:
+            self.agent_checkpoints.append(arrays)
+            if self.agent_keep is not None and len(self.agent_checkpoints) > self.agent_keep:
+                del self.agent_checkpoints[:len(self.agent_checkpoints) - self.agent_keep]
 
     def step(self):
 
@@ -1423,40 +1437,20 @@ class CovidModel(Model):
 
         # This is the equivalent to datacollector.collect(self) except it is done within the model.
         if (self.model_storage == 1 and self.schedule.steps < self.max_steps-1):
-            for var, reporter in self.model_reporters.items():
-                if isinstance(reporter, types.LambdaType):
-                    self.model_vars[var].append(reporter(self))
-                # Check if function with arguments
-                elif isinstance(reporter, list):
-                    self.model_vars[var].append(reporter[0](*reporter[1]))
+            self.store_model_Data()
         #Same thing is done for agent data.
         if(self.agent_storage == 1 and self.schedule.steps < self.max_steps-1):
-            for var, reporter in self.agent_reporters.items():
-                if isinstance(reporter, types.LambdaType):
-                    self.agent_vars[var].append(reporter(self))
-                # Check if function with arguments
-                elif isinstance(reporter, list):
-                    self.agent_vars[var].append(reporter[0](*reporter[1]))
+            self.store_agent_Data()
 
         #If we are incrementally running the model then we will have to collect at the specified time interval.
-        if(self.model_storage == 2 and self.schedule.steps < self.max_step-1):
-            if(self.stepno % self.increment_value == 0):
-                for var, reporter in self.model_reporters.items():
-                    if isinstance(reporter, types.LambdaType):
-                        self.model_vars[var].append(reporter(self))
-                    # Check if function with arguments
-                    elif isinstance(reporter, list):
-                        self.model_vars[var].append(reporter[0](*reporter[1]))
+        if(self.model_storage == 2 and self.schedule.steps < self.max_steps-1):
+            if(self.stepno % self.model_increment == 0):
+                self.store_model_Data()
 
         #We do the same for the agent data.
-        if (self.agent_storage == 2 and self.schedule.steps < self.max_step-1   ):
-            if (self.stepno % self.increment_value == 0):
-                for var, reporter in self.agent_reporters.items():
-                    if isinstance(reporter, types.LambdaType):
-                        self.agent_vars[var].append(reporter(self))
-                    # Check if function with arguments
-                    elif isinstance(reporter, list):
-                        self.agent_vars[var].append(reporter[0](*reporter[1]))
+        if (self.agent_storage == 2 and self.schedule.steps < self.max_steps-1):
+            if (self.stepno % self.agent_increment == 0):
+                self.store_agent_Data()
         self.datacollector.collect(self)
         data_time_B = timeit.default_timer()
         self.datacollection_time = data_time_B-data_time_A
@@ -1546,24 +1540,12 @@ class CovidModel(Model):
             print("Creating DataFrame and saving results")
             if (self.model_storage > 0):
                 #Store all data for the model into a single dataframe and output the result into the path of interest
-                # If the reporter was a function with no parameters
-                for var, reporter in self.model_reporters.items():
-                    if isinstance(reporter, types.LambdaType):
-                        self.model_vars[var].append(reporter(self))
-                    # Check if function with arguments
-                    elif isinstance(reporter, list):
-                        self.model_vars[var].append(reporter[0](*reporter[1]))
+                self.store_model_Data()
 
                 #Create the dataFrame and save it to the file location.
 
             if self.agent_storage > 0:
-                # If the reporter was a function with no parameters
-                for var, reporter in self.agent_reporters.items():
-                    if isinstance(reporter, types.LambdaType):
-                        self.agent_vars[var].append(reporter(self))
-                    # Check if function with arguments
-                    elif isinstance(reporter, list):
-                        self.agent_vars[var].append(reporter[0](*reporter[1]))
+                self.store_agent_Data()
 
 
 
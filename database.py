@@ -1,185 +1,224 @@
-import psycopg2
-from config import config
+import os
+import queue
+import threading
+
+from storage_backends import PooledBackend, storage_options
+from trace_delta import DeltaTraceEncoder
+
+
+# class for background database work
+class AsyncSink:
+    """ Runs database work on a background thread, in submission order.
+
+    Work is fed through a bounded queue: when the database falls behind by
+    max_pending batches, submit blocks the simulation until the writer
+    catches up. Threads do not survive a fork (nor pickling), so a process
+    that inherits the sink starts its own writer on first use. The first
+    error raised by the work is reported back on the next drain or close.
+    """
+
+    def __init__(self, max_pending=8):
+        self.max_pending = max_pending
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    def __getstate__(self):
+        # The writer thread and its queue stay in this process
+        state = self.__dict__.copy()
+        state.update(pid=None, queue=None, thread=None)
+        return state
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=self.max_pending)
+        self.thread = threading.Thread(target=self._run, name="database-sink", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                work, args = item
+                try:
+                    work(*args)
+                except Exception as error:
+                    if self.error is None:
+                        self.error = error
+            finally:
+                self.queue.task_done()
+
+    def submit(self, work, *args):
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put((work, args))
+
+    def _raise(self):
+        error = self.error
+        if error is not None:
+            self.error = None
+            raise error
+
+    def drain(self):
+        # Wait until all submitted work has been done
+        if self.pid == os.getpid():
+            self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join()
+            self.pid = None
+        self._raise()
+
+
+# class for buffered trace writing
+class TraceWriter:
+    """ Accumulates trace rows and writes them to the backend in batches.
+
+    Rows are written and committed in a single transaction once flush_rows
+    rows are buffered, at the end of every step when flush_each_step is set,
+    and when the writer is closed. Every row comes with its key (for agent
+    traces, the experiment_uuid, iteration, step and agent_id), which is
+    stored along with it. With delta set, the rows are written in the
+    change-only encoding of trace_delta.py.
+    """
+
+    def __init__(self, backend, table="agent", flush_rows=100000, flush_each_step=True, sink=None, delta=False):
+        self.backend = backend
+        self.table = table
+        self.flush_rows = flush_rows
+        self.flush_each_step = flush_each_step
+        # Optional AsyncSink doing the writes off the simulation thread
+        self.sink = sink
+        self.encoder = DeltaTraceEncoder() if delta else None
+        self.rows = []
+        self.keys = []
+
+    def write(self, rows, keys):
+        if len(keys) != len(rows):
+            raise ValueError("Every trace row needs its key")
+        self.rows.extend(rows)
+        self.keys.extend(keys)
+        if self.flush_rows is not None and len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows = self.rows
+        keys = self.keys
+        self.rows = []
+        self.keys = []
+        if self.sink is not None:
+            self.sink.submit(self.copy, rows, keys)
+        else:
+            self.copy(rows, keys)
+
+    def copy(self, rows, keys):
+        if self.encoder is not None:
+            static_rows, delta_rows = self.encoder.encode(rows, keys)
+            if static_rows:
+                self.backend.write(self.table + "_static", static_rows)
+            if delta_rows:
+                self.backend.write(self.table + "_delta", delta_rows)
+        else:
+            self.backend.write(self.table, [row + key for row, key in zip(rows, keys)])
+        self.backend.commit()
+
+    def close(self):
+        self.flush()
+
 
 # class for database functions
 class Database:
-    def __init__(self):
-        conn = None
-        try:
-            params = config()
-            self.conn = psycopg2.connect(**params)
-            print("Connection success")
-        
-        except (Exception, psycopg2.DatabaseError) as error:
-            print('error')
-            print(error)
-
-    # insert one agent into database
-    def insert_agent(self, data):
-        """ insert a new agent into the trace table """
-        sql = """
-            INSERT INTO agent(
-                uuid,
-                age_group,
-                sex_group,
-                vaccine_willingness,
-                incubation_time, 
-                dwelling_time, 
-                recovery_time, 
-                prob_contagion, 
-                mortality_value, 
-                severity_value,
-                curr_dwelling,
-                curr_incubation,
-                curr_recovery,
-                curr_asymptomatic,
-                isolated,
-                isolated_but_inefficient,
-                test_chance,
-                in_isolation,
-                in_distancing,
-                in_testing,
-                astep,
-                tested,
-                occupying_bed,
-                cumul_private_value,
-                cumul_public_value,
-                employed,
-                tested_traced,
-                tracing_delay,
-                tracing_counter,
-                vaccinated,
-                safetymultiplier,
-                current_effectiveness,
-                vaccination_day,
-                vaccine_count,
-                dosage_eligible,
-                fully_vaccinated,
-                variant
-            ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        try:
-            self.cur = self.conn.cursor()
-            self.cur.executemany(sql, data)
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
-    
+    """ Writes the experiment, agent trace and summary rows of the runs.
+
+    The rows go to a storage backend (see storage_backends.py), by default
+    the one configured in database/database.ini. That backend comes from a
+    pool of at most pool_size connections per process, and every process
+    the Database is forked into opens its own on first use. Summaries are
+    streamed while the run progresses, in batches of summary_rows steps.
+    """
+
+    def __init__(self, flush_rows=100000, flush_each_step=True, asynchronous=True, max_pending=8, backend=None,
+                 trace=None, summary_rows=96, pool_size=4):
+        if backend is None:
+            backend = PooledBackend(max_size=pool_size)
+            # Connect (and create the tables) once in this process, before any worker is forked
+            backend.healthy()
+        self.backend = backend
+        # With asynchronous set, statements and trace batches are executed by a background
+        # writer so that database stalls do not hold up the simulation
+        self.sink = AsyncSink(max_pending) if asynchronous else None
+        # Agent traces are written in full, or as changes only with trace set to delta
+        if trace is None:
+            trace = storage_options().get("trace", "full")
+        if trace not in ("full", "delta"):
+            raise ValueError(f"Unknown trace mode {trace}")
+        self.traces = TraceWriter(self.backend, flush_rows=flush_rows, flush_each_step=flush_each_step, sink=self.sink,
+                                  delta=(trace == "delta"))
+        self.summaries = TraceWriter(self.backend, table="summary", flush_rows=summary_rows, flush_each_step=False,
+                                     sink=self.sink)
+
+    # run database work on the background writer if there is one
+    def _submit(self, work, *args):
+        if self.sink is not None:
+            self.sink.submit(work, *args)
+        else:
+            work(*args)
+
+    # buffer agent traces; they are written by the trace writer
+    def insert_agent(self, data, keys):
+        """ insert new agents into the trace table; keys are the (experiment_uuid, iteration, step, agent_id) of the rows """
+        self.traces.write(data, keys)
+
+    # write out the buffered traces if the flush policy asks for it at the end of a step
+    def end_step(self):
+        if self.traces.flush_each_step:
+            self.traces.flush()
+
+    # write out all the buffered traces and summaries and complete the output of the run
+    def flush(self):
+        self.traces.flush()
+        self.summaries.flush()
+        self._submit(self.backend.finish)
+        if self.sink is not None:
+            self.sink.drain()
+
+    # read the rows of a run back, after writing out everything pending
+    def fetch_run(self, experiment_uuid, table="agent"):
+        """ rows of one run in step and agent order """
+        return self.fetch_steps(experiment_uuid, None, None, table)
+
+    def fetch_steps(self, experiment_uuid, first_step, last_step, table="agent"):
+        """ rows of one run from first_step to last_step (both included) in step and agent order """
+        self.flush()
+        return self.backend.read(table, experiment_uuid, first_step, last_step)
+
     # insert one model into the database
     def insert_model(self, data):
         """ insert a new model into the experiment table """
-        sql = """
-            INSERT INTO experiment(
-                uuid,
-                test_cost,
-                alpha_private,
-                alpha_public,
-                fully_vaccinated_count,
-                prop_initial_infected,
-                generally_infected,
-                cumul_vaccine_count,
-                cumul_test_cost,
-                total_costs,
-                vaccination_chance,
-                vaccination_stage,
-                vaccine_cost,
-                day_vaccination_begin,
-                day_vaccination_end,
-                effective_period,
-                effectiveness,
-                distribution_rate,
-                vaccine_count,
-                vaccinated_count,
-                vaccinated_percent,
-                vaccine_dosage,
-                effectiveness_per_dosage,
-                dwell_15_day,
-                avg_dwell,
-                avg_incubation,
-                repscaling,
-                prob_contagion_base,
-                kmob,
-                rate_inbound,
-                prob_contagion_places,
-                prob_asymptomatic,
-                avg_recovery,
-                testing_rate,
-                testing_start,
-                testing_end,
-                tracing_start,
-                tracing_end,
-                tracing_now,
-                isolation_rate,
-                isolation_start,
-                isolation_end,
-                after_isolation,
-                prob_isolation_effective,
-                distancing,
-                distancing_start,
-                distancing_end,
-                new_agent_num,
-                new_agent_start,
-                new_agent_end,
-                new_agent_age_mean,
-                new_agent_prop_infected,
-                vaccination_start,
-                vaccination_end,
-                vaccination_now,
-                prob_severe,
-                max_bed_available,
-                bed_count
-            ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """
-        try:
-           self.cur = self.conn.cursor()
-           self.cur.executemany(sql, data)
-        except (Exception, psycopg2.DatabaseError) as error:
-            print(error)
-
-    # insert one summary into the database
-    def insert_summary(self, data):
-        """ insert a new summary into the summary table """
-        sql = """
-            INSERT INTO summary(
-                uuid,
-                cumul_priv_value,
-                cumul_publ_value,
-                cumul_test_cost,
-                rt,
-                employed,
-                unemployed,
-                tested,
-                traced,
-                cumul_vaccine_cost,
-                cumul_cost,
-                step,
-                n,
-                isolated,
-                vaccinated,
-                vaccines,
-                v,
-                data_time,
-                step_time,
-                generally_infected,
-                fully_vaccinated,
-                vaccine_1,
-                vaccine_2,
-                vaccine_willing
-            ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """
-        try:
-            self.cur = self.conn.cursor()
-            self.cur.executemany(sql, data)
-        except (Exception, psycopg2.DatabaseError) as error:
-            print('error')
-            print(error)
+        self._submit(self.backend.write, "experiment", data)
+
+    # buffer summaries; they are written by the summary writer
+    def insert_summary(self, data, keys):
+        """ insert new summaries into the summary table; keys are the (experiment_uuid, iteration) of the rows """
+        self.summaries.write(data, keys)
 
     # commit changes to database
     def commit(self):
-        self.conn.commit()
-    
-    # close connection to database
+        self._submit(self.backend.commit)
+
+    # close connection to database, writing out the buffered traces and draining
+    # the background writer first
     def close(self):
-        if self.cur is not None:
-            self.cur.close()
-        if self.conn is not None:
-            self.conn.close()
\ No newline at end of file
+        self.traces.close()
+        self.summaries.close()
+        self._submit(self.backend.close)
+        if self.sink is not None:
+            self.sink.close()
@@ -22,13 +22,22 @@ Additionally, other objects can write directly to tables by passing in an
 appropriate dictionary object for a table row.
 
 The DataCollector then stores the data it collects in dictionaries:
-    * model_vars maps each reporter to a list of its values
+    * model_vars maps each reporter to an array of its values, one per
+      collection; the arrays are views on preallocated typed columns that
+      grow geometrically when they fill up
     * tables maps each table to a dictionary, with each column as a key with a
       list as its value.
     * _agent_records maps each model step to a list of each agents id
       and its values.
 
+By default a row is recorded on every call to collect. With every=k, a row
+is only recorded on every k-th call or, with aggregate set, every k calls
+summarise the values of all of them (mean, min, max or last), computed on
+line so that no more than a row is kept in between.
+
 Finally, DataCollector can create a pandas DataFrame from each collection.
+The model variables DataFrame (and Arrow table, with pyarrow installed)
+shares memory with the columns instead of copying them.
 
 The default DataCollector here makes several assumptions:
     * The model has a schedule object called 'schedule'
@@ -39,10 +48,49 @@ The default DataCollector here makes several assumptions:
 from functools import partial
 import itertools
 from operator import attrgetter
+import numpy as np
 import pandas as pd
 import warnings
 import types
 
+from fused_reporters import FusedReporter, evaluate
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+def _column_dtype(value):
+    # Narrowest column type holding a reporter value
+    if isinstance(value, (bool, np.bool_)):
+        return np.bool_
+    if isinstance(value, (int, np.integer)) and -2**63 <= value < 2**63:
+        return np.int64
+    if isinstance(value, (float, np.floating)):
+        return np.float64
+    return object
+
+
+def _numeric(value):
+    return isinstance(value, (int, float, np.integer, np.floating))
+
+
+# How the values of a period are combined by aggregate
+_COMBINE = {"mean": lambda a, b: a + b, "min": min, "max": max, "last": lambda a, b: b}
+
+
+def _widened(kind, value):
+    # Column type holding both the values so far and value
+    dtype = _column_dtype(value)
+    if kind == "O" or dtype is object:
+        return object
+    if kind == "b" or dtype is np.bool_:
+        return object if (kind == "b") != (dtype is np.bool_) else np.bool_
+    if kind == "f" or dtype is np.float64:
+        return np.float64
+    return np.int64
+
 
 class DataCollector:
     """ Class for collecting data generated by a Mesa model.
@@ -57,7 +105,8 @@ class DataCollector:
 
     model = None
 
-    def __init__(self, model_reporters=None, agent_reporters=None, tables=None):
+    def __init__(self, model_reporters=None, agent_reporters=None, tables=None, capacity=1024, every=1,
+                 aggregate=None, last=()):
         """ Instantiate a DataCollector with lists of model and agent reporters.
 
         Both model_reporters and agent_reporters accept a dictionary mapping a
@@ -81,6 +130,16 @@ class DataCollector:
             model_reporters: Dictionary of reporter names and attributes/funcs
             agent_reporters: Dictionary of reporter names and attributes/funcs.
             tables: Dictionary of table names to lists of column names.
+            capacity: Number of rows the model variable columns are first
+                      allocated for (see reserve).
+            every: Number of calls to collect per recorded row.
+            aggregate: None to record the values of the first call of every
+                       period of every calls, or one of mean, min, max and
+                       last to record that statistic of the values over the
+                       period. Values that are not numbers are recorded as
+                       their last value.
+            last: Names of the model variables always recorded as their
+                  last value, e.g. the step.
 
         Notes:
             If you want to pickle your model you must not use lambda functions.
@@ -90,8 +149,20 @@ class DataCollector:
         self.model_reporters = {}
         self.agent_reporters = {}
 
-        self.model_vars = {}
+        # Model variable columns, of which the first _length entries are filled
+        self._columns = {}
+        self._length = 0
+        self._capacity = capacity
         self._agent_records = {}
+
+        if aggregate is not None and aggregate not in _COMBINE:
+            raise ValueError(f"Unknown aggregate {aggregate}")
+        self.every = every
+        self.aggregate = aggregate
+        self.last = set(last)
+        self._calls = 0
+        # name -> (combined value, number of values) over the current period
+        self._pending = {}
         self.tables = {}
 
         if model_reporters is not None:
@@ -111,8 +182,9 @@ class DataCollector:
 
         Args:
             name: Name of the model-level variable to collect.
-            reporter: Attribute string, or function object that returns the
-                      variable when given a model instance.
+            reporter: Attribute string, function object that returns the
+                      variable when given a model instance, or FusedReporter
+                      (all of which are evaluated together).
         """
         if type(reporter) is str:
             reporter = partial(self._getattr, reporter)
@@ -123,7 +195,8 @@ class DataCollector:
                           "{reporter: [function, [arguments]]}")
         '''
         self.model_reporters[name] = reporter
-        self.model_vars[name] = []
+        # Typed once the first value comes in
+        self._columns[name] = None
 
 
     def _new_agent_reporter(self, name, reporter):
@@ -169,21 +242,127 @@ class DataCollector:
         agent_records = map(get_reports, model.schedule.agents)
         return agent_records
 
-    def collect(self, model):
-        """ Collect all the data for the given model object. """
+    @property
+    def model_vars(self):
+        """ Values collected so far for every model reporter """
+        return {name: self._column(name) for name in self.model_reporters}
+
+    def _column(self, name):
+        column = self._columns[name]
+        if column is None:
+            return np.empty(0)
+        return column[:self._length]
+
+    def latest(self, name):
+        """ Value of a model reporter at the last collection """
+        value = self._columns[name][self._length - 1]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def reserve(self, calls):
+        """ Make room for the rows recorded over a number of calls to
+        collect, e.g. the maximum number of steps of a run, so that the
+        columns never grow. """
+        self._grow(-(-calls // self.every))
+
+    def _grow(self, rows):
+        if rows > self._capacity:
+            self._capacity = rows
+            for name, column in self._columns.items():
+                if column is not None:
+                    self._columns[name] = self._resized(column)
+
+    def _resized(self, column):
+        resized = np.empty(self._capacity, dtype=column.dtype)
+        resized[:self._length] = column[:self._length]
+        return resized
+
+    def _store(self, name, value):
+        column = self._columns[name]
+        if column is None:
+            column = self._columns[name] = np.empty(self._capacity, dtype=_column_dtype(value))
+        elif column.dtype.kind != "O" and _column_dtype(value) is not column.dtype.type:
+            dtype = _widened(column.dtype.kind, value)
+            if dtype is not column.dtype.type:
+                widened = np.empty(self._capacity, dtype=dtype)
+                widened[:self._length] = column[:self._length]
+                column = self._columns[name] = widened
+        column[self._length] = value
+
+    def _evaluate(self, model):
+        # Current values of the model reporters
+        values = {}
+        fused = {var: reporter for var, reporter in self.model_reporters.items()
+                 if isinstance(reporter, FusedReporter)}
+        if fused:
+            fused = dict(zip(fused, evaluate(model, list(fused.values()))))
+        for var, reporter in self.model_reporters.items():
+            if var in fused:
+                values[var] = fused[var]
+            elif isinstance(reporter, types.LambdaType):
+                values[var] = reporter(model)
+            else:
+                try:
+                    values[var] = reporter[0](*reporter[1])
+                except:
+                    raise Exception("Model reporters should be of form {reporter: [function, [arguments]]}")
+        return values
+
+    def _fold(self, values):
+        # Combine the values into the statistics of the current period
+        combine = _COMBINE[self.aggregate]
+        pending = self._pending
+        for name, value in values.items():
+            previous = pending.get(name)
+            if previous is None or name in self.last or not (_numeric(value) and _numeric(previous[0])):
+                pending[name] = (value, 1)
+            else:
+                pending[name] = (combine(previous[0], value), previous[1] + 1)
+
+    def _period_values(self):
+        values = {}
+        for name, (value, count) in self._pending.items():
+            if self.aggregate == "mean" and _numeric(value) and name not in self.last:
+                value = value / count
+            values[name] = value
+        self._pending = {}
+        return values
+
+    def _record(self, values):
         if self.model_reporters:
-            for var, reporter in self.model_reporters.items():
-                if isinstance(reporter, types.LambdaType):
-                    self.model_vars[var].append(reporter(model))
-                else:
-                    try:
-                        self.model_vars[var].append(reporter[0](*reporter[1]))
-                    except:
-                        raise Exception("Model reporters should be of form {reporter: [function, [arguments]]}")
+            if self._length == self._capacity:
+                self._grow(2 * self._capacity)
+            for var in self.model_reporters:
+                self._store(var, values[var])
+            self._length += 1
+
+    def collect(self, model):
+        """ Collect all the data for the given model object. Returns whether
+        a row was recorded. """
+        call = self._calls
+        self._calls += 1
+        if self.aggregate is None:
+            if call % self.every != 0:
+                return False
+            values = self._evaluate(model)
+        else:
+            self._fold(self._evaluate(model))
+            if self._calls % self.every != 0:
+                return False
+            values = self._period_values()
+        self._record(values)
 
         if self.agent_reporters:
             agent_records = self._record_agents(model)
             self._agent_records[model.schedule.steps] = list(agent_records)
+        return True
+
+    def flush(self):
+        """ Record the statistics of an incomplete period, e.g. at the end of
+        a run. Returns whether a row was recorded. """
+        if not self._pending:
+            return False
+        self._record(self._period_values())
+        return True
 
     def add_table_row(self, table_name, row, ignore_missing=False):
         """ Add a row dictionary to a specific table.
@@ -215,10 +394,18 @@ class DataCollector:
         """ Create a pandas DataFrame from the model variables.
 
         The DataFrame has one column for each model variable, and the index is
-        (implicitly) the model tick.
+        (implicitly) the model tick. Its columns share memory with the
+        collector.
 
         """
-        return pd.DataFrame(self.model_vars)
+        return pd.DataFrame(self.model_vars, copy=False)
+
+    def get_model_vars_table(self):
+        """ Create a pyarrow Table from the model variables, sharing memory
+        with the collector for the numeric columns. """
+        if pa is None:
+            raise ImportError("Arrow tables of the model variables require pyarrow")
+        return pa.table({name: pa.array(values) for name, values in self.model_vars.items()})
 
     def get_agent_vars_dataframe(self):
         """ Create a pandas DataFrame from the agent variables.
@@ -0,0 +1,165 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Fused evaluation of model reporters.
+#
+# The counting reporters read the population counters, but some reporters
+# still aggregate agent fields that change on every step (accumulated
+# values, contacts, times of the infected...), each with its own scan of
+# the schedule. A FusedReporter instead declares the aggregates it needs -
+# counts, sums or last values of agent fields over the agents whose fields
+# take some values, optionally grouped by grid cell or by the value of an
+# enum field such as the age group - and how to combine
+# them. evaluate collects the fields needed by any number of fused reporters
+# in a single pass over the agents (or takes the columns of the population
+# engine when the model has one) and computes all the aggregates with array
+# operations.
+from enum import Enum
+from operator import attrgetter
+
+import numpy as np
+
+
+def _code(value):
+    # Enum members are compared (and stored by the population engine) by value
+    return value.value if isinstance(value, Enum) else value
+
+
+class Aggregate:
+    """ count, sum or last value of an agent field.
+
+    Only the agents whose fields take one of the values listed in where
+    (a dict from field name to values) are aggregated. With by="pos", the
+    aggregate is computed per grid cell, as an array over all the cells.
+    by can also name an enum field (e.g. age_group), whose groups are the
+    values 0 to groups - 1 of its members; the aggregate is then an array
+    indexed by those values. default is the value when no agent matches.
+    """
+
+    KINDS = ("count", "sum", "last")
+
+    def __init__(self, kind, field=None, where=None, by=None, default=0, groups=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown aggregate {kind}")
+        if by not in (None, "pos") and groups is None:
+            raise ValueError(f"Aggregates grouped by {by} need the number of groups")
+        self.kind = kind
+        self.field = field
+        self.by = by
+        self.default = default
+        self.groups = groups
+        self.where = tuple(sorted((name, frozenset(_code(value) for value in values))
+                                  for name, values in (where or {}).items()))
+
+    def key(self):
+        return (self.kind, self.field, self.where, self.by, self.default, self.groups)
+
+    def fields(self):
+        names = {name for name, _ in self.where}
+        if self.field is not None:
+            names.add(self.field)
+        if self.by is not None:
+            names.add(self.by)
+        return names
+
+
+class FusedReporter:
+    """ Model reporter computed from aggregates over the agents.
+
+    aggregates maps names to Aggregate objects and finish(model, values)
+    returns the reported value from the values of the named aggregates.
+    """
+
+    def __init__(self, aggregates, finish):
+        self.aggregates = aggregates
+        self.finish = finish
+
+    def __call__(self, model):
+        return evaluate(model, [self])[0]
+
+
+def _agent_columns(model, fields):
+    # One pass over the agents, collecting the fields the aggregates need into arrays
+    agents = model.schedule.agents
+    columns = {}
+    data_fields = [name for name in fields if name not in ("stage", "pos")]
+    if data_fields:
+        getter = attrgetter(*data_fields)
+        values = [getter(agent.agent_data) for agent in agents]
+        if len(data_fields) == 1:
+            values = [(value,) for value in values]
+        for name, column in zip(data_fields, zip(*values)):
+            if column and isinstance(column[0], Enum):
+                # Kept as values, like the columns of the population engine
+                column = [member.value for member in column]
+            columns[name] = np.array(column)
+        for name in data_fields:
+            columns.setdefault(name, np.empty(0))
+    if "stage" in fields:
+        columns["stage"] = np.array([agent.stage.value for agent in agents], dtype=np.int64)
+    if "pos" in fields:
+        pos = np.array([agent.pos for agent in agents], dtype=np.int64).reshape(-1, 2)
+        columns["pos"] = pos[:, 0] * model.grid.height + pos[:, 1]
+    return columns, len(agents)
+
+
+def _evaluate_columns(column, size, num_cells, aggregates):
+    masks = {}
+    totals = []
+    for aggregate in aggregates:
+        mask = masks.get(aggregate.where)
+        if mask is None:
+            mask = np.ones(size, dtype=np.bool_)
+            for name, allowed in aggregate.where:
+                mask &= np.isin(column(name), list(allowed))
+            masks[aggregate.where] = mask
+        values = None if aggregate.kind == "count" else column(aggregate.field)[mask]
+        groups = num_cells if aggregate.by == "pos" else aggregate.groups
+
+        if aggregate.kind == "last":
+            if aggregate.by is not None:
+                # Agents are in schedule order, so the last write to a group wins
+                total = np.full(groups, aggregate.default, dtype=np.float64)
+                total[column(aggregate.by)[mask]] = values
+            else:
+                total = values[-1].item() if len(values) else aggregate.default
+        elif aggregate.by is not None:
+            total = np.bincount(column(aggregate.by)[mask], weights=values, minlength=groups)
+            if aggregate.kind == "count":
+                total = total.astype(np.int64)
+            total = total + aggregate.default
+        elif aggregate.kind == "count":
+            total = int(np.count_nonzero(mask)) + aggregate.default
+        else:
+            total = values.sum().item() + aggregate.default
+        totals.append(total)
+    return totals
+
+
+def evaluate(model, reporters):
+    """ Values of the fused reporters for the model, in the order given.
+
+    The aggregates of all reporters are computed together, each distinct
+    aggregate once.
+    """
+    aggregates = {}
+    for reporter in reporters:
+        for aggregate in reporter.aggregates.values():
+            aggregates.setdefault(aggregate.key(), aggregate)
+    unique = list(aggregates.values())
+
+    num_cells = model.grid.width * model.grid.height
+    population = getattr(model, "population", None)
+    if population is not None:
+        def column(name):
+            return population.cells() if name == "pos" else population.column(name)
+        totals = _evaluate_columns(column, population.size, num_cells, unique)
+    else:
+        columns, size = _agent_columns(model, set().union(*(aggregate.fields() for aggregate in unique)))
+        totals = _evaluate_columns(columns.__getitem__, size, num_cells, unique)
+    by_key = {aggregate.key(): total for aggregate, total in zip(unique, totals)}
+
+    return [reporter.finish(model, {name: by_key[aggregate.key()] for name, aggregate in reporter.aggregates.items()})
+            for reporter in reporters]
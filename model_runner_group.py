@@ -149,7 +149,10 @@ def runModelScenario(data,index,virus_data,filenames_list,is_checkpoint):
             "agent_storage": data["output"]["agent_storage"],
             "model_storage": data["output"]["model_storage"],
             "agent_increment":  data["output"]["agent_increment"],
-            "model_increment":  data["output"]["model_increment"]
+            "model_increment":  data["output"]["model_increment"],
+            #Agent checkpoints are streamed to files next to the agent save file while the runs progress.
+            "agent_save_file": data["output"]["agent_save_file"],
+            "agent_keep": data["output"].get("agent_keep")
         }
     # start from time 0
     else:
@@ -199,8 +202,12 @@ def runModelScenario(data,index,virus_data,filenames_list,is_checkpoint):
             "effectiveness": data["model"]["policies"]["vaccine_rollout"]["effectiveness"],
             "distribution_rate": data["model"]["policies"]["vaccine_rollout"]["distribution_rate"],
             "cost_per_vaccine":data["model"]["policies"]["vaccine_rollout"]["cost_per_vaccine"],
-            "vaccination_percent": data["model"]["policies"]["vaccine_rollout"]["vaccination_percent"]
+            "vaccination_percent": data["model"]["policies"]["vaccine_rollout"]["vaccination_percent"],
+            "population_engine": data["ensemble"].get("population_engine", False),
+            "collection": data["output"].get("collection")
         }
+
+    model_params["seed"] = data["ensemble"].get("seed")
    
     virus_param_list = []
     for virus in virus_data["variant"]:
@@ -265,22 +272,16 @@ def runModelScenario(data,index,virus_data,filenames_list,is_checkpoint):
 
     if is_checkpoint:
         model_ldfs = []
-        agent_ldfs = []
         time_A = timeit.default_timer()
         i = 0
         for cm in cm_runs.values():
             cm[0]["Iteration"] = i
-            cm[1]["Iteration"] = i
             model_ldfs.append(cm[0])
-            agent_ldfs.append(cm[1])
             i = i + 1
         model_dfs = pd.concat(model_ldfs)
-        agent_dfs = pd.concat(agent_ldfs)
         model_save_file = data["output"]["model_save_file"]
-        agent_save_file = data["output"]["agent_save_file"]
         #TODO-create the nomenclature for the nature of the save file for both model and agent data. (Very important for organizing test runs for different policy evaluations)
         model_dfs.to_csv(model_save_file)
-        agent_dfs.to_csv(agent_save_file)
         time_B = timeit.default_timer()
         return (time_B - time_A)
     else:
@@ -148,7 +148,12 @@ def runModelScenario(data, index,virus_data):
         "agent_storage": data["output"]["agent_storage"],
         "model_storage": data["output"]["model_storage"],
         "agent_increment":  data["output"]["agent_increment"],
-        "model_increment":  data["output"]["model_increment"]
+        "model_increment":  data["output"]["model_increment"],
+        #Agent checkpoints are streamed to files next to the agent save file while the runs progress.
+        "agent_save_file": data["output"]["agent_save_file"],
+        "agent_keep": data["output"].get("agent_keep"),
+        #Optionally, the population at every stored step also goes to a memory-mapped snapshot store per iteration.
+        "agent_snapshot_file": data["output"].get("agent_snapshot_file")
     }
     virus_param_list = []
     for virus in virus_data["variant"]:
@@ -188,26 +193,20 @@ def runModelScenario(data, index,virus_data):
     print("Saving results to file...")
 
     model_ldfs = []
-    agent_ldfs = []
 
 
     time_A = timeit.default_timer()
+    model_save_file = data["output"]["model_save_file"]
     i = 0
     for cm in cm_runs.values():
         cm[0]["Iteration"] = i
-        cm[1]["Iteration"] = i
         model_ldfs.append(cm[0])
-        agent_ldfs.append(cm[1])
         i = i + 1
 
     model_dfs = pd.concat(model_ldfs)
-    agent_dfs = pd.concat(agent_ldfs)
-    model_save_file = data["output"]["model_save_file"]
-    agent_save_file = data["output"]["agent_save_file"]
 
     #TODO-create the nomenclature for the nature of the save file for both model and agent data. (Very important for organizing test runs for different policy evaluations)
     model_dfs.to_csv(model_save_file)
-    agent_dfs.to_csv(agent_save_file)
     time_B = timeit.default_timer()
     return (time_B - time_A)
 
@@ -0,0 +1,886 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Columnar (struct-of-arrays) population engine for CovidModel.
+#
+# Instead of one CovidAgent object per person, all agent state lives in NumPy
+# column arrays and every stage transition of CovidAgent.step is applied as a
+# bulk masked update over the whole population. Agents are updated
+# synchronously: every branch sees the population as it was at the start of
+# the stage phase, whereas RandomActivation lets agents observe changes made
+# earlier in the same step.
+import uuid
+
+import numpy as np
+
+from covid_enums import Stage, AgeGroup, SexGroup, ValueGroup
+
+
+# Column names and types. The order follows AgentDataClass so that the
+# trace tuples written to the database line up with CovidAgent.step.
+COLUMNS = [
+    ("unique_id", np.int64),
+    ("stage", np.int8),
+    ("age_group", np.int8),
+    ("sex_group", np.int8),
+    ("vaccine_willingness", np.bool_),
+    ("incubation_time", np.int32),
+    ("dwelling_time", np.int32),
+    ("recovery_time", np.int32),
+    ("prob_contagion", np.float64),
+    ("mortality_value", np.float64),
+    ("severity_value", np.float64),
+    ("curr_dwelling", np.int32),
+    ("curr_incubation", np.int32),
+    ("curr_recovery", np.int32),
+    ("curr_asymptomatic", np.int32),
+    ("isolated", np.bool_),
+    ("isolated_but_inefficient", np.bool_),
+    ("test_chance", np.float64),
+    ("in_isolation", np.bool_),
+    ("in_distancing", np.bool_),
+    ("in_testing", np.bool_),
+    ("astep", np.int64),
+    ("tested", np.bool_),
+    ("occupying_bed", np.bool_),
+    ("cumul_private_value", np.float64),
+    ("cumul_public_value", np.float64),
+    ("employed", np.bool_),
+    ("tested_traced", np.bool_),
+    ("tracing_delay", np.int32),
+    ("tracing_counter", np.int32),
+    ("vaccinated", np.bool_),
+    ("safetymultiplier", np.float64),
+    ("current_effectiveness", np.float64),
+    ("vaccination_day", np.int64),
+    ("vaccine_count", np.int32),
+    ("dosage_eligible", np.bool_),
+    ("fully_vaccinated", np.bool_),
+    ("variant", np.int16),
+    ("pos_x", np.int32),
+    ("pos_y", np.int32),
+]
+
+# Fields of the agent trace, in the order used by Database.insert_agent
+TRACE_FIELDS = ["age_group", "sex_group", "vaccine_willingness", "incubation_time", "dwelling_time",
+                "recovery_time", "prob_contagion", "mortality_value", "severity_value", "curr_dwelling",
+                "curr_incubation", "curr_recovery", "curr_asymptomatic", "isolated", "isolated_but_inefficient",
+                "test_chance", "in_isolation", "in_distancing", "in_testing", "astep", "tested",
+                "occupying_bed", "cumul_private_value", "cumul_public_value", "employed", "tested_traced",
+                "tracing_delay", "tracing_counter", "vaccinated", "safetymultiplier", "current_effectiveness",
+                "vaccination_day", "vaccine_count", "dosage_eligible", "fully_vaccinated", "variant"]
+
+# Per-agent attributes drawn by PopulationFactory.draw
+DRAWN_FIELDS = ["age_group", "sex_group", "mortality_value", "vaccine_willingness", "incubation_time",
+                "dwelling_time", "recovery_time", "pos_x", "pos_y"]
+
+# Moore neighbourhood offsets, without the center
+MOORE_DX = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+MOORE_DY = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+SUSCEPTIBLE = Stage.SUSCEPTIBLE.value
+EXPOSED = Stage.EXPOSED.value
+ASYMPTOMATIC = Stage.ASYMPTOMATIC.value
+SYMPDETECTED = Stage.SYMPDETECTED.value
+ASYMPDETECTED = Stage.ASYMPDETECTED.value
+SEVERE = Stage.SEVERE.value
+RECOVERED = Stage.RECOVERED.value
+DECEASED = Stage.DECEASED.value
+
+
+class PopulationEngine:
+    """ Agent state stored as NumPy columns and stepped with bulk masked updates """
+
+    def __init__(self, model, capacity=1024):
+        self.model = model
+        self.size = 0
+        self.capacity = 0
+        self.columns = {}
+        # Contacts are only recorded while tracing is active, as sets of row indices
+        self.contacts = []
+        streams = model.streams
+        self.population_rng = streams.population.generator
+        self.movement_rng = streams.movement.generator
+        self.infection_rng = streams.infection.generator
+        self.testing_rng = streams.testing.generator
+        self.vaccination_rng = streams.vaccination.generator
+
+        md = model.model_data
+        self.variant_names = list(md.variant_data_list.keys())
+        if "Standard" not in self.variant_names:
+            self.variant_names.insert(0, "Standard")
+        self.variant_index = {name: i for i, name in enumerate(self.variant_names)}
+        self.variant_immune = np.zeros((0, len(self.variant_names)), dtype=np.bool_)
+
+        # Per-variant multipliers as arrays indexed by variant code
+        def variant_param(key, default):
+            return np.array([md.variant_data_list.get(name, {}).get(key, default) for name in self.variant_names])
+
+        self.contagion_multiplier = variant_param("Contagtion_Multiplier", 1.0).astype(np.float64)
+        self.vaccine_multiplier = variant_param("Vaccine_Multiplier", 1.0).astype(np.float64)
+        self.asymptomatic_multiplier = variant_param("Asymtpomatic_Multiplier", 1.0).astype(np.float64)
+        self.mortality_multiplier = variant_param("Mortality_Multiplier", 1.0).astype(np.float64)
+        self.reinfection = variant_param("Reinfection", False).astype(np.bool_)
+
+        # Cached per-cell aggregates and counter totals for the reporters; invalidated by any change
+        self._version = 0
+        self._cache_version = -1
+        self._cell_cache = None
+        self._counts_version = -1
+        self._counts = {}
+
+        self._reserve(capacity)
+
+    # Storage management
+
+    def _reserve(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, 2 * self.capacity, 16)
+        for name, dtype in COLUMNS:
+            column = np.zeros(capacity, dtype=dtype)
+            if name in self.columns:
+                column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+        immune = np.zeros((capacity, len(self.variant_names)), dtype=np.bool_)
+        immune[:self.size] = self.variant_immune[:self.size]
+        self.variant_immune = immune
+        self.capacity = capacity
+
+    def column(self, name):
+        """ View of the live part of a column """
+        return self.columns[name][:self.size]
+
+    def touch(self):
+        self._version += 1
+
+    def add(self, draws, stages, variant="Standard"):
+        """ Create the agents drawn by PopulationFactory.draw, in the given stage codes """
+        count = len(draws["age_group"])
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        model = self.model
+        md = model.model_data
+        start = self.size
+        self._reserve(start + count)
+        self.size = start + count
+        rows = np.arange(start, self.size)
+        c = self.columns
+
+        c["unique_id"][rows] = np.arange(model.i, model.i + count)
+        model.i = model.i + count
+        c["stage"][rows] = stages
+        for name in DRAWN_FIELDS:
+            c[name][rows] = draws[name]
+        c["prob_contagion"][rows] = md.prob_contagion_base
+        with np.errstate(divide="ignore"):
+            c["severity_value"][rows] = md.prob_severe / (md.dwell_15_day * c["recovery_time"][rows])
+        c["employed"][rows] = True
+        c["tracing_delay"][rows] = 2 * md.dwell_15_day
+        c["safetymultiplier"][rows] = 1
+        c["dosage_eligible"][rows] = True
+        c["variant"][rows] = self.variant_index[variant]
+        self.contacts.extend(set() for _ in range(count))
+        self.touch()
+
+        return rows
+
+    # Spatial helpers
+
+    def cells(self):
+        return self.column("pos_x") * self.model.grid.height + self.column("pos_y")
+
+    def occupancy(self, cells=None):
+        if cells is None:
+            cells = self.cells()
+        return np.bincount(cells, minlength=self.model.grid.width * self.model.grid.height)
+
+    def _cell_variant_counts(self, cells, mask):
+        # Number of agents satisfying mask per (cell, variant)
+        num_variants = len(self.variant_names)
+        num_cells = self.model.grid.width * self.model.grid.height
+        keys = cells[mask] * num_variants + self.column("variant")[mask]
+        counts = np.bincount(keys, minlength=num_cells * num_variants)
+        return counts.reshape(num_cells, num_variants)
+
+    def interactants_all(self):
+        """ Vectorised equivalent of CovidAgent.interactants for every agent """
+        if self._cache_version != self._version:
+            cells = self.cells()
+            free = np.bincount(cells, weights=~self.column("isolated"),
+                               minlength=self.model.grid.width * self.model.grid.height)
+            occupancy = self.occupancy(cells)
+            stage = self.column("stage")
+            counts = np.where(self.column("isolated_but_inefficient"), occupancy[cells] - 1,
+                              free[cells] - ~self.column("isolated"))
+            counts[(stage == DECEASED) | (stage == RECOVERED)] = 0
+            self._cell_cache = (cells, occupancy, free, counts)
+            self._cache_version = self._version
+        return self._cell_cache[3]
+
+    def counter_totals(self):
+        """ Bulk equivalent of the keys of CovidAgent.counter_keys, as used by PopulationCounters """
+        if self._counts_version == self._version:
+            return self._counts
+
+        stage = self.column("stage")
+        variant = self.column("variant")
+        age = self.column("age_group")
+        vaccine_count = self.column("vaccine_count")
+        vaccinated = self.column("vaccinated")
+        willing = self.column("vaccine_willingness")
+        roaming = (stage == SUSCEPTIBLE) | (stage == EXPOSED) | (stage == ASYMPTOMATIC)
+        counts = {}
+
+        def tally(prefix, codes, decode, mask=None):
+            # Count the rows (optionally restricted to mask) per value of codes
+            if mask is not None:
+                codes = codes[mask]
+            if codes.size == 0:
+                return
+            codes = codes.astype(np.int64)
+            offset = codes.min()
+            for code, total in enumerate(np.bincount(codes - offset), start=offset):
+                if total:
+                    counts[(prefix,) + decode(code)] = int(total)
+
+        num_variants = len(self.variant_names)
+        num_counts = int(vaccine_count.max()) + 1 if self.size else 1
+        as_stage = lambda code: (Stage(code),)
+        as_age = lambda code: (AgeGroup(code),)
+        tally("stage", stage, as_stage)
+        tally("variant", variant, lambda code: (self.variant_names[code],))
+        tally("stage_variant", stage.astype(np.int64) * num_variants + variant,
+              lambda code: (Stage(code // num_variants), self.variant_names[code % num_variants]))
+        tally("age", age, as_age)
+        tally("vaccine_count", vaccine_count, lambda code: (code,))
+        tally("age_vaccine_count", age.astype(np.int64) * num_counts + vaccine_count,
+              lambda code: (AgeGroup(code // num_counts), code % num_counts))
+        tally("vaccinated_age", age, as_age, vaccinated)
+        tally("vaccinated_stage", stage, as_stage, vaccinated)
+        tally("fully_vaccinated_age", age, as_age, self.column("fully_vaccinated"))
+        tally("eligible_age", age, as_age, willing & self.column("dosage_eligible") & roaming)
+        counts[("dosage_eligible_willing",)] = int(np.count_nonzero(willing & self.column("dosage_eligible") & (stage != DECEASED)))
+        for key, name in (("vaccinated",), "vaccinated"), (("isolated",), "isolated"), (("employed",), "employed"), \
+                (("tested",), "tested"), (("traced",), "tested_traced"), (("willing",), "vaccine_willingness"):
+            counts[key] = int(np.count_nonzero(self.column(name)))
+
+        self._counts = counts
+        self._counts_version = self._version
+        return counts
+
+    # Stepping
+
+    def step(self):
+        """ Bulk equivalent of calling CovidAgent.step on every agent """
+        n = self.size
+        if n == 0:
+            return
+
+        model = self.model
+        md = model.model_data
+        rng = self.population_rng
+        c = {name: column[:n] for name, column in self.columns.items()}
+        immune = self.variant_immune[:n]
+        astep = c["astep"]
+        dwell_day = md.dwell_15_day
+        # Deceased agents are passive: they only accrue the value of their stage
+        live = c["stage"] != DECEASED
+
+        # Employment: loss is four times likelier when isolated, re-employment is rare
+        loss_chance = np.where(c["isolated"], 32*0.00018/dwell_day, 8*0.00018/dwell_day)
+        c["employed"][live & c["employed"] & (rng.random(n) < loss_chance)] = False
+        c["employed"][live & ~c["employed"] & (rng.random(n) < 0.000018/dwell_day)] = True
+
+        # Social distancing
+        mask = live & ~c["in_distancing"] & (astep >= md.distancing_start)
+        c["prob_contagion"][mask] = self.dmult() * md.prob_contagion_base
+        c["in_distancing"][mask] = True
+        mask = live & c["in_distancing"] & (astep >= md.distancing_end)
+        c["prob_contagion"][mask] = md.prob_contagion_base
+        c["in_distancing"][mask] = False
+
+        # Testing
+        mask = live & ~c["in_testing"] & (astep >= md.testing_start)
+        c["test_chance"][mask] = md.testing_rate
+        c["in_testing"][mask] = True
+        mask = live & c["in_testing"] & (astep >= md.testing_end)
+        c["test_chance"][mask] = 0
+        c["in_testing"][mask] = False
+
+        if md.vaccination_now:
+            self._vaccinate(c)
+
+        # Self isolation only applies to susceptibles, incubating and asymptomatics
+        stage = c["stage"]
+        roaming = (stage == SUSCEPTIBLE) | (stage == EXPOSED) | (stage == ASYMPTOMATIC)
+        pending = ~c["in_isolation"] & roaming
+        start = pending & (astep >= md.isolation_start)
+        c["isolated"][start] = rng.random(np.count_nonzero(start)) < md.isolation_rate
+        after = pending & ~start & (astep >= md.isolation_end)
+        c["isolated"][after] = rng.random(np.count_nonzero(after)) < md.after_isolation
+        c["in_isolation"][start | after] = True
+        release = c["in_isolation"] & (astep >= md.isolation_end) & roaming
+        c["isolated"][release] = False
+        c["in_isolation"][release] = False
+
+        self._update_effectiveness(c, live)
+
+        # Stage transitions, every agent follows the branch of the stage it started in
+        start_stage = stage.copy()
+        cells = self.cells()
+        occupancy = self.occupancy(cells)
+        movers = np.zeros(n, dtype=np.bool_)
+
+        # Contagious occupants per cell and variant, as seen by every agent this step
+        symptomatic = start_stage == SYMPDETECTED
+        contagious = (self._cell_variant_counts(cells, symptomatic),
+                      self._cell_variant_counts(cells, start_stage == ASYMPTOMATIC),
+                      self._cell_variant_counts(cells, symptomatic & self.reinfection[c["variant"]]))
+        # Rows of the contagious occupants of either kind, and of the asymptomatic ones
+        asymptomatic = start_stage == ASYMPTOMATIC
+        contagious_rows = (np.flatnonzero(symptomatic | asymptomatic), np.flatnonzero(asymptomatic))
+
+        self._step_susceptible(c, immune, start_stage == SUSCEPTIBLE, cells, occupancy, contagious,
+                               contagious_rows, movers)
+        self._step_exposed(c, start_stage == EXPOSED, cells, occupancy, movers)
+        self._step_asymptomatic(c, immune, start_stage == ASYMPTOMATIC, cells, occupancy, movers)
+        self._step_detected(c, immune, start_stage == SYMPDETECTED, start_stage == ASYMPDETECTED)
+        self._step_severe(c, immune, start_stage == SEVERE)
+        self._step_recovered(c, immune, start_stage == RECOVERED, cells, occupancy, contagious,
+                             contagious_rows, movers)
+        self._accrue_fixed(c, start_stage == DECEASED, Stage.DECEASED)
+
+        self._move(c, movers)
+        self._insert_traces(c)
+
+        astep += 1
+        self.touch()
+
+    def dmult(self):
+        # Same sigmoid aerosol multiplier as CovidAgent.dmult
+        distancing = self.model.model_data.distancing
+        if distancing >= 1.5:
+            k = 10
+            return 1.0 - (1.0 / (1.0 + np.exp(k*(-(distancing - 1.5) + 0.5))))
+        return 1.0
+
+    def _vaccinate(self, c):
+        model = self.model
+        md = model.model_data
+        rng = self.vaccination_rng
+        n = self.size
+        stage = c["stage"]
+        age = c["age_group"]
+
+        candidates = (~c["vaccinated"] | c["dosage_eligible"]) & ~c["fully_vaccinated"] & \
+            (c["vaccine_count"] < md.vaccine_dosage)
+        if not candidates.any():
+            return
+
+        # general_vaccination_chance: one in the size of the agent's age group
+        group_count = np.bincount(age, minlength=len(AgeGroup))
+        chance = 1 / group_count[age]
+        roaming = (stage == SUSCEPTIBLE) | (stage == EXPOSED) | (stage == ASYMPTOMATIC)
+        drawn = candidates & roaming & (rng.random(n) < chance)
+        if not drawn.any():
+            return
+
+        chosen = drawn & (age == md.vaccination_stage.value) & c["vaccine_willingness"]
+        chosen = rng.permutation(np.flatnonzero(chosen))[:max(int(md.vaccine_count), 0)]
+
+        # About one in ten does not show up and the dose goes to another eligible agent
+        no_show = rng.random(chosen.size) < 0.1
+        recipients = chosen[~no_show]
+        if no_show.any():
+            pool = c["dosage_eligible"] & c["vaccine_willingness"] & ~c["fully_vaccinated"] & (stage != DECEASED)
+            pool[recipients] = False
+            pool = np.flatnonzero(pool)
+            replacements = rng.choice(pool, size=min(no_show.sum(), pool.size), replace=False)
+            recipients = np.concatenate([recipients, replacements])
+
+        c["vaccinated"][recipients] = True
+        c["vaccination_day"][recipients] = model.stepno
+        c["vaccine_count"][recipients] += 1
+        c["dosage_eligible"][recipients] = False
+        md.vaccine_count = md.vaccine_count - recipients.size
+        md.vaccinated_count = md.vaccinated_count + recipients.size
+
+        self.update_vaccination_stage()
+
+    def update_vaccination_stage(self):
+        self.model.vaccination.update()
+
+    def _update_effectiveness(self, c, live):
+        md = self.model.model_data
+        vaccination_time = self.model.stepno - c["vaccination_day"]
+        # The vaccine is assumed to reach its effectiveness two weeks after each dose
+        effective_date = md.dwell_15_day * 14
+
+        ramping = live & (vaccination_time < effective_date) & c["vaccinated"]
+        c["safetymultiplier"][ramping] = 1 - md.effectiveness_per_dosage * (vaccination_time[ramping] / effective_date) - \
+            c["current_effectiveness"][ramping]
+
+        settled = live & ~ramping
+        c["current_effectiveness"][settled] = md.effectiveness_per_dosage * c["vaccine_count"][settled]
+        c["safetymultiplier"][settled] = 1 - c["current_effectiveness"][settled] * \
+            self.vaccine_multiplier[c["variant"][settled]]
+
+        short = settled & (c["vaccine_count"] < md.vaccine_dosage)
+        c["dosage_eligible"][short] = True
+        completed = settled & ~short & ~c["fully_vaccinated"]
+        c["dosage_eligible"][completed] = False
+        c["fully_vaccinated"][completed] = True
+        md.fully_vaccinated_count = md.fully_vaccinated_count + int(completed.sum())
+
+    def _accrue_interactions(self, c, mask, cells, occupancy, stage):
+        # Value produced by interacting with cellmates, reduced while isolated
+        md = self.model.model_data
+        private = md.stage_value_dist[ValueGroup.PRIVATE][stage]
+        public = md.stage_value_dist[ValueGroup.PUBLIC][stage]
+
+        employed = mask & c["employed"]
+        cellmates = occupancy[cells[employed]] - 1
+        isolated = c["isolated"][employed]
+        c["cumul_private_value"][employed] += cellmates * private * np.where(isolated, 0.3, 1)
+        c["cumul_public_value"][employed] += cellmates * public * np.where(isolated, 0.01, 1)
+        c["cumul_public_value"][mask & ~c["employed"]] -= 2*public
+
+    def _accrue_fixed(self, c, mask, stage):
+        md = self.model.model_data
+        c["cumul_private_value"][mask] += md.stage_value_dist[ValueGroup.PRIVATE][stage]
+        c["cumul_public_value"][mask] += md.stage_value_dist[ValueGroup.PUBLIC][stage]
+
+    def _test(self, c, mask):
+        # Agents not tested yet are tested with their current test chance
+        md = self.model.model_data
+        untested = mask & ~(c["tested"] | c["tested_traced"])
+        tested = untested & (self.testing_rng.random(self.size) < c["test_chance"])
+        c["tested"][tested] = True
+        md.cumul_test_cost = md.cumul_test_cost + md.test_cost * int(tested.sum())
+        return tested
+
+    def _draw_contacts(self, rows, cells, immune, symptomatic, asymptomatic):
+        # For each row: 1 for contact with a symptomatic, 2 for an asymptomatic only,
+        # 0 otherwise, together with the variant drawn in proportion to the contagious counts
+        contact = np.zeros(rows.size, dtype=np.int8)
+        variant = np.zeros(rows.size, dtype=np.int16)
+        if rows.size == 0:
+            return contact, variant
+
+        for kind, counts in ((2, asymptomatic), (1, symptomatic)):
+            weights = counts[cells[rows]] * ~immune[rows]
+            total = weights.sum(axis=1)
+            found = total > 0
+            if not found.any():
+                continue
+            cumulative = np.cumsum(weights[found], axis=1)
+            target = self.infection_rng.random(found.sum()) * total[found]
+            variant[found] = (cumulative <= target[:, None]).sum(axis=1)
+            contact[found] = kind
+
+        return contact, variant
+
+    def _trace_contacts(self, rows, cells, immune, contagious):
+        # Record contacts of the given rows with the contagious cellmates whose variant
+        # can infect them (as CovidAgent.step does) while tracing is active
+        if not self.model.model_data.tracing_now or contagious.size == 0 or rows.size == 0:
+            return
+        order = contagious[np.argsort(cells[contagious], kind="stable")]
+        sorted_cells = cells[order]
+        variant = self.column("variant")
+        for row in rows:
+            lo = np.searchsorted(sorted_cells, cells[row], side="left")
+            hi = np.searchsorted(sorted_cells, cells[row], side="right")
+            others = order[lo:hi]
+            for other in others[~immune[row, variant[others]]]:
+                self.contacts[other].add(row)
+
+    def _expose(self, c, rows, contact, variant, count_infection):
+        md = self.model.model_data
+        rng = self.infection_rng
+        hit = contact > 0
+        rows, contact, variant = rows[hit], contact[hit], variant[hit]
+
+        isolated = c["isolated"][rows]
+        leaky = isolated & (rng.random(rows.size) < 1 - md.prob_isolation_effective)
+        c["isolated_but_inefficient"][rows[leaky]] = True
+
+        prob = c["prob_contagion"][rows] * self.contagion_multiplier[variant]
+        prob = np.where(c["vaccinated"][rows], prob * c["safetymultiplier"][rows], prob)
+        prob = np.where(contact == 2, prob * 0.42, prob)
+
+        infected = rng.random(rows.size) < prob
+        infected &= ~isolated | ~(rng.random(rows.size) < md.prob_isolation_effective)
+        c["stage"][rows[infected]] = EXPOSED
+        c["variant"][rows[infected]] = variant[infected]
+        if count_infection:
+            md.generally_infected = md.generally_infected + int(infected.sum())
+
+    def _step_susceptible(self, c, immune, mask, cells, occupancy, contagious, contagious_rows, movers):
+        self._test(c, mask)
+
+        symptomatic, asymptomatic, _ = contagious
+        rows = np.flatnonzero(mask)
+        contact, variant = self._draw_contacts(rows, cells, immune, symptomatic, asymptomatic)
+        # Any contact traces the contagious cellmates of both kinds
+        self._trace_contacts(rows[contact > 0], cells, immune, contagious_rows[0])
+
+        self._accrue_interactions(c, mask, cells, occupancy, Stage.SUSCEPTIBLE)
+        isolated = c["isolated"].copy()
+        self._expose(c, rows, contact, variant, True)
+        movers |= mask & ~isolated
+
+    def _step_exposed(self, c, mask, cells, occupancy, movers):
+        md = self.model.model_data
+        rng = self.infection_rng
+        self._accrue_interactions(c, mask, cells, occupancy, Stage.EXPOSED)
+
+        prob_asymptomatic = md.prob_asymptomatic * self.asymptomatic_multiplier[c["variant"]]
+        prob_asymptomatic = np.where(c["vaccinated"], 1 - (1 - md.prob_asymptomatic) * c["safetymultiplier"],
+                                     prob_asymptomatic)
+        asymptomatic = rng.random(self.size) < prob_asymptomatic
+        do_move = mask.copy()
+
+        tested = self._test(c, mask)
+        c["stage"][tested & asymptomatic] = ASYMPDETECTED
+        c["stage"][tested & ~asymptomatic] = SYMPDETECTED
+        do_move[tested & ~asymptomatic] = False
+
+        waiting = mask & ~tested
+        incubating = waiting & (c["curr_incubation"] < c["incubation_time"])
+        c["curr_incubation"][incubating] += 1
+        onset = waiting & ~incubating
+        c["stage"][onset & asymptomatic] = ASYMPTOMATIC
+        c["stage"][onset & ~asymptomatic] = SYMPDETECTED
+        do_move[onset & ~asymptomatic] = False
+
+        movers |= do_move & ~c["isolated"]
+
+    def _step_asymptomatic(self, c, immune, mask, cells, occupancy, movers):
+        self._accrue_interactions(c, mask, cells, occupancy, Stage.ASYMPTOMATIC)
+
+        tested = self._test(c, mask)
+        c["stage"][tested] = ASYMPDETECTED
+
+        recovered = mask & (c["curr_recovery"] >= c["recovery_time"])
+        self._recover(c, immune, recovered)
+        c["curr_recovery"][mask & ~recovered] += 1
+
+        movers |= mask & ~c["isolated"]
+
+    def _step_detected(self, c, immune, symptomatic, asymptomatic):
+        md = self.model.model_data
+        mask = symptomatic | asymptomatic
+        c["isolated"][mask] = True
+        c["tested"][symptomatic] = True
+
+        # Contact tracing: a negative counter indicates trace exhaustion
+        if md.tracing_now:
+            tracing = mask & (c["tracing_counter"] >= 0)
+            due = tracing & (c["tracing_counter"] == c["tracing_delay"])
+            c["tracing_counter"][tracing & ~due] += 1
+            c["tracing_counter"][due] = -1
+            traced = set()
+            for row in np.flatnonzero(due):
+                traced |= self.contacts[row]
+            self._test_contact_trace(c, np.fromiter(traced, dtype=np.int64, count=len(traced)))
+
+        self._accrue_fixed(c, symptomatic, Stage.SYMPDETECTED)
+        self._accrue_fixed(c, asymptomatic, Stage.ASYMPDETECTED)
+
+        ill = mask & (c["curr_incubation"] + c["curr_recovery"] < c["incubation_time"] + c["recovery_time"])
+        c["curr_recovery"][ill] += 1
+        severe_chance = c["mortality_value"] * self.mortality_multiplier[c["variant"]] / md.dwell_15_day
+        severe_chance = np.where(c["vaccinated"], severe_chance * c["safetymultiplier"], severe_chance)
+        c["stage"][symptomatic & ill & (self.infection_rng.random(self.size) < severe_chance)] = SEVERE
+        self._recover(c, immune, mask & ~ill)
+
+    def _test_contact_trace(self, c, rows):
+        # Bulk CovidAgent.test_contact_trace
+        md = self.model.model_data
+        stage = c["stage"][rows]
+        susceptible = rows[stage == SUSCEPTIBLE]
+        exposed = rows[stage == EXPOSED]
+        asymptomatic = rows[stage == ASYMPTOMATIC]
+
+        c["tested_traced"][susceptible] = True
+        c["tested_traced"][exposed] = True
+        c["stage"][exposed] = np.where(self.infection_rng.random(exposed.size) < md.prob_asymptomatic,
+                                       ASYMPDETECTED, SYMPDETECTED)
+        c["stage"][asymptomatic] = ASYMPDETECTED
+        c["tested_traced"][asymptomatic] = True
+
+    def _step_severe(self, c, immune, mask):
+        md = self.model.model_data
+        self._accrue_fixed(c, mask, Stage.SEVERE)
+
+        # Severe patients are in ICU facilities while beds are available
+        ill = mask & (c["curr_recovery"] < c["recovery_time"])
+        waiting = np.flatnonzero(ill & ~c["occupying_bed"])
+        beds = max(int(md.bed_count), 0)
+        admitted = self.infection_rng.permutation(waiting)[:beds]
+        c["occupying_bed"][admitted] = True
+        md.bed_count = md.bed_count - admitted.size
+
+        unattended = ill & ~c["occupying_bed"]
+        with np.errstate(divide="ignore"):
+            death_chance = 1 / c["recovery_time"]
+        c["stage"][unattended & (self.infection_rng.random(self.size) < death_chance)] = DECEASED
+        c["curr_recovery"][ill] += 1
+
+        recovered = mask & ~ill
+        self._recover(c, immune, recovered)
+        freed = recovered & c["occupying_bed"]
+        c["occupying_bed"][freed] = False
+        md.bed_count = md.bed_count + int(freed.sum())
+
+    def _step_recovered(self, c, immune, mask, cells, occupancy, contagious, contagious_rows, movers):
+        self._accrue_interactions(c, mask, cells, occupancy, Stage.RECOVERED)
+
+        # A recovered agent can now move freely within the grid again
+        c["curr_recovery"][mask] = 0
+        c["isolated"][mask] = False
+        c["isolated_but_inefficient"][mask] = False
+
+        # Symptomatic reinfection is limited to variants that allow it
+        _, asymptomatic, symptomatic = contagious
+        rows = np.flatnonzero(mask)
+        contact, variant = self._draw_contacts(rows, cells, immune, symptomatic, asymptomatic)
+        # Only a contact with asymptomatics alone traces them
+        self._trace_contacts(rows[contact == 2], cells, immune, contagious_rows[1])
+        self._expose(c, rows, contact, variant, False)
+
+        movers |= mask
+
+    def _recover(self, c, immune, mask):
+        rows = np.flatnonzero(mask)
+        c["stage"][rows] = RECOVERED
+        immune[rows, c["variant"][rows]] = True
+
+    def _move(self, c, movers):
+        # If dwelling has not been exhausted, do not move
+        rows = np.flatnonzero(movers)
+        dwelling = c["curr_dwelling"]
+        waiting = dwelling[rows] > 0
+        dwelling[rows[waiting]] -= 1
+
+        # Otherwise move to a random Moore neighbour and replenish the dwell
+        rows = rows[~waiting]
+        if rows.size == 0:
+            return
+        grid = self.model.grid
+        direction = self.movement_rng.integers(len(MOORE_DX), size=rows.size)
+        c["pos_x"][rows] = (c["pos_x"][rows] + MOORE_DX[direction]) % grid.width
+        c["pos_y"][rows] = (c["pos_y"][rows] + MOORE_DY[direction]) % grid.height
+        dwelling[rows] = self.model.streams.movement.poissons(self.model.model_data.avg_dwell, rows.size)
+
+    def _insert_traces(self, c):
+        # One bulk insert per step instead of one per agent
+        db = self.model.db
+        if db is None:
+            return
+        values = []
+        for name in TRACE_FIELDS:
+            column = c[name].tolist()
+            if name == "variant":
+                column = [self.variant_names[v] for v in column]
+            values.append(column)
+        ids = [str(uuid.uuid4()) for _ in range(self.size)]
+        run = self.model.run_id
+        iteration = self.model.iteration
+        step = self.model.stepno
+        keys = [(run, iteration, step, agent) for agent in c["unique_id"].tolist()]
+        db.insert_agent(list(zip(ids, *values)), keys)
+
+
+class PopulationAgentData:
+    """ AgentDataClass-like view on one row of a PopulationEngine """
+
+    __slots__ = ("_population", "_row")
+
+    def __init__(self, population, row):
+        object.__setattr__(self, "_population", population)
+        object.__setattr__(self, "_row", row)
+
+    def __getattr__(self, name):
+        population = self._population
+        row = self._row
+        if name == "variant_immune":
+            immune = population.variant_immune[row]
+            return {variant: bool(immune[i]) for i, variant in enumerate(population.variant_names)}
+        if name == "contacts":
+            return {PopulationAgent(population, other): None for other in sorted(population.contacts[row])}
+        if name not in population.columns:
+            raise AttributeError(name)
+
+        value = population.columns[name][row].item()
+        if name == "age_group":
+            return AgeGroup(value)
+        if name == "sex_group":
+            return SexGroup(value)
+        if name == "variant":
+            return population.variant_names[value]
+        if name == "stage":
+            return Stage(value)
+        return value
+
+    def __setattr__(self, name, value):
+        population = self._population
+        row = self._row
+        if name == "variant_immune":
+            for variant, immune in value.items():
+                population.variant_immune[row, population.variant_index[variant]] = immune
+        elif name == "variant":
+            population.columns[name][row] = population.variant_index[value]
+        elif name in population.columns:
+            if hasattr(value, "value"):
+                value = value.value
+            population.columns[name][row] = value
+        else:
+            raise AttributeError(name)
+        population.touch()
+
+
+class PopulationAgent:
+    """ CovidAgent-like view on one row of a PopulationEngine, used by the reporters """
+
+    __slots__ = ("_population", "_row", "agent_data")
+
+    def __init__(self, population, row):
+        self._population = population
+        self._row = row
+        self.agent_data = PopulationAgentData(population, row)
+
+    def __eq__(self, other):
+        return isinstance(other, PopulationAgent) and other._population is self._population and \
+            other._row == self._row
+
+    def __hash__(self):
+        return hash((id(self._population), self._row))
+
+    @property
+    def unique_id(self):
+        return int(self._population.columns["unique_id"][self._row])
+
+    @property
+    def stage(self):
+        return Stage(int(self._population.columns["stage"][self._row]))
+
+    @stage.setter
+    def stage(self, value):
+        self._population.columns["stage"][self._row] = value.value
+        self._population.touch()
+
+    @property
+    def pos(self):
+        return (int(self._population.columns["pos_x"][self._row]),
+                int(self._population.columns["pos_y"][self._row]))
+
+    def is_contagious(self):
+        return self.stage in (Stage.EXPOSED, Stage.ASYMPTOMATIC, Stage.SYMPDETECTED)
+
+    def is_vaccinated(self):
+        return self.agent_data.vaccinated
+
+    def interactants(self):
+        return int(self._population.interactants_all()[self._row])
+
+
+class PopulationSchedule:
+    """ Scheduler stand-in that steps a PopulationEngine in bulk """
+
+    def __init__(self, model, population):
+        self.model = model
+        self.population = population
+        self.steps = 0
+        self.time = 0
+
+    def add(self, agent):
+        raise TypeError("Agents are created through PopulationEngine.add when the population engine is enabled")
+
+    def step(self):
+        self.population.step()
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        return self.population.size
+
+    @property
+    def agents(self):
+        return [PopulationAgent(self.population, row) for row in range(self.population.size)]
+
+
+class PopulationFactory:
+    """ Draws the attributes of new agents in bulk.
+
+    Demographics, willingness, fixed times and positions of a whole batch of
+    agents are drawn with a few array operations on the population stream,
+    for CovidAgent objects and PopulationEngine rows alike.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        md = model.model_data
+        self.age_codes = np.array([ag.value for ag in AgeGroup])
+        self.sex_codes = np.array([sg.value for sg in SexGroup])
+        # Mortality indexed by age and sex code
+        self.mortality = np.zeros((self.age_codes.max() + 1, self.sex_codes.max() + 1), dtype=np.float64)
+        for ag in AgeGroup:
+            for sg in SexGroup:
+                self.mortality[ag.value, sg.value] = md.age_mortality[ag] * md.sex_mortality[sg]
+
+    def initial_groups(self, num_agents):
+        # Age and sex codes of the initial population, split according to the distributions
+        md = self.model.model_data
+        ages = []
+        sexes = []
+        for ag in md.age_distribution:
+            for sg in md.sex_distribution:
+                r = md.age_distribution[ag]*md.sex_distribution[sg]
+                count = int(round(num_agents*r))
+                ages.append(np.full(count, ag.value, dtype=np.int64))
+                sexes.append(np.full(count, sg.value, dtype=np.int64))
+        if not ages:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(ages), np.concatenate(sexes)
+
+    def random_groups(self, count):
+        # Uniformly drawn age and sex codes
+        stream = self.model.streams.population
+        return self.age_codes[stream.randranges(len(AgeGroup), count)], \
+            self.sex_codes[stream.randranges(len(SexGroup), count)]
+
+    def ingress_groups(self, count):
+        # Age codes drawn from a Poisson distribution centered at the mean age of the incoming
+        # population (redrawing those outside the age groups), sex codes drawn uniformly
+        stream = self.model.streams.population
+        mean = self.model.model_data.new_agent_age_mean
+        ages = stream.poissons(mean, count)
+        outside = np.flatnonzero(ages > self.age_codes.max())
+        while outside.size > 0:
+            ages[outside] = stream.poissons(mean, outside.size)
+            outside = outside[ages[outside] > self.age_codes.max()]
+        return ages, self.sex_codes[stream.randranges(len(SexGroup), count)]
+
+    def draw(self, ages, sexes):
+        """ Per-agent attributes (DRAWN_FIELDS) of agents with the given age and sex codes """
+        model = self.model
+        md = model.model_data
+        stream = model.streams.population
+        count = len(ages)
+        return {
+            "age_group": ages,
+            "sex_group": sexes,
+            "mortality_value": self.mortality[ages, sexes],
+            "vaccine_willingness": stream.bernoullis(md.vaccinated_percent, count),
+            "incubation_time": stream.poissons(md.avg_incubation, count),
+            "dwelling_time": stream.poissons(md.avg_dwell, count),
+            "recovery_time": stream.poissons(md.avg_recovery, count),
+            "pos_x": stream.randranges(model.grid.width, count),
+            "pos_y": stream.randranges(model.grid.height, count),
+        }
@@ -0,0 +1,75 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Incrementally maintained population counters.
+#
+# Most model reporters count agents satisfying some property (being in a
+# stage, carrying a variant, being vaccinated in an age group...). Instead of
+# scanning the whole schedule for every reporter on every step, each agent
+# declares the counter keys it currently contributes to (CovidAgent.counter_keys)
+# and notifies the registry whenever one of the underlying properties changes.
+# The registry then only adjusts the keys that differ, and reporters read their
+# counts in constant time.
+
+
+class PopulationCounters:
+
+    def __init__(self):
+        # key tuple -> number of agents
+        self.counts = {}
+        # agent -> key tuple it is currently counted under
+        self.entries = {}
+        # Optional bulk source (the population engine) providing all the counts at once
+        self.source = None
+        # key prefix -> callbacks run when a count under that prefix changes
+        self.watchers = {}
+
+    def watch(self, prefix, callback):
+        self.watchers.setdefault(prefix, []).append(callback)
+
+    def _notify(self, keys):
+        for prefix in {key[0] for key in keys if key[0] in self.watchers}:
+            for callback in self.watchers[prefix]:
+                callback()
+
+    def add(self, agent):
+        keys = agent.counter_keys()
+        self.entries[agent] = keys
+        counts = self.counts
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        if self.watchers:
+            self._notify(keys)
+
+    def remove(self, agent):
+        keys = self.entries.pop(agent, None)
+        if keys is None:
+            return
+        counts = self.counts
+        for key in keys:
+            counts[key] -= 1
+        if self.watchers:
+            self._notify(keys)
+
+    def update(self, agent):
+        old = self.entries.get(agent)
+        if old is None:
+            return
+        new = agent.counter_keys()
+        if new == old:
+            return
+        self.entries[agent] = new
+        counts = self.counts
+        for key in old:
+            counts[key] -= 1
+        for key in new:
+            counts[key] = counts.get(key, 0) + 1
+        if self.watchers:
+            self._notify(set(old).symmetric_difference(new))
+
+    def count(self, *key):
+        if self.source is not None:
+            self.counts = self.source.counter_totals()
+        return self.counts.get(key, 0)
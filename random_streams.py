@@ -0,0 +1,133 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Seedable random number streams for CovidModel.
+#
+# A run is driven by a single seed. From it we derive one independent
+# numpy Generator per concern (movement, infection, testing, vaccination and
+# population creation), so that for instance a change in how many movement
+# draws happen does not shift the infection draws. Scalar draws are served
+# from pre-drawn blocks to amortise the cost of calling into numpy, and
+# Poisson variates (dwell, incubation and recovery times) are obtained by
+# inverting a CDF table that is built once per mean.
+from bisect import bisect_right
+import math
+
+import numpy as np
+
+
+# One stream per concern; the order fixes the spawn keys and must not change
+STREAM_NAMES = ("movement", "infection", "testing", "vaccination", "population")
+
+# Number of variates drawn in one go when a block runs out
+BLOCK_SIZE = 4096
+
+
+class PoissonTable:
+    """ Inverse CDF sampler for a Poisson distribution of a fixed mean.
+
+    The table covers the mean plus twelve standard deviations; the mass left
+    out is far below the resolution of a double precision uniform.
+    """
+
+    def __init__(self, mu):
+        self.mu = mu
+        upper = int(math.ceil(mu + 12 * math.sqrt(mu) + 12))
+        k = np.arange(upper + 1)
+        # Work in log space, so large means (incubation and recovery are counted
+        # in steps) do not underflow exp(-mu)
+        if mu > 0:
+            logpmf = k * math.log(mu) - mu - np.array([math.lgamma(i + 1) for i in k])
+            cdf = np.cumsum(np.exp(logpmf))
+        else:
+            cdf = np.ones(upper + 1)
+        self.cdf = cdf / cdf[-1]
+        self.cdf_list = self.cdf.tolist()
+        self.last = upper
+
+    def sample(self, u):
+        # Smallest k with u < CDF(k)
+        return min(bisect_right(self.cdf_list, u), self.last)
+
+    def samples(self, u):
+        return np.minimum(np.searchsorted(self.cdf, u, side="right"), self.last)
+
+
+# mean -> PoissonTable, shared by all streams
+_poisson_tables = {}
+
+
+def poisson_table(mu):
+    table = _poisson_tables.get(mu)
+    if table is None:
+        table = PoissonTable(mu)
+        _poisson_tables[mu] = table
+    return table
+
+
+def derive_seed(seed, *keys):
+    # Deterministically derive an integer seed for a sub-run (e.g. an iteration
+    # of a batch run) from a base seed and a tuple of integer keys
+    sequence = np.random.SeedSequence(seed, spawn_key=keys)
+    return int(sequence.generate_state(1, np.uint64)[0])
+
+
+class RandomStream:
+
+    def __init__(self, generator, block_size=BLOCK_SIZE):
+        self.generator = generator
+        self.block_size = block_size
+        self._uniforms = []
+        self._next_uniform = 0
+
+    def uniform(self):
+        if self._next_uniform >= len(self._uniforms):
+            self._uniforms = self.generator.random(self.block_size).tolist()
+            self._next_uniform = 0
+        u = self._uniforms[self._next_uniform]
+        self._next_uniform += 1
+        return u
+
+    def bernoulli(self, p):
+        # 1 with probability p, 0 otherwise
+        if self.uniform() < p:
+            return 1
+        return 0
+
+    def poisson(self, mu):
+        return poisson_table(mu).sample(self.uniform())
+
+    def randrange(self, n):
+        return min(int(self.uniform() * n), n - 1)
+
+    def choice(self, seq):
+        return seq[self.randrange(len(seq))]
+
+    # Vectorised draws for bulk callers, taken directly from the generator
+    def uniforms(self, n):
+        return self.generator.random(n)
+
+    def randranges(self, upper, n):
+        return np.minimum((self.generator.random(n) * upper).astype(np.int64), upper - 1)
+
+    def bernoullis(self, p, n):
+        return self.generator.random(n) < p
+
+    def poissons(self, mu, n):
+        return poisson_table(mu).samples(self.generator.random(n))
+
+
+class RandomStreams:
+    """ The random number streams of one model run.
+
+    Each stream in STREAM_NAMES is available as an attribute, e.g.
+    model.streams.infection.bernoulli(p).
+    """
+
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        self.sequence = np.random.SeedSequence(seed)
+        self.seed = self.sequence.entropy
+        for name, child in zip(STREAM_NAMES, self.sequence.spawn(len(STREAM_NAMES))):
+            setattr(self, name, RandomStream(np.random.default_rng(child), block_size))
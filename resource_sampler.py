@@ -0,0 +1,82 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Background sampling of the resources used by a run.
+#
+# psutil.cpu_percent(1) blocks for a second to measure CPU use. Instead, a
+# daemon thread takes a sample every interval seconds - per-core CPU use
+# since the previous sample, resident memory and I/O counters of the
+# process - and keeps the most recent ones in a ring buffer, from which the
+# reporters read without ever waiting.
+import collections
+import os
+import threading
+import time
+
+import psutil as psu
+
+
+Sample = collections.namedtuple("Sample", ["time", "cpu", "rss", "read_bytes", "write_bytes"])
+
+
+class ResourceSampler:
+    """ Samples resource use on a background thread into a ring buffer.
+
+    The thread is started on first use in every process, since threads do
+    not survive a fork. latest returns the most recent sample, or None
+    before the first one.
+    """
+
+    def __init__(self, interval=1.0, size=600):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.pid = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.samples.clear()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        process = psu.Process()
+        # The first call only sets the reference point of the CPU counters
+        psu.cpu_percent(None, True)
+        while not self.stopped.wait(self.interval):
+            try:
+                io = process.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+            except (AttributeError, psu.Error):
+                # Not available on every platform
+                read_bytes, write_bytes = None, None
+            self.samples.append(Sample(time.time(), tuple(psu.cpu_percent(None, True)),
+                                       process.memory_info().rss, read_bytes, write_bytes))
+
+    def latest(self):
+        self.start()
+        try:
+            return self.samples[-1]
+        except IndexError:
+            return None
+
+    def stop(self):
+        if self.pid == os.getpid():
+            self.stopped.set()
+            self.thread.join()
+            self.pid = None
+
+
+# One sampler per process, shared by all the models it runs
+_sampler = ResourceSampler()
+
+
+def resource_sampler():
+    _sampler.start()
+    return _sampler
@@ -0,0 +1,171 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Memory-mapped store of the population states of a run.
+#
+# The states of all agents at many steps of one run are kept in a single
+# file of fixed-width records, one per agent, laid out step after step
+# (the fields of the checkpoint format, see checkpoint.py, except the
+# contacts, which have no fixed width). A step -> (offset, count) index
+# and a small JSON layout sit next to it. Readers map the file read-only,
+# so the population at any step is a view on the mapped records: nothing
+# is parsed, and the pages are shared by all the processes reading the
+# store.
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import COLUMNS, header
+
+
+INDEX_DTYPE = np.dtype([("step", np.int64), ("offset", np.int64), ("count", np.int64)])
+
+FIELD_DTYPES = {"int": "<i8", "float": "<f8", "bool": "?", "enum": "i1", "category": "<i4"}
+
+
+def snapshot_path(base, iteration):
+    """ store of the snapshots of an iteration, for the save file base """
+    root, _ = os.path.splitext(base)
+    return f"{root}_{iteration}.snapshots"
+
+
+def record_dtype(variants):
+    fields = []
+    for name, kind in COLUMNS:
+        if kind == "ids":
+            continue
+        if kind == "flags":
+            fields.append((name, "?", (len(variants),)))
+        elif kind == "pos":
+            fields.append((name, "<i8", (2,)))
+        else:
+            fields.append((name, FIELD_DTYPES[kind]))
+    return np.dtype(fields)
+
+
+class SnapshotStore:
+    """ Population states of a run at many steps, in one memory-mapped file.
+
+    mode is "r" to read an existing store, "a" to append to it (creating it
+    if needed) or "w" to start a new one. Snapshots are appended from
+    checkpoints captured by checkpoint.capture; read returns the records
+    of a step as a read-only view. A step written again replaces the
+    earlier snapshot in the index. Readers opened while a run is still
+    appending see new steps after refresh.
+    """
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a", "w"):
+            raise ValueError(f"Unknown mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.variants = None
+        self.dtype = None
+        self.index = {}
+        self.records = None
+        self.file = None
+        if mode == "w":
+            for name in (path, path + ".index.npy", path + ".json"):
+                if os.path.exists(name):
+                    os.remove(name)
+        if os.path.exists(path + ".json"):
+            self.refresh()
+        elif mode == "r":
+            raise FileNotFoundError(f"No snapshot store at {path}")
+
+    def refresh(self):
+        with open(self.path + ".json") as f:
+            layout = json.load(f)
+        self.variants = layout["variants"]
+        self.dtype = record_dtype(self.variants)
+        self.index = {}
+        if os.path.exists(self.path + ".index.npy"):
+            for step, offset, count in np.load(self.path + ".index.npy").tolist():
+                self.index[step] = (offset, count)
+        self.records = None
+
+    def _write_index(self):
+        # Written after the records it points to, and renamed into place
+        index = np.array([(step, offset, count) for step, (offset, count) in sorted(self.index.items())],
+                         dtype=INDEX_DTYPE)
+        temporary = self.path + ".index.tmp.npy"
+        np.save(temporary, index)
+        os.replace(temporary, self.path + ".index.npy")
+
+    def append(self, arrays):
+        """ append the population of a checkpoint; returns its step """
+        if self.mode == "r":
+            raise ValueError("Snapshot store opened read-only")
+        info = header(arrays)
+        if self.dtype is None:
+            self.variants = info["variants"]
+            self.dtype = record_dtype(self.variants)
+            with open(self.path + ".json", "w") as f:
+                json.dump({"fields": [name for name, kind in COLUMNS if kind != "ids"],
+                           "variants": self.variants}, f)
+        elif info["variants"] != self.variants:
+            raise ValueError("The variants of a snapshot do not match the store")
+
+        count = len(arrays["unique_id"])
+        records = np.empty(count, dtype=self.dtype)
+        for name in self.dtype.names:
+            records[name] = arrays[name]
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        offset = self.file.tell() // self.dtype.itemsize
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+        step = info["model"]["stepno"]
+        self.index[step] = (offset, count)
+        self._write_index()
+        self.records = None
+        return step
+
+    def steps(self):
+        return sorted(self.index)
+
+    def read(self, step):
+        """ records of all agents at the step, as a read-only view on the file """
+        offset, count = self.index[step]
+        if self.records is None or len(self.records) < offset + count:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode="r")
+        return self.records[offset:offset + count]
+
+    def frame(self, step):
+        """ population at the step as a DataFrame
+
+        Enums are kept as their values, the variant is categorical, and the
+        immunities and position are split into one column each.
+        """
+        records = self.read(step)
+        columns = {}
+        for name in self.dtype.names:
+            if name == "variant":
+                columns[name] = pd.Categorical.from_codes(records[name], self.variants)
+            elif name == "variant_immune":
+                for i, variant in enumerate(self.variants):
+                    columns[f"variant_immune {variant}"] = records[name][:, i]
+            elif name == "pos":
+                columns["pos_x"] = records[name][:, 0]
+                columns["pos_y"] = records[name][:, 1]
+            else:
+                columns[name] = records[name]
+        return pd.DataFrame(columns)
+
+    def __getstate__(self):
+        # Copies (e.g. pickled ones) reopen the file when they need it
+        state = dict(self.__dict__)
+        state["file"] = None
+        state["records"] = None
+        return state
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.records = None
@@ -0,0 +1,727 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Storage backends for Database.
+#
+# Database buffers and orders the writes of a run; a backend decides where
+# the rows end up. All backends share the experiment/agent/summary schema
+# below. PostgreSQL is the shared server used so far, SQLite is an embedded
+# file that needs no server, and Parquet writes append-only columnar files
+# for bulk ensemble output. The backend is selected in the [storage] section
+# of database/database.ini, e.g.
+#
+#   [storage]
+#   backend = parquet
+#   path = outcomes/traces
+#   trace = delta
+#
+# On PostgreSQL, the partitions, step_span and step_ranges options set the
+# partitioning of the trace tables (see postgres_ddl), and fallback = sqlite
+# writes to the SQLite file at path instead when the server cannot be reached.
+import io
+import os
+import sqlite3
+import threading
+import uuid
+from configparser import ConfigParser
+from multiprocessing import util
+
+from config import config
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# Column names and types of every table, in the order of the rows handed to Database
+SCHEMA = {
+    "experiment": [
+        ("uuid", "text"),
+        ("test_cost", "real"),
+        ("alpha_private", "real"),
+        ("alpha_public", "real"),
+        ("fully_vaccinated_count", "integer"),
+        ("prop_initial_infected", "real"),
+        ("generally_infected", "integer"),
+        ("cumul_vaccine_count", "real"),
+        ("cumul_test_cost", "real"),
+        ("total_costs", "real"),
+        ("vaccination_chance", "real"),
+        ("vaccination_stage", "integer"),
+        ("vaccine_cost", "real"),
+        ("day_vaccination_begin", "integer"),
+        ("day_vaccination_end", "integer"),
+        ("effective_period", "integer"),
+        ("effectiveness", "real"),
+        ("distribution_rate", "integer"),
+        ("vaccine_count", "integer"),
+        ("vaccinated_count", "integer"),
+        ("vaccinated_percent", "real"),
+        ("vaccine_dosage", "integer"),
+        ("effectiveness_per_dosage", "real"),
+        ("dwell_15_day", "integer"),
+        ("avg_dwell", "real"),
+        ("avg_incubation", "real"),
+        ("repscaling", "real"),
+        ("prob_contagion_base", "real"),
+        ("kmob", "real"),
+        ("rate_inbound", "real"),
+        ("prob_contagion_places", "real"),
+        ("prob_asymptomatic", "real"),
+        ("avg_recovery", "real"),
+        ("testing_rate", "real"),
+        ("testing_start", "integer"),
+        ("testing_end", "integer"),
+        ("tracing_start", "integer"),
+        ("tracing_end", "integer"),
+        ("tracing_now", "boolean"),
+        ("isolation_rate", "real"),
+        ("isolation_start", "integer"),
+        ("isolation_end", "integer"),
+        ("after_isolation", "real"),
+        ("prob_isolation_effective", "real"),
+        ("distancing", "real"),
+        ("distancing_start", "integer"),
+        ("distancing_end", "integer"),
+        ("new_agent_num", "integer"),
+        ("new_agent_start", "integer"),
+        ("new_agent_end", "integer"),
+        ("new_agent_age_mean", "real"),
+        ("new_agent_prop_infected", "real"),
+        ("vaccination_start", "integer"),
+        ("vaccination_end", "integer"),
+        ("vaccination_now", "boolean"),
+        ("prob_severe", "real"),
+        ("max_bed_available", "real"),
+        ("bed_count", "real"),
+        ("iteration", "integer"),
+    ],
+    "agent": [
+        ("uuid", "text"),
+        ("age_group", "integer"),
+        ("sex_group", "integer"),
+        ("vaccine_willingness", "boolean"),
+        ("incubation_time", "integer"),
+        ("dwelling_time", "integer"),
+        ("recovery_time", "integer"),
+        ("prob_contagion", "real"),
+        ("mortality_value", "real"),
+        ("severity_value", "real"),
+        ("curr_dwelling", "integer"),
+        ("curr_incubation", "integer"),
+        ("curr_recovery", "integer"),
+        ("curr_asymptomatic", "integer"),
+        ("isolated", "boolean"),
+        ("isolated_but_inefficient", "boolean"),
+        ("test_chance", "real"),
+        ("in_isolation", "boolean"),
+        ("in_distancing", "boolean"),
+        ("in_testing", "boolean"),
+        ("astep", "integer"),
+        ("tested", "boolean"),
+        ("occupying_bed", "boolean"),
+        ("cumul_private_value", "real"),
+        ("cumul_public_value", "real"),
+        ("employed", "boolean"),
+        ("tested_traced", "boolean"),
+        ("tracing_delay", "integer"),
+        ("tracing_counter", "integer"),
+        ("vaccinated", "boolean"),
+        ("safetymultiplier", "real"),
+        ("current_effectiveness", "real"),
+        ("vaccination_day", "integer"),
+        ("vaccine_count", "integer"),
+        ("dosage_eligible", "boolean"),
+        ("fully_vaccinated", "boolean"),
+        ("variant", "text"),
+        # Run, step and agent of the row, appended by the trace writer
+        ("experiment_uuid", "text"),
+        ("iteration", "integer"),
+        ("step", "integer"),
+        ("agent_id", "integer"),
+    ],
+    # Delta trace mode (see trace_delta.py): attributes fixed at creation, once per agent
+    "agent_static": [
+        ("experiment_uuid", "text"),
+        ("iteration", "integer"),
+        ("agent_id", "integer"),
+        ("age_group", "integer"),
+        ("sex_group", "integer"),
+        ("vaccine_willingness", "boolean"),
+        ("incubation_time", "integer"),
+        ("dwelling_time", "integer"),
+        ("recovery_time", "integer"),
+        ("mortality_value", "real"),
+        ("severity_value", "real"),
+        ("tracing_delay", "integer"),
+    ],
+    # and one row per changed field, field being its position in the agent table
+    "agent_delta": [
+        ("experiment_uuid", "text"),
+        ("iteration", "integer"),
+        ("step", "integer"),
+        ("agent_id", "integer"),
+        ("field", "integer"),
+        ("value", "real"),
+        ("text", "text"),
+    ],
+    "summary": [
+        ("uuid", "text"),
+        ("cumul_priv_value", "real"),
+        ("cumul_publ_value", "real"),
+        ("cumul_test_cost", "real"),
+        ("rt", "real"),
+        ("employed", "real"),
+        ("unemployed", "real"),
+        ("tested", "real"),
+        ("traced", "real"),
+        ("cumul_vaccine_cost", "real"),
+        ("cumul_cost", "real"),
+        ("step", "integer"),
+        ("n", "real"),
+        ("isolated", "real"),
+        ("vaccinated", "real"),
+        ("vaccines", "real"),
+        ("v", "real"),
+        ("data_time", "real"),
+        ("step_time", "real"),
+        ("generally_infected", "real"),
+        ("fully_vaccinated", "real"),
+        ("vaccine_1", "real"),
+        ("vaccine_2", "real"),
+        ("vaccine_willing", "real"),
+        ("experiment_uuid", "text"),
+        ("iteration", "integer"),
+    ],
+}
+
+# Key columns of the lookups by run and step window, and the columns these
+# indexes carry along so that the lookups never touch the table
+INDEXES = {
+    "experiment": (("uuid",), ()),
+    "agent": (("experiment_uuid", "step", "agent_id"), ()),
+    "agent_static": (("experiment_uuid", "agent_id"), ()),
+    "agent_delta": (("experiment_uuid", "step", "agent_id", "field"), ("value", "text")),
+    "summary": (("experiment_uuid", "step"), ()),
+}
+
+# The trace tables are partitioned on the server by experiment (hashed into
+# a fixed number of partitions) and then by ranges of steps
+PARTITIONED = ("agent", "agent_delta")
+
+# Where the embedded database goes when no path is configured
+DEFAULT_SQLITE_PATH = "outcomes/covidmesa.sqlite"
+
+# Messages of the psycopg2 OperationalError raised when the server cannot be
+# reached at all (as opposed to refusing the credentials or the statements)
+UNREACHABLE_MESSAGES = ("could not connect", "connection refused", "could not translate host name",
+                        "timeout expired", "no route to host", "network is unreachable")
+
+
+def columns(table):
+    return [name for name, _ in SCHEMA[table]]
+
+
+def run_column(table):
+    # Column holding the experiment uuid of a row
+    return "uuid" if table == "experiment" else "experiment_uuid"
+
+
+def select(table, experiment_uuid, first_step, last_step, placeholder):
+    # Query for the rows of a run within a step window, in step and agent order
+    names = columns(table)
+    conditions = ["{} = {}".format(run_column(table), placeholder)]
+    args = [experiment_uuid]
+    if "step" in names:
+        if first_step is not None:
+            conditions.append("step >= {}".format(placeholder))
+            args.append(first_step)
+        if last_step is not None:
+            conditions.append("step <= {}".format(placeholder))
+            args.append(last_step)
+    order = [name for name in ("step", "agent_id", "field") if name in names]
+    sql = "SELECT {} FROM {} WHERE {}".format(", ".join(names), table, " AND ".join(conditions))
+    if order:
+        sql += " ORDER BY " + ", ".join(order)
+    return sql, args
+
+
+def copy_text(value):
+    # Render a value in the text format of COPY
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    text = str(value)
+    if isinstance(value, str):
+        text = text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return text
+
+
+class StorageBackend:
+    """ Destination of the rows written through Database.
+
+    write(table, rows) appends rows (tuples ordered as in SCHEMA) to a
+    table; commit makes the writes so far durable, finish completes the
+    output of a run and close releases the backend. read(table,
+    experiment_uuid, first_step, last_step) returns the rows of one run,
+    optionally limited to a window of steps. healthy tells whether the
+    backend can still be used.
+    """
+
+    def write(self, table, rows):
+        raise NotImplementedError
+
+    def healthy(self):
+        return True
+
+    def read(self, table, experiment_uuid, first_step=None, last_step=None):
+        raise NotImplementedError
+
+    def commit(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.finish()
+
+
+def postgres_ddl(partitions=8, step_span=960, step_ranges=10):
+    """ Statements creating the tables, partitions and indexes on PostgreSQL.
+
+    Every partitioned table is split into partitions hash partitions by
+    experiment_uuid, each of which holds step_ranges ranges of step_span
+    steps plus a default partition for the steps beyond.
+    """
+    types = {"text": "text", "integer": "integer", "real": "double precision", "boolean": "boolean"}
+    statements = []
+    for table, fields in SCHEMA.items():
+        definition = ", ".join("{} {}".format(name, types[kind]) for name, kind in fields)
+        if table not in PARTITIONED:
+            statements.append("CREATE TABLE IF NOT EXISTS {} ({})".format(table, definition))
+        else:
+            statements.append("CREATE TABLE IF NOT EXISTS {} ({}) PARTITION BY HASH (experiment_uuid)".format(
+                table, definition))
+            for remainder in range(partitions):
+                part = "{}_p{}".format(table, remainder)
+                statements.append("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES WITH "
+                                  "(MODULUS {}, REMAINDER {}) PARTITION BY RANGE (step)".format(
+                                      part, table, partitions, remainder))
+                for i in range(step_ranges):
+                    statements.append("CREATE TABLE IF NOT EXISTS {0}_s{1} PARTITION OF {0} FOR VALUES "
+                                      "FROM ({2}) TO ({3})".format(part, i, i * step_span, (i + 1) * step_span))
+                statements.append("CREATE TABLE IF NOT EXISTS {0}_rest PARTITION OF {0} DEFAULT".format(part))
+        keys, included = INDEXES[table]
+        statements.append("CREATE INDEX IF NOT EXISTS {0}_key ON {0} ({1}){2}".format(
+            table, ", ".join(keys), " INCLUDE ({})".format(", ".join(included)) if included else ""))
+    return statements
+
+
+class PostgresBackend(StorageBackend):
+    """ PostgreSQL server, written to with COPY FROM STDIN.
+
+    With create set, the tables of SCHEMA are created if missing (tables
+    created before the run keys were added must be migrated by hand).
+    """
+
+    def __init__(self, params, create=True, partitions=8, step_span=960, step_ranges=10):
+        if psycopg2 is None:
+            raise ImportError("The postgresql storage backend requires psycopg2")
+        self.conn = psycopg2.connect(**params)
+        if create:
+            try:
+                with self.conn.cursor() as cur:
+                    for statement in postgres_ddl(partitions, step_span, step_ranges):
+                        cur.execute(statement)
+                self.conn.commit()
+            except Exception:
+                self.conn.close()
+                raise
+
+    def write(self, table, rows):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join([copy_text(value) for value in row]))
+            buffer.write("\n")
+        buffer.seek(0)
+        sql = "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns(table)))
+        try:
+            with self.conn.cursor() as cur:
+                cur.copy_expert(sql, buffer)
+        except (Exception, psycopg2.DatabaseError):
+            self.conn.rollback()
+            raise
+
+    def healthy(self):
+        if self.conn.closed:
+            return False
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            self.conn.rollback()
+            return True
+        except (Exception, psycopg2.DatabaseError):
+            return False
+
+    def read(self, table, experiment_uuid, first_step=None, last_step=None):
+        sql, args = select(table, experiment_uuid, first_step, last_step, "%s")
+        with self.conn.cursor() as cur:
+            cur.execute(sql, args)
+            rows = cur.fetchall()
+        self.conn.commit()
+        return rows
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteBackend(StorageBackend):
+    """ Embedded SQLite file; the tables are created on first use """
+
+    TYPES = {"text": "TEXT", "integer": "INTEGER", "real": "REAL", "boolean": "INTEGER"}
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Writes may come from the background writer thread of Database
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        for table, fields in SCHEMA.items():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+                table, ", ".join("{} {}".format(name, self.TYPES[kind]) for name, kind in fields)))
+            # SQLite has no partitions nor included columns, the key index has to do
+            keys, included = INDEXES[table]
+            self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_key ON {0} ({1})".format(
+                table, ", ".join(keys + included)))
+        self.conn.commit()
+        print(f"Writing to {path}")
+
+    def write(self, table, rows):
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ", ".join(columns(table)), ", ".join("?" * len(SCHEMA[table])))
+        self.conn.executemany(sql, rows)
+
+    def healthy(self):
+        try:
+            self.conn.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def read(self, table, experiment_uuid, first_step=None, last_step=None):
+        sql, args = select(table, experiment_uuid, first_step, last_step, "?")
+        return self.conn.execute(sql, args).fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class ParquetBackend(StorageBackend):
+    """ Append-only Parquet files, one directory per table and experiment.
+
+    Every batch becomes a row group of the current part file, so the row
+    group statistics narrow step windows down. A part file is completed (and
+    readable) once the run finishes; every process writes its own parts, so
+    ensemble workers never contend for a file.
+    """
+
+    TYPES = {"text": "string", "integer": "int64", "real": "float64", "boolean": "bool_"}
+
+    def __init__(self, path="outcomes/traces"):
+        if pa is None:
+            raise ImportError("The parquet storage backend requires pyarrow")
+        self.path = path
+        self.schemas = {table: pa.schema([(name, getattr(pa, self.TYPES[kind])()) for name, kind in fields])
+                        for table, fields in SCHEMA.items()}
+        self.writers = {}
+        print(f"Writing to {path}")
+
+    def write(self, table, rows):
+        # Rows of several runs go to the directories of their runs
+        key = columns(table).index(run_column(table))
+        runs = {}
+        for row in rows:
+            runs.setdefault(row[key], []).append(row)
+        for experiment_uuid, run_rows in runs.items():
+            self._write(table, experiment_uuid, run_rows)
+
+    def _write(self, table, experiment_uuid, rows):
+        schema = self.schemas[table]
+        arrays = []
+        for values, (_, kind), field in zip(zip(*rows), SCHEMA[table], schema):
+            # Flags are stored as 0/1 by some agents
+            if kind == "boolean":
+                values = [None if value is None else bool(value) for value in values]
+            arrays.append(pa.array(list(values), type=field.type))
+        writer = self.writers.get((table, experiment_uuid))
+        if writer is None:
+            directory = os.path.join(self.path, table, str(experiment_uuid))
+            os.makedirs(directory, exist_ok=True)
+            name = "part-{}-{}.parquet".format(os.getpid(), uuid.uuid4().hex)
+            writer = pq.ParquetWriter(os.path.join(directory, name), schema)
+            self.writers[(table, experiment_uuid)] = writer
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    def read(self, table, experiment_uuid, first_step=None, last_step=None):
+        # Only the completed part files of the run are read
+        directory = os.path.join(self.path, table, str(experiment_uuid))
+        if not os.path.isdir(directory):
+            return []
+        names = columns(table)
+        filters = []
+        if "step" in names:
+            if first_step is not None:
+                filters.append(("step", ">=", first_step))
+            if last_step is not None:
+                filters.append(("step", "<=", last_step))
+        data = pq.read_table(directory, schema=self.schemas[table], filters=filters or None)
+        order = [(name, "ascending") for name in ("step", "agent_id", "field") if name in names]
+        if order:
+            data = data.sort_by(order)
+        return list(zip(*[data.column(name).to_pylist() for name in names]))
+
+    def finish(self):
+        # Complete the part files; later writes start new ones
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+def storage_options(filename='database/database.ini'):
+    # Options of the [storage] section of filename, if any
+    parser = ConfigParser()
+    parser.read(filename)
+    return dict(parser.items("storage")) if parser.has_section("storage") else {}
+
+
+def unreachable(error):
+    # Whether error tells that the server could not be reached, or psycopg2 is missing
+    if isinstance(error, ImportError):
+        return True
+    if psycopg2 is None or not isinstance(error, psycopg2.OperationalError):
+        return False
+    message = str(error).lower()
+    return any(text in message for text in UNREACHABLE_MESSAGES)
+
+
+def open_backend(filename='database/database.ini', create=True):
+    """ Open the backend configured in the [storage] section of filename.
+
+    Without a [storage] section the PostgreSQL server of the [postgresql]
+    section is used. With fallback = sqlite, the SQLite file at path is
+    used instead when psycopg2 is missing or the server cannot be reached;
+    any other error (credentials, statements) is raised. With create set,
+    the server tables are created if missing.
+    """
+    options = storage_options(filename)
+    kind = options.get("backend", "postgresql")
+
+    if kind == "sqlite":
+        return SQLiteBackend(options.get("path", DEFAULT_SQLITE_PATH))
+    if kind == "parquet":
+        return ParquetBackend(options.get("path", "outcomes/traces"))
+    if kind != "postgresql":
+        raise Exception('Unknown storage backend {0} in the {1} file'.format(kind, filename))
+
+    fallback = options.get("fallback")
+    if fallback not in (None, "sqlite"):
+        raise Exception('Unknown storage fallback {0} in the {1} file'.format(fallback, filename))
+    params = config(filename)
+    try:
+        return PostgresBackend(params, create=create, partitions=int(options.get("partitions", 8)),
+                               step_span=int(options.get("step_span", 960)),
+                               step_ranges=int(options.get("step_ranges", 10)))
+    except Exception as error:
+        if fallback is None or not unreachable(error):
+            raise
+        path = options.get("path", DEFAULT_SQLITE_PATH)
+        print(f"PostgreSQL is not available ({str(error).strip()}), falling back to {path}")
+        return SQLiteBackend(path)
+
+
+# Configurations whose tables were created by this process or the one it was forked from
+_created = set()
+
+# (pid, configuration file) -> BackendPool
+_pools = {}
+
+
+class BackendPool:
+    """ Backends opened from one configuration file by one process.
+
+    A connection cannot be shared with a forked child, so every process has
+    its own pools (see backend_pool). At most max_size backends are open at
+    a time; acquire waits for one to be released beyond that. Released
+    backends are kept open for reuse, and are checked to be healthy before
+    they are handed out again. close closes all the backends, idle or
+    checked out.
+    """
+
+    def __init__(self, filename='database/database.ini', max_size=4):
+        self.filename = filename
+        self.max_size = max_size
+        self.idle = []
+        # Backends handed out and not released yet
+        self.busy = set()
+        self.opened = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                while self.idle:
+                    backend = self.idle.pop()
+                    if backend.healthy():
+                        self.busy.add(backend)
+                        return backend
+                    print("Dropping a broken storage connection")
+                    self.opened -= 1
+                    try:
+                        backend.close()
+                    except Exception:
+                        pass
+                if self.opened < self.max_size:
+                    self.opened += 1
+                    break
+                self.condition.wait()
+        try:
+            backend = open_backend(self.filename, create=self.filename not in _created)
+        except Exception:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+        _created.add(self.filename)
+        with self.condition:
+            self.busy.add(backend)
+        return backend
+
+    def release(self, backend):
+        with self.condition:
+            if backend not in self.busy:
+                # Already closed along with the pool
+                return
+            self.busy.remove(backend)
+            if not self.closed:
+                self.idle.append(backend)
+                self.condition.notify()
+                return
+            self.opened -= 1
+            self.condition.notify()
+        backend.close()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            backends = self.idle + list(self.busy)
+            self.idle = []
+            self.busy = set()
+            self.opened -= len(backends)
+            self.condition.notify_all()
+        for backend in backends:
+            try:
+                backend.close()
+            except Exception as error:
+                print(error)
+
+
+def close_pools(pid=None):
+    """ close and discard the pools of a process (by default the current one) """
+    if pid is None:
+        pid = os.getpid()
+    for key in [key for key in _pools if key[0] == pid]:
+        _pools.pop(key).close()
+
+
+def backend_pool(filename='database/database.ini', max_size=4):
+    """ The pool of the current process for filename """
+    pid = os.getpid()
+    key = (pid, filename)
+    pool = _pools.get(key)
+    if pool is None:
+        if not any(other == pid for other, _ in _pools):
+            # The connections of the process are closed when it exits. Finalizers
+            # also run in the workers of a multiprocessing pool, which exit
+            # without calling the atexit handlers, and are not inherited by forks.
+            util.Finalize(None, close_pools, args=(pid,), exitpriority=10)
+        pool = _pools[key] = BackendPool(filename, max_size)
+    return pool
+
+
+class PooledBackend(StorageBackend):
+    """ Backend checked out from the pool of the current process.
+
+    The backend is acquired on first use in every process, so a Database
+    created before the ensemble workers are forked gives each worker its
+    own connection. close returns it to the pool, which closes it when
+    the process exits (see close_pools). A pickled copy (e.g. in the
+    arguments of a pool task) acquires its own backend as well.
+    """
+
+    def __init__(self, filename='database/database.ini', max_size=4):
+        self.filename = filename
+        self.max_size = max_size
+        self.pid = None
+        self.pool = None
+        self.backend = None
+
+    def __getstate__(self):
+        # The backend checked out in this process stays here
+        state = self.__dict__.copy()
+        state.update(pid=None, pool=None, backend=None)
+        return state
+
+    def _backend(self):
+        if self.pid != os.getpid():
+            # A backend inherited from the parent process is left alone
+            self.pool = backend_pool(self.filename, self.max_size)
+            self.backend = self.pool.acquire()
+            self.pid = os.getpid()
+        return self.backend
+
+    def write(self, table, rows):
+        self._backend().write(table, rows)
+
+    def read(self, table, experiment_uuid, first_step=None, last_step=None):
+        return self._backend().read(table, experiment_uuid, first_step, last_step)
+
+    def commit(self):
+        self._backend().commit()
+
+    def finish(self):
+        self._backend().finish()
+
+    def healthy(self):
+        return self._backend().healthy()
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        backend, pool = self.backend, self.pool
+        self.backend = None
+        self.pool = None
+        self.pid = None
+        backend.finish()
+        pool.release(backend)
@@ -0,0 +1,147 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Parity of the columnar population engine (population.py) with CovidAgent.step.
+#
+# The engine updates agents synchronously, so for the same seed the two paths
+# start from the same population but do not follow the same trajectory. The
+# check therefore runs the same seeded scenario on both paths and compares
+# the stage counts (and the number of agents found by contact tracing)
+# averaged over the seeds.
+import json
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from covidmodel import CovidModel, Stage, AgeGroup, SexGroup, ValueGroup
+
+
+SCENARIO = os.path.join(ROOT, "scenarios", "Vaccination_Scenarios_Attempt_4", "Test_A",
+                        "cu-vaccination-test-200-heavyM.json")
+VARIANTS = os.path.join(ROOT, "scenarios", "Backtracking_Scenarios", "Variant_Data.json")
+
+AGE_KEYS = {AgeGroup.C80toXX: "80+", AgeGroup.C70to79: "70-79", AgeGroup.C60to69: "60-69",
+            AgeGroup.C50to59: "50-59", AgeGroup.C40to49: "40-49", AgeGroup.C30to39: "30-39",
+            AgeGroup.C20to29: "20-29", AgeGroup.C10to19: "10-19", AgeGroup.C00to09: "00-09"}
+SEX_KEYS = {SexGroup.MALE: "male", SexGroup.FEMALE: "female"}
+
+SEEDS = range(6)
+AGENTS = 300
+STEPS = 400
+
+
+class NullDatabase:
+    """ Database that drops everything the model writes """
+
+    def insert_model(self, data):
+        pass
+
+    def insert_agent(self, data, keys):
+        pass
+
+    def insert_summary(self, data, keys):
+        pass
+
+    def end_step(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+class NoPolicies:
+    """ Policy handler without any policy """
+
+    def dispatch(self, model, model_data):
+        pass
+
+    def reverse_dispatch(self, model, model_data):
+        pass
+
+
+def model_params():
+    with open(SCENARIO) as f:
+        model = json.load(f)["model"]
+    with open(VARIANTS) as f:
+        variants = json.load(f)["variant"]
+    # A second variant that reinfects appears on day 1, while the first wave is recovering
+    variants = [variants["Standard"], dict(variants["Xeta"], Appearance=1)]
+    epidemiology = model["epidemiology"]
+    policies = model["policies"]
+    stages = {"susceptible": Stage.SUSCEPTIBLE, "exposed": Stage.EXPOSED, "sympdetected": Stage.SYMPDETECTED,
+              "asymptomatic": Stage.ASYMPTOMATIC, "asympdetected": Stage.ASYMPDETECTED, "severe": Stage.SEVERE,
+              "recovered": Stage.RECOVERED, "deceased": Stage.DECEASED}
+    rollout = policies["vaccine_rollout"]
+    return dict(
+        num_agents=AGENTS, width=epidemiology["width"], height=epidemiology["height"],
+        repscaling=epidemiology["repscaling"], kmob=epidemiology["kmob"],
+        age_mortality={age: model["mortalities"]["age"][key] for age, key in AGE_KEYS.items()},
+        sex_mortality={sex: model["mortalities"]["sex"][key] for sex, key in SEX_KEYS.items()},
+        age_distribution={age: model["distributions"]["age"][key] for age, key in AGE_KEYS.items()},
+        sex_distribution={sex: model["distributions"]["sex"][key] for sex, key in SEX_KEYS.items()},
+        # An outbreak that runs its course within the steps of the check, with tracing from day 0
+        prop_initial_infected=0.05, rate_inbound=epidemiology["rate_inbound"], avg_incubation_time=1,
+        avg_recovery_time=2, proportion_asymptomatic=epidemiology["proportion_asymptomatic"],
+        proportion_severe=epidemiology["proportion_severe"], prob_contagion=0.2,
+        proportion_beds_pop=epidemiology["proportion_beds_pop"],
+        proportion_isolated=policies["isolation"]["proportion_isolated"],
+        day_start_isolation=policies["isolation"]["day_start_isolation"],
+        days_isolation_lasts=policies["isolation"]["days_isolation_lasts"],
+        after_isolation=policies["isolation"]["after_isolation"],
+        prob_isolation_effective=policies["isolation"]["prob_isolation_effective"],
+        social_distance=policies["distancing"]["social_distance"],
+        day_distancing_start=policies["distancing"]["day_distancing_start"],
+        days_distancing_lasts=policies["distancing"]["days_distancing_lasts"],
+        proportion_detected=policies["testing"]["proportion_detected"],
+        day_testing_start=policies["testing"]["day_testing_start"],
+        days_testing_lasts=policies["testing"]["days_testing_lasts"],
+        day_tracing_start=0, days_tracing_lasts=100,
+        new_agent_proportion=policies["massingress"]["new_agent_proportion"],
+        new_agent_start=policies["massingress"]["new_agent_start"],
+        new_agent_lasts=policies["massingress"]["new_agent_lasts"],
+        new_agent_age_mean=policies["massingress"]["new_agent_age_mean"],
+        new_agent_prop_infected=policies["massingress"]["new_agent_prop_infected"],
+        stage_value_matrix={ValueGroup.PRIVATE: {stage: model["value"]["private"][key] for key, stage in stages.items()},
+                            ValueGroup.PUBLIC: {stage: model["value"]["public"][key] for key, stage in stages.items()}},
+        test_cost=model["value"]["test_cost"], alpha_private=model["value"]["alpha_private"],
+        alpha_public=model["value"]["alpha_public"],
+        day_vaccination_begin=rollout["day_vaccination_begin"], day_vaccination_end=rollout["day_vaccination_end"],
+        effective_period=rollout["effective_period"], effectiveness=rollout["effectiveness"],
+        distribution_rate=rollout["distribution_rate"], cost_per_vaccine=rollout["cost_per_vaccine"],
+        vaccination_percent=rollout.get("vaccination_percent", 0.5),
+        variant_data=variants, db=NullDatabase())
+
+
+def counts(model):
+    # Agents per stage, followed by the agents found by contact tracing
+    return [model.counters.count("stage", stage) for stage in Stage] + [model.counters.count("traced")]
+
+
+def run(population_engine, seed):
+    model = CovidModel(**model_params(), population_engine=population_engine, seed=seed)
+    model.policy_handler = NoPolicies()
+    initial = counts(model)
+    for _ in range(STEPS):
+        model.step()
+    return initial, counts(model)
+
+
+def test_engine_matches_agents():
+    objects = [run(False, seed) for seed in SEEDS]
+    engine = [run(True, seed) for seed in SEEDS]
+
+    # The same seed draws the same initial population on both paths
+    assert [initial for initial, _ in objects] == [initial for initial, _ in engine]
+
+    final_objects = np.array([final for _, final in objects], dtype=float)
+    final_engine = np.array([final for _, final in engine], dtype=float)
+    difference = np.abs(final_objects.mean(axis=0) - final_engine.mean(axis=0))
+    error = np.sqrt((final_objects.var(axis=0, ddof=1) + final_engine.var(axis=0, ddof=1)) / len(SEEDS))
+    # Four standard errors of the difference of the means, plus 3% of the population
+    assert np.all(difference <= 4 * error + 0.03 * AGENTS), (final_objects.mean(axis=0), final_engine.mean(axis=0))
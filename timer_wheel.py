@@ -0,0 +1,60 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Timing wheel for step-based countdowns.
+#
+# Incubation, recovery and contact tracing are countdowns of a known length
+# that start when an agent enters a stage. Rather than having every agent
+# increment a counter on every step, the agent registers the step at which its
+# countdown runs out and the wheel fires the corresponding callback at the
+# start of that step. Timers are hashed into a fixed ring of slots by step, so
+# scheduling, cancelling and advancing cost O(1) per timer.
+
+
+class Timer:
+
+    __slots__ = ("due", "callback", "cancelled")
+
+    def __init__(self, due, callback):
+        self.due = due
+        self.callback = callback
+        self.cancelled = False
+
+
+class TimerWheel:
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        # First step that has not been fired yet
+        self.now = 0
+
+    def schedule(self, due, callback):
+        # Timers that are already due fire on the next advance
+        due = max(due, self.now)
+        timer = Timer(due, callback)
+        self.slots[due % self.size].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        # Cancelled timers are dropped lazily when their slot comes up
+        timer.cancelled = True
+
+    def advance(self, step):
+        """ Fire, in scheduling order, every timer due at or before step """
+        while self.now <= step:
+            index = self.now % self.size
+            # Callbacks may schedule new timers for the current step, so keep
+            # draining the slot until nothing due is left in it
+            while True:
+                slot = self.slots[index]
+                due = [timer for timer in slot if timer.due <= self.now and not timer.cancelled]
+                self.slots[index] = [timer for timer in slot if timer.due > self.now and not timer.cancelled]
+                if not due:
+                    break
+                for timer in due:
+                    if not timer.cancelled:
+                        timer.callback()
+            self.now += 1
@@ -0,0 +1,115 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Change-only (delta) encoding of the agent trace.
+#
+# A full trace row repeats all the agent fields on every step, although
+# most of them are fixed at creation and the rest change rarely. In delta
+# mode, the fixed attributes of an agent are written once to agent_static,
+# and afterwards only the fields that changed since the agent's previous
+# row are written to agent_delta, one row per field, keyed by experiment,
+# iteration, step and agent. The reader below rebuilds full agent states from
+# both tables.
+from storage_backends import SCHEMA
+
+
+# Keys of a trace row, as handed to Database.insert_agent
+KEY_FIELDS = ("experiment_uuid", "iteration", "step", "agent_id")
+
+# Agent trace fields, as in the rows handed to Database.insert_agent (the
+# leading uuid is a per-row identifier and is not kept in delta mode)
+AGENT_FIELDS = [field for field in SCHEMA["agent"] if field[0] not in KEY_FIELDS]
+
+# Attributes fixed at creation
+STATIC_FIELDS = ("age_group", "sex_group", "vaccine_willingness", "incubation_time", "dwelling_time",
+                 "recovery_time", "mortality_value", "severity_value", "tracing_delay")
+
+STATIC_INDEX = [i for i, (name, _) in enumerate(AGENT_FIELDS) if name in STATIC_FIELDS]
+DYNAMIC_INDEX = [i for i, (name, _) in enumerate(AGENT_FIELDS) if name not in STATIC_FIELDS and name != "uuid"]
+TEXT_INDEX = frozenset(i for i, (_, kind) in enumerate(AGENT_FIELDS) if kind == "text")
+
+
+class DeltaTraceEncoder:
+    """ Turns full agent trace rows into agent_static and agent_delta rows.
+
+    keys gives the (experiment_uuid, iteration, step, agent_id) of every
+    row. The encoder remembers the last row written for every agent of
+    every run.
+    """
+
+    def __init__(self):
+        # (run, agent) -> last full row
+        self.last = {}
+
+    def encode(self, rows, keys):
+        static_rows = []
+        delta_rows = []
+        last = self.last
+        for row, (run, iteration, step, agent) in zip(rows, keys):
+            previous = last.get((run, agent))
+            if previous is None:
+                static_rows.append((run, iteration, agent) + tuple(row[i] for i in STATIC_INDEX))
+                changed = DYNAMIC_INDEX
+            elif previous == row[1:]:
+                continue
+            else:
+                changed = [i for i in DYNAMIC_INDEX if row[i] != previous[i - 1]]
+            for i in changed:
+                value = row[i]
+                if i in TEXT_INDEX:
+                    delta_rows.append((run, iteration, step, agent, i, None, value))
+                else:
+                    delta_rows.append((run, iteration, step, agent, i, None if value is None else float(value), None))
+            last[(run, agent)] = row[1:]
+        return static_rows, delta_rows
+
+
+def _decode(index, value, text):
+    kind = AGENT_FIELDS[index][1]
+    if kind == "text":
+        return text
+    if value is None:
+        return None
+    if kind == "integer":
+        return int(value)
+    if kind == "boolean":
+        return bool(value)
+    return value
+
+
+def reconstruct(static_rows, delta_rows):
+    """ Rebuild full agent states from agent_static and agent_delta rows.
+
+    delta_rows must be ordered by step within every run and grouped by
+    agent within a step (e.g. ORDER BY experiment_uuid, step, agent_id, as
+    returned by Database.fetch_run). Yields (experiment_uuid, step, agent_id,
+    state) for every agent and step with a change, where state maps every
+    agent trace field but uuid to its value.
+    """
+    states = {}
+    for row in static_rows:
+        run, agent = row[0], row[2]
+        states[(run, agent)] = {AGENT_FIELDS[i][0]: _decode(i, value, value)
+                                for i, value in zip(STATIC_INDEX, row[3:])}
+
+    current = None
+    for run, _, step, agent, index, value, text in delta_rows:
+        key = (run, step, agent)
+        if key != current:
+            if current is not None:
+                yield current + (dict(states[(current[0], current[2])]),)
+            current = key
+        states.setdefault((run, agent), {})[AGENT_FIELDS[index][0]] = _decode(index, value, text)
+    if current is not None:
+        yield current + (dict(states[(current[0], current[2])]),)
+
+
+def snapshot(static_rows, delta_rows, run, step):
+    """ Full state of every agent of a run as of the given step """
+    states = {}
+    for row_run, row_step, agent, state in reconstruct(static_rows, delta_rows):
+        if row_run == run and row_step <= step:
+            states[agent] = state
+    return states
@@ -0,0 +1,49 @@
+# Santiago Nunez-Corrales and Eric Jakobsson
+# Illinois Informatics and Molecular and Cell Biology
+# University of Illinois at Urbana-Champaign
+# {nunezco,jake}@illinois.edu
+
+# Vaccination stage scheduling.
+#
+# Vaccines are handed out by age group, starting from the oldest one, and the
+# rollout moves to the next younger group once the current one runs out of
+# eligible (willing, not fully vaccinated, not ill) agents. The scheduler reads
+# the per-age-group eligible counts from the population counters and only
+# recomputes the stage when one of those counts has changed.
+
+
+class VaccinationScheduler:
+
+    def __init__(self, model_data, counters, order):
+        # order: (age group, vaccination stage) pairs in priority order, oldest first
+        self.model_data = model_data
+        self.counters = counters
+        self.order = order
+        self.dirty = True
+        counters.watch("eligible_age", self.invalidate)
+
+    def invalidate(self):
+        self.dirty = True
+
+    def group_count(self, age_group):
+        return self.counters.count("age", age_group)
+
+    def eligible_count(self, age_group):
+        return self.counters.count("eligible_age", age_group)
+
+    def update(self):
+        # Counts coming from a bulk source are not watched, so always re-evaluate them
+        if not self.dirty and self.counters.source is None:
+            return
+        self.dirty = False
+
+        initial_stage = self.model_data.vaccination_stage
+        stage = self.order[-1][1]
+        for age_group, vaccination_stage in self.order:
+            if self.eligible_count(age_group) >= 1:
+                stage = vaccination_stage
+                break
+        self.model_data.vaccination_stage = stage
+
+        if initial_stage != stage:
+            print(f"Vaccination stage is now {stage}")